@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Worker backend benchmark: in-process thread pool vs MPI ranks.
+
+Runs the same parallel NRPA experiment with both backends for each worker count and
+prints wall time, idle time and throughput. The MPI runs are started with mpirun
+(one extra rank for the server).
+
+    python3 benchmarks/backends.py --cores 4 8 16 --iterations 10
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mpi4py
+
+# The benchmark driver starts MPI runs with mpirun, so it must not initialize MPI itself.
+mpi4py.rc.initialize = '--mpi-child' in sys.argv
+
+import parallel_nrpa
+
+
+class BenchmarkExperiment(parallel_nrpa.ParallelNRPAExperiment):
+    """Experiment with parameters from the command line and no Neptune reporting."""
+
+    def __init__(self, params, threads=0):
+        super().__init__(threads=threads)
+        self.params = params
+
+    def init_context(self):
+        self.neptune_ctx = None
+        self.neptune_params = self.params
+
+    def report_progress(self, report_sequence=False):
+        pass
+
+    def server_loop(self):
+        self._server_loop()
+
+        if self.threads == 0:
+            print(json.dumps({'wall_time': self.root.stats['wall_time'],
+                              'idle_time_percent': self.root.idle_time_percent(),
+                              'sequences': int(self.root.stats['sequences']),
+                              'best_sequence': len(self.root.best_sequence)}))
+
+
+def experiment_params(args):
+    return {'iterations': args.iterations,
+            'parallel_levels': args.parallel_levels,
+            'atomic_levels': args.atomic_levels,
+            'alpha': 1.0,
+            'seed': args.seed,
+            'prefetch': args.prefetch,
+            'batch_size': args.batch_size,
+            'speculation_threshold': args.speculation_threshold,
+            'adaptive_selector': args.adaptive_selector}
+
+
+def run_threads(args, cores):
+    experiment = BenchmarkExperiment(experiment_params(args), threads=cores)
+    experiment.server_loop()
+
+    return experiment.root.stats['wall_time'], experiment.root.idle_time_percent(), \
+        experiment.root.stats['sequences']
+
+
+def run_mpi(args, cores):
+    command = [args.mpirun, '-n', str(cores + 1), sys.executable, os.path.abspath(__file__),
+               '--mpi-child', '--iterations', str(args.iterations),
+               '--parallel_levels', str(args.parallel_levels),
+               '--atomic_levels', str(args.atomic_levels), '--seed', str(args.seed),
+               '--prefetch', str(args.prefetch), '--batch_size', str(args.batch_size),
+               '--speculation_threshold', str(args.speculation_threshold)]
+    if args.adaptive_selector:
+        command.append('--adaptive_selector')
+    if args.oversubscribe:
+        command[1:1] = ['--oversubscribe']
+
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+    summary = json.loads(output.strip().splitlines()[-1])
+
+    return summary['wall_time'], summary['idle_time_percent'], summary['sequences']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cores', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--parallel_levels', type=int, default=2)
+    parser.add_argument('--atomic_levels', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--prefetch', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--speculation_threshold', type=float, default=1.0)
+    parser.add_argument('--adaptive_selector', action='store_true')
+    parser.add_argument('--mpirun', default='mpirun')
+    parser.add_argument('--oversubscribe', action='store_true')
+    parser.add_argument('--no-mpi', dest='mpi', action='store_false')
+    parser.add_argument('--mpi-child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mpi_child:
+        BenchmarkExperiment(experiment_params(args)).run()
+        return
+
+    print('{0:>8} {1:>8} {2:>10} {3:>8} {4:>14}'.format('backend', 'cores', 'wall [s]', 'idle',
+                                                       'sequences/s'))
+    for cores in args.cores:
+        backends = [('threads', run_threads)]
+        if args.mpi:
+            backends.append(('mpi', run_mpi))
+
+        for name, run in backends:
+            wall_time, idle, sequences = run(args, cores)
+            print('{0:>8} {1:>8} {2:>10.2f} {3:>8.1%} {4:>14.0f}'.format(
+                name, cores, wall_time, idle, sequences / wall_time if wall_time > 0 else 0.0))
+
+
+if __name__ == '__main__':
+    main()
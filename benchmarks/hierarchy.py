@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+Server topology benchmark: a single server vs a top server with sub-servers.
+
+Runs the same parallel NRPA experiment with mpirun for each number of ranks, once with the
+flat topology and once with sub-servers of about --group_size ranks each (see
+ParallelNRPAExperiment.run_hierarchy), and prints wall time, throughput and the fraction of
+wall time the (top) server was busy rather than waiting for results. A server that is busy
+most of the time is the bottleneck of the run.
+
+    python3 benchmarks/hierarchy.py --ranks 24 96 384 --oversubscribe
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mpi4py
+
+# The benchmark driver starts MPI runs with mpirun, so it must not initialize MPI itself.
+mpi4py.rc.initialize = '--mpi-child' in sys.argv
+
+import parallel_nrpa
+
+
+class BenchmarkExperiment(parallel_nrpa.ParallelNRPAExperiment):
+    """Experiment with parameters from the command line and no Neptune reporting."""
+
+    def __init__(self, params, sub_servers=0):
+        super().__init__(sub_servers=sub_servers)
+        self.params = params
+        self.wait_time = 0.0
+
+    def init_context(self):
+        self.neptune_ctx = None
+        self.neptune_params = self.params
+
+    def init_workers(self):
+        backend = super().init_workers()
+
+        # Time spent waiting for results
+        recv = backend.recv
+
+        def timed_recv():
+            start = time.time()
+            results = recv()
+            self.wait_time += time.time() - start
+            return results
+
+        backend.recv = timed_recv
+        return backend
+
+    def report_progress(self, report_sequence=False):
+        pass
+
+    def report_final_result(self):
+        wall_time = self.root.stats['wall_time']
+        print(json.dumps({'wall_time': wall_time,
+                          'busy': 1.0 - self.wait_time / wall_time if wall_time > 0 else 0.0,
+                          'sequences': int(self.root.stats['sequences']),
+                          'best_sequence': len(self.root.best_sequence)}))
+
+    def server_loop(self):
+        self._server_loop()
+
+
+def sub_servers(args, ranks):
+    return max(1, (ranks - 1) // (args.group_size + 1))
+
+
+def run(args, ranks, servers):
+    command = [args.mpirun, '-n', str(ranks), sys.executable, os.path.abspath(__file__),
+               '--mpi-child', '--sub_servers', str(servers),
+               '--iterations', str(args.iterations),
+               '--parallel_levels', str(args.parallel_levels),
+               '--sub_parallel_levels', str(args.sub_parallel_levels),
+               '--atomic_levels', str(args.atomic_levels), '--seed', str(args.seed)]
+    if args.oversubscribe:
+        command[1:1] = ['--oversubscribe']
+
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+    return json.loads([line for line in output.splitlines() if line.startswith('{')][-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ranks', type=int, nargs='+', default=[24, 96, 384])
+    parser.add_argument('--group_size', type=int, default=24,
+                        help='workers per sub-server')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--parallel_levels', type=int, default=3)
+    parser.add_argument('--sub_parallel_levels', type=int, default=1)
+    parser.add_argument('--atomic_levels', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mpirun', default='mpirun')
+    parser.add_argument('--oversubscribe', action='store_true')
+    parser.add_argument('--sub_servers', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--mpi-child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mpi_child:
+        params = {'iterations': args.iterations,
+                  'parallel_levels': args.parallel_levels,
+                  'sub_parallel_levels': args.sub_parallel_levels,
+                  'atomic_levels': args.atomic_levels,
+                  'alpha': 1.0,
+                  'seed': args.seed}
+        BenchmarkExperiment(params, args.sub_servers).run()
+        return
+
+    print('{0:>6} {1:>12} {2:>10} {3:>14} {4:>8} {5:>6}'.format(
+        'ranks', 'topology', 'wall [s]', 'sequences/s', 'busy', 'best'))
+    for ranks in args.ranks:
+        for name, servers in [('flat', 0), ('two-tier', sub_servers(args, ranks))]:
+            summary = run(args, ranks, servers)
+            wall_time = summary['wall_time']
+            print('{0:>6} {1:>12} {2:>10.2f} {3:>14.0f} {4:>8.1%} {5:>6}'.format(
+                ranks, '{0} {1}'.format(name, servers) if servers else name, wall_time,
+                summary['sequences'] / wall_time if wall_time > 0 else 0.0, summary['busy'],
+                summary['best_sequence']))
+
+
+if __name__ == '__main__':
+    main()
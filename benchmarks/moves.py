@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""
+Move generation benchmark: MorpionGame::MakeMove with neighbourhood tables vs the reference.
+
+Plays --games games of random moves from the root position and replays them with
+MakeMove (precomputed tables of the dot counts and moves touched by a move) and with
+ReferenceMakeMove (the loops over directions and offsets). Only replays are timed. Prints
+moves/s of the best of --repeats runs and checks that both produce the same positions (a
+checksum of every position after every move).
+
+    python3 benchmarks/moves.py --games 2000 --variant 5d
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nrpa
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', choices=['5t', '5d'], default='5t')
+    parser.add_argument('--board_size', type=int, default=0)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    modes = {'reference': True, 'tables': False}
+    results = dict()
+    for name, reference in modes.items():
+        runs = [nrpa.benchmark_moves(args.games, args.seed, args.variant, args.board_size,
+                                     reference)
+                for _ in range(args.repeats)]
+        results[name] = max(runs, key=lambda run: run['moves_per_second'])
+
+    checksums = set(result['checksum'] for result in results.values())
+    assert len(checksums) == 1, 'positions differ'
+
+    print('{0} moves in {1} games'.format(results['tables']['moves'], args.games))
+    print('{0:>10} {1:>12} {2:>10}'.format('', 'Mmoves/s', 'speedup'))
+    for name in modes:
+        print('{0:>10} {1:>12.2f} {2:>10.2f}'.format(
+            name, 1e-6 * results[name]['moves_per_second'],
+            results[name]['moves_per_second'] / results['reference']['moves_per_second']))
+
+
+if __name__ == '__main__':
+    main()
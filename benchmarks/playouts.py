@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Playout kernel micro-benchmark.
+
+Runs the same batch of level 0 playouts (and a level 1 search, where playouts dominate)
+with every playout kernel from identical seeds and reports playouts/s and moves/s.
+Each kernel runs twice: resetting positions by copying the root position ("copy") and
+by undoing the moves recorded in a journal ("journal"); bytes/reset is the amount of
+memory written per reset in each mode.
+
+    python3 benchmarks/playouts.py --playouts 20000
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nrpa
+import policy
+
+
+def run(kernel, journal, levels, iterations, batch_size, seed):
+    payload = {'batch_size': batch_size, 'levels': levels, 'iterations': iterations,
+               'alpha': 1.0, 'random_seed': seed, 'weights': policy.WeightPolicy(),
+               'kernel': kernel, 'journal': journal}
+
+    return nrpa.NRPA().run(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--playouts', type=int, default=20000)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{0:>12} {1:>8} {2:>6} {3:>12} {4:>14} {5:>12} {6:>8}'.format(
+        'kernel', 'reset', 'level', 'playouts/s', 'moves/s', 'bytes/reset', 'best'))
+    for levels, iterations, batch_size in [(0, 1, args.playouts), (1, args.iterations,
+                                           max(1, args.playouts // args.iterations))]:
+        for name, kernel in sorted(nrpa.KERNELS.items(), key=lambda item: item[1]):
+            for journal in [False, True]:
+                best_time_us = None
+                for _ in range(args.repeat):
+                    result = run(kernel, journal, levels, iterations, batch_size, args.seed)
+                    if best_time_us is None or result['time_us'] < best_time_us:
+                        best_time_us = result['time_us']
+
+                # Every playout and every adaptation resets one position
+                resets = result['sequences'] + (iterations * batch_size if levels > 0 else 0)
+                seconds = max(best_time_us, 1) / 1e6
+                print('{0:>12} {1:>8} {2:>6} {3:>12.0f} {4:>14.0f} {5:>12.0f} {6:>8}'.format(
+                    name, 'journal' if journal else 'copy', levels,
+                    result['sequences'] / seconds, result['moves'] / seconds,
+                    result['reset_bytes'] / resets, len(result['best_sequence'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+Policy transfer benchmark: pickled WeightPolicy vs sparse deltas vs adapt sequence chains.
+
+Runs a parallel NRPA experiment in a single process (atomic rollouts are computed in order
+of dispatch by --workers simulated workers) and encodes the policy of every job for its
+worker in three ways: the pickled WeightPolicy, a sparse delta against the worker's cached
+policies (PolicyEncoder) and a chain of adapt sequences from a cached ancestor
+(PolicyEncoder with RootRollout.policy_lineage). Prints pickled bytes per job, server CPU
+time per job (encoding and pickling) and worker CPU time per job (unpickling and
+decoding). --verify checks that workers reconstruct the weights exactly.
+
+    python3 benchmarks/policies.py --workers 8 --iterations 20 --parallel_levels 2
+"""
+
+import argparse
+import os
+import pickle
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nrpa
+import policy_cache
+import rollout
+import selector
+
+
+class PickledPolicy:
+    """The whole WeightPolicy is pickled with every job."""
+
+    def encode(self, worker, job):
+        return job['weights']
+
+    def decode(self, worker, message):
+        return message.to_array()
+
+
+class EncodedPolicy:
+    """Policies are encoded by a PolicyEncoder and decoded by per-worker PolicyCaches."""
+
+    def __init__(self, chains):
+        self.chains = chains
+        self.encoder = policy_cache.PolicyEncoder()
+        self.caches = dict()
+
+    def encode(self, worker, job):
+        return self.encoder.encode(worker, job['policy_id'], job['weights'],
+                                   job['policy_lineage'] if self.chains else None)
+
+    def decode(self, worker, message):
+        if worker not in self.caches:
+            self.caches[worker] = policy_cache.PolicyCache()
+        return self.caches[worker].decode(message)
+
+
+def run(args, methods):
+    root = rollout.RootRollout(iterations=args.iterations, parallel_levels=args.parallel_levels,
+                               atomic_levels=args.atomic_levels, random_seed=args.seed)
+    root.add_pending_nodes()
+    node_selector = selector.IncrementalProbabilitySelector()
+
+    stats = dict((name, {'bytes': 0, 'server': 0.0, 'worker': 0.0}) for name in methods)
+    free = deque(range(1, args.workers + 1))
+    running = deque()
+    jobs = 0
+
+    while True:
+        while free:
+            node = node_selector.select(root)
+            if node is None:
+                break
+            job = node.get_computation_metadata()
+            job['policy_lineage'] = root.policy_lineage
+            node.state = rollout.Rollout.State.running
+            node.mark_as_dirty()
+            worker = free.popleft()
+
+            for name, method in methods.items():
+                start = time.perf_counter()
+                data = pickle.dumps(method.encode(worker, job), pickle.HIGHEST_PROTOCOL)
+                stats[name]['server'] += time.perf_counter() - start
+                stats[name]['bytes'] += len(data)
+
+                start = time.perf_counter()
+                weights = method.decode(worker, pickle.loads(data))
+                stats[name]['worker'] += time.perf_counter() - start
+
+                if args.verify:
+                    assert np.array_equal(weights, job['weights'].to_array()), \
+                        '{0} weights differ'.format(name)
+
+            running.append((job.pop('source'), job, worker))
+            jobs += 1
+            root.update()
+
+        if not running:
+            break
+
+        node, job, worker = running.popleft()
+        del job['policy_lineage']
+        node.record_computation_result(nrpa.NRPA().run(job))
+        free.append(worker)
+        root.update()
+
+    return jobs, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--parallel_levels', type=int, default=2)
+    parser.add_argument('--atomic_levels', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verify', action='store_true')
+    args = parser.parse_args()
+
+    methods = {'pickled policy': PickledPolicy(),
+               'sparse delta': EncodedPolicy(chains=False),
+               'adapt chain': EncodedPolicy(chains=True)}
+    jobs, stats = run(args, methods)
+
+    print('{0} jobs'.format(jobs))
+    print('{0:>16} {1:>12} {2:>14} {3:>14}'.format('', 'bytes/job', 'server [us]',
+                                                   'worker [us]'))
+    for name, method_stats in stats.items():
+        print('{0:>16} {1:>12.0f} {2:>14.1f} {3:>14.1f}'.format(
+            name, method_stats['bytes'] / jobs, 1e6 * method_stats['server'] / jobs,
+            1e6 * method_stats['worker'] / jobs))
+
+
+if __name__ == '__main__':
+    main()
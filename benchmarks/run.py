@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite of the NRPA engine and the rollout tree scheduler.
+
+Runs every benchmark from fixed seeds in a single process (no MPI and no Neptune) and
+writes the results with the commit and machine to a JSON file, so that runs of different
+commits can be compared (--compare). Every benchmark keeps the best of --repeat runs.
+
+* simulate - level 0 playouts of the default playout kernel: playouts/s and ns/move.
+* make_move - MorpionGame::MakeMove replaying random games (nrpa.benchmark_moves): ns/move.
+* adapt - Weights::adapt of a level 1 best sequence (WeightPolicy.adapt): adapts/s.
+* nrpa_level_1..3 - batches of NRPA searches of --iterations iterations, with about
+  --playouts playouts per batch: playouts/s, best length.
+* sequence_comparator - SequenceComparator.is_equal of sequences of equal length: ops/s.
+* rollout_update, select - RootRollout.update and IncrementalProbabilitySelector.select on
+  a synthetic rollout tree (rollouts adapt no policies), as in the server: updates include
+  the work of the selector observing the tree. ops/s.
+
+    python3 benchmarks/run.py --output before.json
+    python3 benchmarks/run.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nrpa
+import policy
+import rollout
+import selector
+
+
+def best_of(args, run):
+    """Result of run() with the highest first metric of --repeat runs."""
+    results = [run() for _ in range(args.repeat)]
+    return max(results, key=lambda result: next(iter(result.values())))
+
+
+def search(levels, iterations, batch_size, seed):
+    return nrpa.NRPA().run({'batch_size': batch_size, 'levels': levels,
+                            'iterations': iterations, 'alpha': 1.0, 'random_seed': seed,
+                            'weights': policy.WeightPolicy()})
+
+
+def simulate(args):
+    def run():
+        result = search(0, 1, args.playouts, args.seed)
+        seconds = max(result['time_us'], 1) / 1e6
+        return OrderedDict([('playouts_per_second', result['sequences'] / seconds),
+                            ('ns_per_move', 1e9 * seconds / max(result['moves'], 1))])
+    return best_of(args, run)
+
+
+def make_move(args):
+    def run():
+        result = nrpa.benchmark_moves(args.games, args.seed)
+        return OrderedDict([('moves_per_second', result['moves_per_second']),
+                            ('ns_per_move', 1e3 * result['time_us'] / max(result['moves'], 1)),
+                            ('checksum', result['checksum'])])
+    return best_of(args, run)
+
+
+def adapt(args):
+    sequence = search(1, args.iterations, 1, args.seed)['best_sequence']
+
+    def run():
+        weights = policy.WeightPolicy()
+        start = time.perf_counter()
+        for _ in range(args.adapts):
+            weights.adapt(sequence)
+        seconds = time.perf_counter() - start
+        return OrderedDict([('adapts_per_second', args.adapts / seconds),
+                            ('us_per_adapt', 1e6 * seconds / args.adapts),
+                            ('sequence_length', len(sequence))])
+    return best_of(args, run)
+
+
+def nrpa_level(levels):
+    def benchmark(args):
+        def run():
+            batch_size = max(1, args.playouts // args.iterations ** levels)
+            result = search(levels, args.iterations, batch_size, args.seed)
+            seconds = max(result['time_us'], 1) / 1e6
+            return OrderedDict([('playouts_per_second', result['sequences'] / seconds),
+                                ('seconds', seconds),
+                                ('best_length', len(result['best_sequence']))])
+        return best_of(args, run)
+    return benchmark
+
+
+def sequence_comparator(args):
+    generator = random.Random(args.seed)
+    sequences = []
+    for _ in range(100):
+        sequence = generator.sample(range(6400), args.length)
+        sequences.append(tuple(sequence))
+        # A few moves changed, so that fuzzy comparisons cannot stop early
+        for _ in range(generator.randint(1, args.length // 2)):
+            sequence[generator.randrange(args.length)] = generator.randrange(6400)
+        sequences.append(tuple(sequence))
+    pairs = [(generator.choice(sequences), generator.choice(sequences))
+             for _ in range(args.comparisons)]
+
+    def run():
+        # Fresh sequences, so that their move sets are computed in every run
+        fresh = {sequence: rollout.MoveSequence(sequence) for sequence in sequences}
+        run_pairs = [(fresh[left], fresh[right]) for left, right in pairs]
+        start = time.perf_counter()
+        for left, right in run_pairs:
+            rollout.SequenceComparator.is_equal(left, right)
+        seconds = time.perf_counter() - start
+        return OrderedDict([('ops_per_second', len(pairs) / seconds)])
+    return best_of(args, run)
+
+
+class SyntheticTree:
+    """Rollout tree whose atomic rollouts complete with random sequences.
+
+    Rollouts adapt to their parent's predicted best sequence without policies, and jobs
+    complete with sequences derived from their adapt sequence (a few moves changed, about
+    the same length), so that rollouts are discarded and compared as in experiments.
+    """
+
+    def __init__(self, args):
+        self.random = random.Random(args.seed)
+        self.length = args.length
+        self.root = rollout.RootRollout(iterations=args.tree_iterations,
+                                        parallel_levels=args.parallel_levels, atomic_levels=0)
+        self.root.add_pending_nodes()
+        self.running = []
+
+    @staticmethod
+    def adapt(node):
+        node.policy = None
+        node.policy_id = 0
+        if node.parent is None or node.sibling is None:
+            node.adapt_sequence = ()
+        else:
+            node.adapt_sequence = node.parent.predicted_best_sequence()
+
+    def dispatch(self, node):
+        node.state = rollout.Rollout.State.running
+        node.mark_as_dirty()
+        self.running.append(node)
+
+    def complete(self):
+        node = self.running.pop(self.random.randrange(len(self.running)))
+        sequence = list(node.adapt_sequence) or self.random.sample(range(6400), self.length)
+        for _ in range(self.random.randint(0, 4)):
+            sequence[self.random.randrange(len(sequence))] = self.random.randrange(6400)
+        length = len(sequence) + self.random.choice([-2, -1, 0, 0, 0, 0, 1])
+        sequence = sequence[:length] + \
+            self.random.sample(range(6400), max(0, length - len(sequence)))
+        node.record_computation_result({'best_sequence': sequence, 'random_seed': 0})
+
+
+def scheduler(args):
+    """Time update() after every dispatch and completion, and select() of the rollouts
+    dispatched, with up to --running rollouts running."""
+    adapt = rollout.Rollout.adapt
+    rollout.Rollout.adapt = SyntheticTree.adapt
+    try:
+        tree = SyntheticTree(args)
+        node_selector = selector.IncrementalProbabilitySelector()
+        times = {'rollout_update': 0.0, 'select': 0.0}
+        counts = {'rollout_update': 0, 'select': 0}
+
+        def timed(name, function, *function_args):
+            start = time.perf_counter()
+            value = function(*function_args)
+            times[name] += time.perf_counter() - start
+            counts[name] += 1
+            return value
+
+        while counts['rollout_update'] < args.updates:
+            while len(tree.running) < args.running:
+                node = timed('select', node_selector.select, tree.root)
+                if node is None:
+                    break
+                tree.dispatch(node)
+                timed('rollout_update', tree.root.update)
+            if not tree.running:
+                break
+            tree.complete()
+            timed('rollout_update', tree.root.update)
+    finally:
+        rollout.Rollout.adapt = adapt
+
+    return dict((name, OrderedDict([('ops_per_second', counts[name] / max(times[name], 1e-9)),
+                                    ('ops', counts[name])]))
+                for name in times)
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([('commit', commit), ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                        ('machine', platform.node()), ('processor', platform.processor()),
+                        ('python', platform.python_version())])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='benchmarks.json')
+    parser.add_argument('--compare', help='results of a previous run')
+    parser.add_argument('--only', nargs='+', help='names of benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--playouts', type=int, default=20000)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--adapts', type=int, default=20000)
+    parser.add_argument('--iterations', type=int, default=20, help='NRPA iterations per level')
+    parser.add_argument('--length', type=int, default=80, help='length of synthetic sequences')
+    parser.add_argument('--comparisons', type=int, default=100000)
+    parser.add_argument('--tree_iterations', type=int, default=100)
+    parser.add_argument('--parallel_levels', type=int, default=3)
+    parser.add_argument('--running', type=int, default=100)
+    parser.add_argument('--updates', type=int, default=2000)
+    args = parser.parse_args()
+
+    benchmarks = OrderedDict([('simulate', simulate), ('make_move', make_move),
+                              ('adapt', adapt), ('nrpa_level_1', nrpa_level(1)),
+                              ('nrpa_level_2', nrpa_level(2)), ('nrpa_level_3', nrpa_level(3)),
+                              ('sequence_comparator', sequence_comparator),
+                              ('scheduler', scheduler)])
+
+    results = OrderedDict()
+    for name, benchmark in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        result = benchmark(args)
+        # The scheduler benchmark measures rollout_update and select together
+        results.update(result if name == 'scheduler' else {name: result})
+
+    previous = dict()
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    print('{0:>20} {1:>20} {2:>14} {3:>10}'.format('benchmark', 'metric', 'value', 'change'))
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            if metric == 'checksum':
+                continue
+            change = ''
+            if previous.get(name, {}).get(metric):
+                change = '{0:+.1%}'.format(value / previous[name][metric] - 1)
+            print('{0:>20} {1:>20} {2:>14.6g} {3:>10}'.format(name, metric, value, change))
+
+    with open(args.output, 'w') as f:
+        json.dump(OrderedDict([('metadata', metadata()), ('arguments', vars(args)),
+                               ('results', results)]), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
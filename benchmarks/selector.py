@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Rollout selector benchmark on synthetic rollout trees.
+
+Grows a rollout tree to about --nodes atomic rollouts by dispatching jobs that complete in
+random order, then measures the time of select() with ProbabilitySelector and
+IncrementalProbabilitySelector while jobs are dispatched and completed. Policies are not
+computed: rollouts get adapt sequences of random lengths, and jobs complete with random
+sequences shorter than any adapt sequence, so that no rollouts are discarded while the tree
+grows. Both selectors work on the same tree and --verify checks that they select the same
+rollouts.
+
+    python3 benchmarks/selector.py --nodes 1000 10000 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rollout
+import selector
+
+
+class SyntheticTree:
+    """Rollout tree whose atomic rollouts complete with random sequences."""
+
+    def __init__(self, iterations, parallel_levels, seed):
+        self.random = random.Random(seed)
+
+        # Policies are not needed for selection, only adapt sequence lengths
+        def adapt(node):
+            node.policy = None
+            node.policy_id = 0
+            node.adapt_sequence = [] if node.sibling is None else \
+                [0] * self.random.randint(64, 160)
+
+        rollout.Rollout.adapt = adapt
+
+        self.root = rollout.RootRollout(iterations=iterations, parallel_levels=parallel_levels,
+                                        atomic_levels=0)
+        self.root.add_pending_nodes()
+        self.running = []
+
+    def dispatch(self, node):
+        node.state = rollout.Rollout.State.running
+        node.mark_as_dirty()
+        self.running.append(node)
+        self.root.update()
+
+    def complete(self, min_length=20, max_length=60):
+        """Complete a random running rollout."""
+        node = self.running.pop(self.random.randrange(len(self.running)))
+        length = self.random.randint(min_length, max_length)
+        node.record_computation_result({'best_sequence': self.random.sample(range(6400), length),
+                                        'random_seed': 0})
+        self.root.update()
+
+    def leaves(self):
+        count = 0
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node.is_atomic():
+                count += 1
+            nodes.extend(node.active_pool)
+        return count
+
+
+def benchmark(nodes, args):
+    # Enough iterations per level that nodes leaves fit in the tree
+    iterations = max(10, int(round(nodes ** (1.0 / args.parallel_levels))) * 4)
+    tree = SyntheticTree(iterations, args.parallel_levels, args.seed)
+
+    reference = selector.ProbabilitySelector()
+    incremental = selector.IncrementalProbabilitySelector()
+
+    # Grow the tree: every dispatched rollout gets a pending sibling. Trees stop growing
+    # when speculative rollouts are too unlikely to be selected.
+    dispatched = 0
+    while dispatched < 20 * nodes and (dispatched % 100 != 0 or tree.leaves() < nodes):
+        node = incremental.select(tree.root)
+        if node is not None:
+            tree.dispatch(node)
+            dispatched += 1
+        if tree.running and (node is None or tree.random.random() < args.completions):
+            tree.complete()
+        elif node is None:
+            break
+
+    leaves = tree.leaves()
+
+    times = {'reference': 0.0, 'incremental': 0.0}
+    selections = 0
+    for _ in range(args.selections):
+        start = time.perf_counter()
+        expected = reference.select(tree.root) if args.reference else None
+        times['reference'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        node = incremental.select(tree.root)
+        times['incremental'] += time.perf_counter() - start
+
+        if args.reference and args.verify:
+            assert node is expected, 'Selectors disagree'
+
+        if node is not None:
+            selections += 1
+            tree.dispatch(node)
+        if tree.running:
+            tree.complete(80, 99)
+
+    return leaves, selections, times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--parallel_levels', type=int, default=3)
+    parser.add_argument('--selections', type=int, default=50)
+    parser.add_argument('--completions', type=float, default=0.5,
+                        help='fraction of dispatched jobs that complete while the tree grows')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verify', action='store_true')
+    parser.add_argument('--no-reference', dest='reference', action='store_false')
+    args = parser.parse_args()
+
+    print('{0:>8} {1:>10} {2:>16} {3:>16}'.format('nodes', 'selections', 'reference [ms]',
+                                                 'incremental [ms]'))
+    for nodes in args.nodes:
+        leaves, selections, times = benchmark(nodes, args)
+        per_selection = dict((name, 1000.0 * total / max(selections, 1))
+                             for name, total in times.items())
+        print('{0:>8} {1:>10} {2:>16.3f} {3:>16.3f}'.format(
+            leaves, selections, per_selection['reference'], per_selection['incremental']))
+
+
+if __name__ == '__main__':
+    main()
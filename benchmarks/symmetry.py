@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+Canonical move numbers benchmark: best sequence length against wall time.
+
+Runs NRPA searches of --levels levels from the same seeds with a weight per move and with
+canonical move numbers (WeightPolicy with canonical_moves: symmetric moves share a weight,
+and only moves that can be legal on the board have weights). The top level runs in Python
+over C++ searches of the lower levels, so that the best length is known after every
+iteration. Prints the number of weights and pickled bytes of policies, and the mean best
+length of --seeds searches at --points times up to the longest search.
+
+    python3 benchmarks/symmetry.py --levels 3 --iterations 30 --seeds 4
+"""
+
+import argparse
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nrpa
+import policy
+
+
+def search(args, canonical_moves, seed):
+    """Return (wall time, best length) after every iteration of the top level."""
+    weights = policy.WeightPolicy(args.variant, args.board_size, canonical_moves)
+    engine = nrpa.NRPA()
+    best = []
+    curve = []
+
+    start = time.perf_counter()
+    for i in range(args.iterations):
+        result = engine.run({'batch_size': 1, 'levels': args.levels - 1,
+                             'iterations': args.iterations, 'alpha': 1.0,
+                             'random_seed': seed * args.iterations + i, 'weights': weights,
+                             'variant': weights.variant, 'board_size': weights.board_size,
+                             'canonical_moves': canonical_moves})
+        if len(result['best_sequence']) >= len(best):
+            best = result['best_sequence']
+        weights.adapt(best)
+        curve.append((time.perf_counter() - start, len(best)))
+
+    return curve
+
+
+def best_at(curve, moment):
+    """Best length found by moment."""
+    length = 0
+    for elapsed, best in curve:
+        if elapsed > moment:
+            break
+        length = best
+    return length
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', choices=['5t', '5d'], default='5t')
+    parser.add_argument('--board_size', type=int, default=0)
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--seeds', type=int, default=4)
+    parser.add_argument('--points', type=int, default=8)
+    args = parser.parse_args()
+
+    modes = {'all moves': False, 'canonical': True}
+    curves = dict((name, [search(args, canonical_moves, seed)
+                          for seed in range(1, args.seeds + 1)])
+                  for name, canonical_moves in modes.items())
+
+    print('{0:>12} {1:>10} {2:>14}'.format('', 'weights', 'pickled bytes'))
+    for name, canonical_moves in modes.items():
+        weights = policy.WeightPolicy(args.variant, args.board_size, canonical_moves)
+        print('{0:>12} {1:>10} {2:>14}'.format(
+            name, weights.to_array().shape[0],
+            len(pickle.dumps(weights, pickle.HIGHEST_PROTOCOL))))
+    print('')
+
+    longest = max(curve[-1][0] for mode_curves in curves.values() for curve in mode_curves)
+    print('{0:>10} '.format('time [s]') + ' '.join('{0:>12}'.format(name) for name in modes))
+    for point in range(1, args.points + 1):
+        moment = longest * point / args.points
+        print('{0:>10.2f} '.format(moment) + ' '.join(
+            '{0:>12.1f}'.format(sum(best_at(curve, moment) for curve in curves[name]) /
+                                len(curves[name]))
+            for name in modes))
+
+
+if __name__ == '__main__':
+    main()
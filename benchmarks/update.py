@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Rollout tree update benchmark against tree size.
+
+Keeps up to --running atomic rollouts running on a synthetic rollout tree and measures the
+time of RootRollout.update() after each completed rollout, with the current
+SequenceComparator and with the previous one (Python loops over a shared scratch array). Policies are not
+computed: rollouts adapt to their parent's predicted best sequence, and jobs complete with
+sequences derived from their adapt sequence (a few moves changed, about the same length),
+so that fuzzy comparisons of sequences of equal length are frequent. Both comparators see
+the same sequence of events.
+
+    python3 benchmarks/update.py --running 10 100 1000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rollout
+
+
+class LegacyComparator:
+    """SequenceComparator.is_equal before move set fingerprints."""
+
+    iter = 1
+    set = np.zeros((10000,), dtype=int)
+
+    @staticmethod
+    def is_equal(left, right):
+        if len(left) != len(right):
+            return False
+        LegacyComparator.iter += 1
+
+        for i in left:
+            LegacyComparator.set[i] = LegacyComparator.iter
+
+        diffs = 0
+        for i in right:
+            if LegacyComparator.set[i] != LegacyComparator.iter:
+                diffs += 1
+                if diffs > len(left) * 0.3:
+                    return False
+
+        return True
+
+
+def adapt(node):
+    """Rollout.adapt without policies."""
+    node.policy = None
+    node.policy_id = 0
+    if node.parent is None or node.sibling is None:
+        node.adapt_sequence = ()
+    else:
+        node.adapt_sequence = node.parent.predicted_best_sequence()
+
+
+def pending_node(root):
+    """First pending atomic rollout in depth-first order."""
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        if node.is_atomic():
+            if node.state == rollout.Rollout.State.pending:
+                return node
+        else:
+            nodes.extend(reversed(node.active_pool))
+    return None
+
+
+def tree_size(root):
+    count = 0
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        count += 1
+        nodes.extend(node.active_pool)
+    return count
+
+
+def benchmark(running, args):
+    """Return the mean tree size and the time per update."""
+    generator = random.Random(args.seed)
+    root = rollout.RootRollout(iterations=args.iterations, parallel_levels=args.parallel_levels,
+                               atomic_levels=0)
+    root.add_pending_nodes()
+    jobs = []
+
+    def result(node):
+        sequence = list(node.adapt_sequence) or generator.sample(range(6400), args.length)
+        for _ in range(generator.randint(0, 4)):
+            sequence[generator.randrange(len(sequence))] = generator.randrange(6400)
+        length = len(sequence) + generator.choice([-2, -1, 0, 0, 0, 0, 1])
+        return sequence[:length] + generator.sample(range(6400), max(0, length - len(sequence)))
+
+    update_time = 0.0
+    sizes = 0
+    updates = 0
+    while updates < args.warmup + args.updates:
+        # Dispatch pending rollouts until running jobs run
+        while len(jobs) < running:
+            node = pending_node(root)
+            if node is None:
+                break
+            node.state = rollout.Rollout.State.running
+            node.mark_as_dirty()
+            jobs.append(node)
+            root.update()
+
+        if not jobs:
+            break
+
+        node = jobs.pop(generator.randrange(len(jobs)))
+        node.record_computation_result({'best_sequence': result(node), 'random_seed': 0})
+
+        start = time.perf_counter()
+        root.update()
+        if updates >= args.warmup:
+            update_time += time.perf_counter() - start
+            sizes += tree_size(root)
+        updates += 1
+
+    measured = max(updates - args.warmup, 1)
+    return sizes / measured, update_time / measured
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--running', type=int, nargs='+', default=[10, 100, 1000],
+                        help='numbers of running atomic rollouts')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--parallel_levels', type=int, default=3)
+    parser.add_argument('--length', type=int, default=80, help='length of first sequences')
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rollout.Rollout.adapt = adapt
+    current = rollout.SequenceComparator.is_equal
+
+    print('{0:>8} {1:>10} {2:>14} {3:>14} {4:>8}'.format(
+        'running', 'tree size', 'legacy [us]', 'current [us]', 'speedup'))
+    for running in args.running:
+        rollout.SequenceComparator.is_equal = staticmethod(LegacyComparator.is_equal)
+        size, legacy_time = benchmark(running, args)
+        rollout.SequenceComparator.is_equal = staticmethod(current)
+        size, current_time = benchmark(running, args)
+
+        print('{0:>8} {1:>10.0f} {2:>14.1f} {3:>14.1f} {4:>8.2f}'.format(
+            running, size, 1e6 * legacy_time, 1e6 * current_time,
+            legacy_time / current_time if current_time > 0 else 0.0))
+
+
+if __name__ == '__main__':
+    main()
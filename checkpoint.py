@@ -0,0 +1,345 @@
+"""
+Checkpointing of the rollout tree.
+
+A checkpoint directory holds the pickled rollout tree (tree.pickle) and an append-only
+store of policies (policies.<generation>.pickle). The policy of a rollout never changes
+after the rollout is created, so every policy is written to the store once, as sparse
+index/value pairs, and the pickled tree refers to policies by policy id.
+
+Checkpoints are written by a background thread. tree.pickle is replaced atomically, only
+after the policies it refers to are on disk, so the directory always holds a consistent
+checkpoint. When most of the store is policies that are no longer in the tree, a new
+generation of the store is started with the live policies only.
+
+tree.pickle starts with a header: the format of the file, the store generation and the
+parameters of the experiment, which an experiment must have to resume from the checkpoint.
+"""
+
+import glob
+import io
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+import policy
+import rollout
+
+TREE_FILE = 'tree.pickle'
+STORE_FILE = 'policies.{0}.pickle'
+
+FORMAT = 2  #: Format of tree.pickle; checkpoints of format 1 have no format in the header
+
+#: Attributes of the root rollout that a resumed experiment must have
+PARAMETERS = ('variant', 'board_size', 'canonical_moves', 'iterations', 'parallel_levels',
+              'atomic_levels', 'alpha', 'batch_size', 'random_seed')
+
+
+def tree_parameters(root):
+    """Return the parameters of the experiment of a rollout tree (see PARAMETERS)."""
+    return dict((name, getattr(root, name)) for name in PARAMETERS)
+
+
+def tree_policies(root):
+    """Map id() of every materialized policy in the rollout tree, and of the policies that
+    the other policies will be materialized from, to (policy_id, policy)."""
+    policies = dict()
+
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        for holder in (node, node.policy_base):
+            if holder is not None and holder.materialized_policy is not None:
+                policies[id(holder.materialized_policy)] = (holder.policy_id,
+                                                            holder.materialized_policy)
+        nodes.extend(node.active_pool)
+
+    return policies
+
+
+def tree_nodes(root):
+    """List the rollouts that the rollout tree refers to, root first. Discarded rollouts
+    are listed only if a rollout in the tree refers to them."""
+    index = {id(root)}
+    nodes = [root]
+
+    position = 0
+    while position < len(nodes):
+        node = nodes[position]
+        position += 1
+        for value in vars(node).values():
+            if value is root.discarded_pool:
+                continue
+            for item in (value if isinstance(value, (deque, list)) else (value,)):
+                if isinstance(item, rollout.Rollout) and id(item) not in index:
+                    index.add(id(item))
+                    nodes.append(item)
+
+    return nodes
+
+
+class TreePickler(pickle.Pickler):
+    """Pickles policies as policy ids. Discarded rollouts, observers, the lineage of
+    policies and random seeds are not saved.
+
+    Rollouts refer to their children, parents, siblings and policy bases, so pickling the
+    root would recurse along these references, deeper for deeper trees. The tree is pickled
+    flat instead (dump_tree): the classes of all rollouts, then their attributes, with
+    rollouts pickled as their index.
+    """
+
+    def __init__(self, file, root, policy_ids):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.root = root
+        self.policy_ids = policy_ids
+        self.indices = dict()
+
+    def dump_tree(self):
+        nodes = tree_nodes(self.root)
+        self.dump([type(node) for node in nodes])
+
+        self.indices = dict((id(node), index) for index, node in enumerate(nodes))
+        self.dump([vars(node) for node in nodes])
+
+    def persistent_id(self, obj):
+        if isinstance(obj, rollout.Rollout):
+            return ('node', self.indices[id(obj)])
+        if obj is self.root.discarded_pool:
+            return ('discarded_pool',)
+        if obj is self.root.observers:
+            return ('observers',)
+        if obj is self.root.policy_lineage:
+            return ('policy_lineage',)
+        if obj is self.root.seeds:
+            return ('seeds',)
+        if isinstance(obj, policy.WeightPolicy) and id(obj) in self.policy_ids:
+            return ('policy', self.policy_ids[id(obj)], obj.variant, obj.board_size,
+                    obj.canonical_moves)
+        return None
+
+
+class TreeUnpickler(pickle.Unpickler):
+    def __init__(self, file, store):
+        super().__init__(file)
+        self.store = store
+        self.nodes = []
+
+    def load_tree(self):
+        """Load a tree written by TreePickler.dump_tree and return its root."""
+        self.nodes = [cls.__new__(cls) for cls in self.load()]
+        for node, attributes in zip(self.nodes, self.load()):
+            node.__dict__.update(attributes)
+        return self.nodes[0]
+
+    def persistent_load(self, pid):
+        if pid[0] == 'node':
+            return self.nodes[pid[1]]
+        if pid[0] in ('discarded_pool', 'observers'):
+            return []
+        if pid[0] == 'policy_lineage':
+            return OrderedDict()
+        if pid[0] == 'seeds':
+            return None
+
+        size, indices, values = self.store[pid[1]]
+        weights = np.zeros(size, dtype=np.float32)
+        weights[indices] = values
+
+        # Checkpoints without the game of policies are 5T searches on the largest board
+        loaded = policy.WeightPolicy(*pid[2:])
+        loaded.set_array(weights)
+        return loaded
+
+
+def read_store(path):
+    """Read policy records. A record torn by an interrupted write ends the store."""
+    store = dict()
+
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                policy_id, size, indices, values = pickle.load(file)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                break
+            store[policy_id] = (size, indices, values)
+
+    return store
+
+
+def write_atomic(path, data):
+    """Replace the file at path with data, so that readers see the old or the new file."""
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+class Checkpointer:
+    """Writes checkpoints of a rollout tree to a directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self.generation = None      #: Store generation written by this checkpointer
+        self.written = set()        #: Policy ids in the store
+        self.records = 0            #: Records in the store, including dead policies
+        self.thread = None
+
+        self.stats = {'checkpoints': 0, 'snapshot_time': 0.0, 'write_time': 0.0}
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def save(self, root, wait=False):
+        """Snapshot the rollout tree and write it in the background.
+
+        Returns False without taking a snapshot if the previous checkpoint is still being
+        written, unless wait is set.
+        """
+        if self.busy():
+            if not wait:
+                return False
+            self.thread.join()
+
+        snapshot_start = time.time()
+
+        policies = tree_policies(root)
+        policy_ids = dict((key, policy_id) for key, (policy_id, _) in policies.items())
+        live = set(policy_ids.values())
+
+        # Start a new generation of the store when it is mostly dead policies
+        compact = self.generation is None or self.records > 2 * len(live) + 64
+        written = set() if compact else self.written
+
+        new_policies = dict()
+        for policy_id, node_policy in policies.values():
+            if policy_id not in written and policy_id not in new_policies:
+                new_policies[policy_id] = node_policy.to_array()
+
+        tree = io.BytesIO()
+        TreePickler(tree, root, policy_ids).dump_tree()
+
+        self.stats['snapshot_time'] += time.time() - snapshot_start
+
+        header = {'format': FORMAT, 'parameters': tree_parameters(root)}
+        self.thread = threading.Thread(target=self.write,
+                                       args=(header, tree.getvalue(), new_policies, compact))
+        self.thread.start()
+
+        if wait:
+            self.thread.join()
+
+        return True
+
+    def close(self):
+        """Wait for the checkpoint being written."""
+        if self.thread is not None:
+            self.thread.join()
+
+    def store_generations(self):
+        generations = []
+        for path in glob.glob(os.path.join(self.directory, STORE_FILE.format('*'))):
+            match = re.search(r'policies\.(\d+)\.pickle$', path)
+            if match:
+                generations.append(int(match.group(1)))
+        return generations
+
+    def write(self, header, tree, new_policies, compact):
+        write_start = time.time()
+
+        if compact:
+            self.generation = max(self.store_generations(), default=-1) + 1
+            self.written = set()
+            self.records = 0
+
+        store_name = STORE_FILE.format(self.generation)
+
+        with open(os.path.join(self.directory, store_name), 'ab') as store:
+            for policy_id, weights in new_policies.items():
+                indices = np.flatnonzero(weights)
+                index_type = np.uint16 if weights.shape[0] <= 65536 else np.int32
+                pickle.dump((policy_id, weights.shape[0], indices.astype(index_type),
+                             weights[indices]), store, protocol=pickle.HIGHEST_PROTOCOL)
+            store.flush()
+            os.fsync(store.fileno())
+
+        self.written.update(new_policies)
+        self.records += len(new_policies)
+
+        header = pickle.dumps(dict(header, store=store_name), protocol=pickle.HIGHEST_PROTOCOL)
+        write_atomic(os.path.join(self.directory, TREE_FILE), header + tree)
+
+        # Older generations are not referenced by the new tree
+        if compact:
+            for generation in self.store_generations():
+                if generation != self.generation:
+                    os.remove(os.path.join(self.directory, STORE_FILE.format(generation)))
+
+        self.stats['checkpoints'] += 1
+        self.stats['write_time'] += time.time() - write_start
+
+        logging.info("Checkpoint written ({0} new policies).".format(len(new_policies)))
+
+
+def load(directory, parameters=None):
+    """Load the rollout tree of the latest checkpoint in directory, or return None.
+
+    Atomic rollouts that were running when the checkpoint was taken become pending, so
+    only they are computed again. Random seeds are generated again from the seed of the
+    root. The lineage of policies starts empty, so policies of the loaded tree are sent to
+    workers as deltas (see policy_cache).
+
+    Raises ValueError if the checkpoint cannot be read, has another format, or if its
+    experiment parameters differ from parameters (see tree_parameters).
+    """
+    path = os.path.join(directory, TREE_FILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as file:
+        try:
+            header = pickle.load(file)
+        except Exception as error:
+            raise ValueError("Cannot read checkpoint {0}: {1!r}".format(path, error)) from error
+
+        version = header.get('format', 1) if isinstance(header, dict) else None
+        if version != FORMAT:
+            raise ValueError("Checkpoint {0} has format {1}, expected {2}. Remove it to start "
+                             "the experiment again.".format(path, version, FORMAT))
+
+        if parameters is not None:
+            saved = header['parameters']
+            different = ['{0}={1!r} (expected {2!r})'.format(name, saved.get(name), value)
+                         for name, value in sorted(parameters.items())
+                         if saved.get(name) != value]
+            if different:
+                raise ValueError("Checkpoint {0} is of an experiment with other parameters: "
+                                 "{1}.".format(path, ', '.join(different)))
+
+        try:
+            store = read_store(os.path.join(directory, header['store']))
+            root = TreeUnpickler(file, store).load_tree()
+        except Exception as error:
+            raise ValueError("Cannot read checkpoint {0}: {1!r}".format(path, error)) from error
+
+    root.init_seeds()
+
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        if node.is_atomic() and node.state == rollout.Rollout.State.running:
+            node.state = rollout.Rollout.State.pending
+            node.mark_as_dirty()
+        nodes.extend(node.active_pool)
+
+    root.update()
+
+    return root
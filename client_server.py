@@ -3,16 +3,20 @@ Client/Server code that distributes calculations across multiple nodes.
 """
 
 import logging
+import threading
 import time
 from collections import deque
 from mpi4py import MPI
-from deepsense import neptune
 
 import gc
 
 class ClientServer:
+    POLL_INTERVAL = 0.01    #: Seconds between checks for commands during a computation
+
     def server_loop(self):
         """Server loop."""
+        from deepsense import neptune
+
         self.comm = MPI.COMM_WORLD
         self.rank = self.comm.Get_rank()
         self.nodes = self.comm.Get_size() - 1
@@ -54,9 +58,13 @@ class ClientServer:
             cmd = {'command': 'quit'}
             self.comm.send(cmd, dest=client+1)
 
-    def client_loop(self):
-        """Client loop."""
-        self.comm = MPI.COMM_WORLD
+    def client_loop(self, comm=None):
+        """Client loop receiving commands from rank 0 of comm (MPI.COMM_WORLD by default).
+
+        If new_engine() returns engines, computations run in a separate thread, and cancel
+        commands received meanwhile cancel the engines of running or queued jobs.
+        """
+        self.comm = comm if comm is not None else MPI.COMM_WORLD
         self.rank = self.comm.Get_rank()
         self.nodes = self.comm.Get_size() - 1
 
@@ -67,12 +75,17 @@ class ClientServer:
         self.stats["computation_time"] = 0
         self.stats["idle_time"] = 0
 
+        self.commands = deque()     # received commands, with engines of run commands
+        self.engines = dict()       # job id -> engine of a queued or running job
+
         time_checkpoint = time.time()
 
         while True:
             # logging.debug("Client {0} is waiting for a job.".format(self.rank))
 
-            data = self.comm.recv(source=0)
+            while not self.commands:
+                self.receive_command()
+            data, engine = self.commands.popleft()
 
             if data['command'] == 'quit':
                 logging.info("Stopping client {0}.".format(self.rank))
@@ -84,7 +97,8 @@ class ClientServer:
                 time_checkpoint = time_measurement
 
                 logging.debug("Process {0} received RUN command.".format(self.rank))
-                result = self.atomic_computation(data['payload'])
+                result = self.compute(data['payload'], engine)
+                self.engines.pop(data['payload'].get('job_id'), None)
                 gc.collect()
                 logging.debug("Process {0} finished computation.".format(self.rank))
 
@@ -96,6 +110,54 @@ class ClientServer:
 
                 self.comm.send({"source": self.rank, "result": result, "stats": self.stats}, dest=0)
 
+    def receive_command(self):
+        """Receive a command from the server.
+
+        Cancel commands are executed at once, other commands are queued.
+        """
+        data = self.comm.recv(source=0)
+
+        if data['command'] == 'cancel':
+            engine = self.engines.get(data['job_id'])
+            if engine is not None:
+                logging.debug("Process {0} cancels job {1}.".format(self.rank, data['job_id']))
+                engine.cancel()
+            return
+
+        engine = None
+        if data['command'] == 'run':
+            engine = self.new_engine()
+            if engine is not None:
+                self.engines[data['payload'].get('job_id')] = engine
+
+        self.commands.append((data, engine))
+
+    def compute(self, payload, engine):
+        """Run atomic_computation, receiving commands in the meantime if there is an engine."""
+        if engine is None:
+            return self.atomic_computation(payload)
+
+        outcome = dict()
+
+        def computation():
+            try:
+                outcome['result'] = self.atomic_computation(payload, engine)
+            except Exception as error:
+                outcome['error'] = error
+
+        thread = threading.Thread(target=computation)
+        thread.start()
+        while thread.is_alive():
+            if self.comm.Iprobe(source=0):
+                self.receive_command()
+            else:
+                thread.join(ClientServer.POLL_INTERVAL)
+
+        if 'error' in outcome:
+            raise outcome['error']
+
+        return outcome['result']
+
     def run(self):
         """Entry point."""
         if MPI.COMM_WORLD.Get_rank() == 0:
@@ -165,5 +227,10 @@ class ClientServer:
         pass
 
     # Experiment specific methods - client-side
-    def atomic_computation(self, payload):
+    def atomic_computation(self, payload, engine=None):
         pass
+
+    def new_engine(self):
+        """Return an object with a thread-safe cancel() method that atomic_computation
+        computes with, or None if computations cannot be cancelled."""
+        return None
@@ -1,27 +1,15 @@
+#include <algorithm>
 #include <random>
 #include <chrono>
 #include <fstream>
 #include <iostream>
+#include <stdexcept>
+#include <string>
 #include <vector>
 
 #include "morpiongame.h"
 #include "cppnrpa.h"
 
-/*
- * The root object holds the root search position.
- * We use it for performance: copying constructor is much faster for MorpionGame.
- */
-const MorpionGame root;
-
-/*
- * Holds the search parameters and results.
- * Global for performance.
- */
-
-std::mt19937_64 generator;
-
-CppNRPAExperimentData *state;
-
 float max(float a, float b)
 {
     return a > b ? a : b;
@@ -32,6 +20,38 @@ float min(float a, float b)
     return a > b ? b : a;
 }
 
+/*
+ * exp(x) for x <= 88 with relative error below 1e-7 (values below exp(-87) are not
+ * flushed to zero, they are returned as ~1e-38). There are no branches or floating point
+ * comparisons, so loops calling it are vectorized by the compiler.
+ * exp(x) = 2^i * exp(g), where i = round(x / ln 2) and |g| <= ln(2) / 2; exp(g) is
+ * approximated with the Cephes expf polynomial.
+ */
+
+static inline float vectorizable_exp(float x)
+{
+    const float round_magic = 12582912.0f;   // 1.5 * 2^23: adding it rounds to integer
+
+    float r = (x * 1.44269504088896341f + round_magic) - round_magic;
+    float g = x - r * 0.693359375f + r * 2.12194440e-4f;
+    int i = (int) r;
+    i = i < -126 ? -126 : i;
+
+    float p = 1.9875691500e-4f;
+    p = p * g + 1.3981999507e-3f;
+    p = p * g + 8.3334519073e-3f;
+    p = p * g + 4.1665795894e-2f;
+    p = p * g + 1.6666665459e-1f;
+    p = p * g + 5.0000001201e-1f;
+    p = p * g * g + g + 1.0f;
+
+    int bits = (i + 127) << 23;
+    float scale;
+    memcpy(&scale, &bits, sizeof(scale));
+
+    return p * scale;
+}
+
 /*
  * Probability weights table. It stores exp(adaptation weight of m) for each move m.
  */
@@ -47,18 +67,42 @@ Weights::~Weights()
 {
 }
 
-Weights::Weights(float _w[])
+Weights::Weights(MorpionGame::Variant variant, int board_size, bool canonical, const float _w[])
 {
-    memcpy(w, _w, sizeof(w));
+    reset(variant, board_size, canonical);
+    memcpy(w, _w, length * sizeof(w[0]));
+}
+
+void Weights::reset(MorpionGame::Variant _variant, int _board_size, bool _canonical)
+{
+    variant = _variant;
+    board_size = _board_size;
+    canonical = _canonical;
+    length = MorpionGame::Root(variant, board_size, canonical).goedel_count();
+    exp_cache = false;
+
+    for (int i = 0; i < length; i++) {
+        w[i] = 0.0f;
+    }
 }
 
 Weights::Weights(const Weights& _w)
 {
-    memcpy(w, _w.w, sizeof(w));
+    *this = _w;
 }
 
 Weights& Weights::operator=(const Weights& _w) {
-    memcpy(w, _w.w, sizeof(w));
+    variant = _w.variant;
+    board_size = _w.board_size;
+    canonical = _w.canonical;
+    length = _w.length;
+    memcpy(w, _w.w, length * sizeof(w[0]));
+
+    exp_cache = _w.exp_cache;
+    if (exp_cache) {
+        shift = _w.shift;
+        memcpy(e, _w.e, length * sizeof(e[0]));
+    }
     return *this;
 }
 
@@ -70,14 +114,76 @@ const float& Weights::operator[](int i) const {
     return w[i];
 }
 
+void Weights::enable_exp_cache()
+{
+    exp_cache = true;
+    renormalize();
+}
+
+void Weights::renormalize()
+{
+    shift = w[0];
+    for (int i = 0; i < length; i++) {
+        shift = max(shift, w[i]);
+    }
+
+    for (int i = 0; i < length; i++) {
+        e[i] = vectorizable_exp(w[i] - shift);
+    }
+}
+
+void Weights::update_exp_cache(const std::vector<int> &touched)
+{
+    float top = shift;
+    for (int g: touched) {
+        top = max(top, w[g]);
+    }
+
+    // Keep the cached values far from float overflow
+    if (top - shift > 40.0f) {
+        renormalize();
+        return;
+    }
+
+    for (int g: touched) {
+        e[g] = vectorizable_exp(w[g] - shift);
+    }
+}
+
 // Probability weights adaptation. Standard way (gradient ascent move by move).
 void Weights::adapt(const MorpionGame::Sequence &l)
 {
-    Weights orig(*this);
-    MorpionGame simulation(root);
+    MorpionGame simulation(MorpionGame::Root(variant, board_size, canonical));
+    adapt(l, simulation);
+}
 
+// Adaptation replaying the sequence in simulation, which must be in the root position.
+//
+// All updates are computed from the weights before the adaptation, so they are computed
+// first and written afterwards, in the same order (the result is identical to updating a
+// copy). Only the weights of legal moves along the sequence are read and written.
+void Weights::adapt(const MorpionGame::Sequence &l, MorpionGame &simulation)
+{
     float W;
 
+    // Updates in order of the replay: w[g] += alpha for played moves, w[g] -= delta for
+    // the other legal moves. Deltas keep the type of the expressions that compute them, so
+    // that the subtractions round exactly as in place.
+    enum UpdateKind { PLAYED, CACHED, EXPONENTIAL };
+    typedef decltype(alpha * exp(w[0] - W) / W) Delta;
+    struct Update {
+        int g;
+        UpdateKind kind;
+        float cached_delta;
+        Delta delta;
+    };
+    static thread_local std::vector<Update> updates;
+    updates.clear();
+
+    // Entries changed by the adaptation, used to update the exp cache
+    static thread_local std::vector<int> touched;
+    touched.clear();
+
     for (unsigned int i = 0; i < l.length; i++) {
         const MorpionGame::Move &m = l.mv[i];
 
@@ -85,8 +191,8 @@ void Weights::adapt(const MorpionGame::Sequence &l)
         float smin =  1000000000.0f;
 
         for (unsigned int i = 0; i < simulation.Moves().length; i++) {
-            smax = max(smax,orig[MorpionGame::goedel_number(simulation.Moves().mv[i])]);
-            smin = min(smin,orig[MorpionGame::goedel_number(simulation.Moves().mv[i])]);
+            smax = max(smax,w[simulation.goedel_number(simulation.Moves().mv[i])]);
+            smin = min(smin,w[simulation.goedel_number(simulation.Moves().mv[i])]);
         }
 
         float s = (smax + smin) / 2.0f;
@@ -95,45 +201,66 @@ void Weights::adapt(const MorpionGame::Sequence &l)
             s = smax - 5.0f;
         }
 
-//            std::cout << "MAX1 " << s << std::endl;
+        if (exp_cache) {
+            // exp(w - s) / W does not depend on s, use cached exponentials
+            W = 0.0f;
+            for (unsigned int j = 0; j < simulation.Moves().length; j++) {
+                W += e[simulation.goedel_number(simulation.Moves().mv[j])];
+            }
+
+            // Unless all of them underflowed
+            if (W > 1e-30f) {
+                for (unsigned int j = 0; j < simulation.Moves().length; j++) {
+                    int g = simulation.goedel_number(simulation.Moves().mv[j]);
+                    if (w[g] > 2e-10) {
+                        updates.push_back({g, CACHED, alpha * e[g] / W, 0});
+                    }
+                }
+                updates.push_back({simulation.goedel_number(m), PLAYED, 0.0f, 0});
+
+                simulation.MakeMove(m);
+                continue;
+            }
+        }
 
         W = 0.0f;
         for (unsigned int j = 0; j < simulation.Moves().length; j++) {
-            W += exp(orig[MorpionGame::goedel_number(simulation.Moves().mv[j])] - s);
+            W += exp(w[simulation.goedel_number(simulation.Moves().mv[j])] - s);
         }
-//            std::cout << "W " << W << std::endl;
 
         if (W > 2e10) {
-            std::cout << "SMAX " << smax << " SMIN " << smin << " s " << s << std::endl;
-
-            for (unsigned int j = 0; j < simulation.Moves().length; j++) {
-                std::cout << orig[MorpionGame::goedel_number(simulation.Moves().mv[j])] << " ";
-            }
-            std::cout << std::endl;
-            for (unsigned int j = 0; j < simulation.Moves().length; j++) {
-                std::cout << orig[MorpionGame::goedel_number(simulation.Moves().mv[j])] - s << " ";
-            }
-            std::cout << std::endl;
-
-            exit(1);
+            // Diverged weights: report to the caller, the weights are not changed yet
+            throw std::overflow_error("Weights diverged in adapt: smax " + std::to_string(smax) +
+                                      " smin " + std::to_string(smin) + " s " +
+                                      std::to_string(s));
         }
 
         for (unsigned int j = 0; j < simulation.Moves().length; j++) {
-            if (orig[MorpionGame::goedel_number(simulation.Moves().mv[j])] > 2e-10) {
-                w[MorpionGame::goedel_number(simulation.Moves().mv[j])] -= alpha *
-                        exp(orig[MorpionGame::goedel_number(simulation.Moves().mv[j])] - s) / W;
+            int g = simulation.goedel_number(simulation.Moves().mv[j]);
+            if (w[g] > 2e-10) {
+                updates.push_back({g, EXPONENTIAL, 0.0f, alpha * exp(w[g] - s) / W});
             }
         }
-        w[MorpionGame::goedel_number(m)] += alpha;
+        updates.push_back({simulation.goedel_number(m), PLAYED, 0.0f, 0});
 
-        s = -1000000000.0f;
-        for (unsigned int j = 0; j < simulation.Moves().length; j++) {
-            s = max(s,orig[MorpionGame::goedel_number(simulation.Moves().mv[j])]);
+        simulation.MakeMove(m);
+    }
+
+    for (const Update &update: updates) {
+        if (update.kind == PLAYED) {
+            w[update.g] += alpha;
+        } else if (update.kind == CACHED) {
+            w[update.g] -= update.cached_delta;
+        } else {
+            w[update.g] -= update.delta;
         }
-        s = s - 10.0f;
-//            std::cout << "MAX2" << s << std::endl;
+        if (exp_cache) {
+            touched.push_back(update.g);
+        }
+    }
 
-        simulation.MakeMove(m);
+    if (exp_cache) {
+        update_exp_cache(touched);
     }
 }
 
@@ -142,11 +269,50 @@ void Weights::adapt(const MorpionGame::Sequence &l)
  * Single playout given probability weight table. Result is stored in passed sequence.
  */
 
-void simulate(const Weights &w, MorpionGame::Sequence &l)
+void CppNRPA::simulate(const Weights &w, MorpionGame::Sequence &l)
 {
-	l.init();
+    if (journal) {
+        simulate(w, game, l);
+
+        reset_bytes += game.Rollback(*root);
+    } else {
+        MorpionGame simulation(*root);
+        simulate(w, simulation, l);
+
+        reset_bytes += root -> StateBytes();
+    }
 
-	MorpionGame simulation(root);
+	moves += l.length;
+	sequences++;
+}
+
+void CppNRPA::simulate(const Weights &w, MorpionGame &simulation, MorpionGame::Sequence &l)
+{
+    if (kernel == REFERENCE_KERNEL) {
+        simulate_reference(w, simulation, l);
+    } else if (kernel == EXP_CACHE_KERNEL && w.exp_cache) {
+        simulate_exp_cache(w, simulation, l);
+    } else {
+        simulate_vectorized(w, simulation, l);
+    }
+}
+
+void CppNRPA::adapt(Weights &w, const MorpionGame::Sequence &l)
+{
+    if (journal) {
+        w.adapt(l, game);
+
+        reset_bytes += game.Rollback(*root);
+    } else {
+        w.adapt(l);
+
+        reset_bytes += root -> StateBytes();
+    }
+}
+
+void CppNRPA::simulate_reference(const Weights &w, MorpionGame &simulation, MorpionGame::Sequence &l)
+{
+	l.init();
 
 	while(simulation.Moves().length > 0) {
         // max of log-weights
@@ -154,8 +320,8 @@ void simulate(const Weights &w, MorpionGame::Sequence &l)
 		float smin =  1000000000.0f;
 
         for (unsigned int i = 0; i < simulation.Moves().length; i++) {
-            smax = max(smax,w[MorpionGame::goedel_number(simulation.Moves().mv[i])]);
-            smin = min(smin,w[MorpionGame::goedel_number(simulation.Moves().mv[i])]);
+            smax = max(smax,w[simulation.goedel_number(simulation.Moves().mv[i])]);
+            smin = min(smin,w[simulation.goedel_number(simulation.Moves().mv[i])]);
        	}
 
        	float s = (smax + smin) / 2.0f;
@@ -167,7 +333,7 @@ void simulate(const Weights &w, MorpionGame::Sequence &l)
         // sum of adjusted exp-weights
         float W = 0.0f;
         for (unsigned int i = 0; i < simulation.Moves().length; i++) {
-            W += exp(w[MorpionGame::goedel_number(simulation.Moves().mv[i])] - s);
+            W += exp(w[simulation.goedel_number(simulation.Moves().mv[i])] - s);
        	}
 
 	 	std::uniform_real_distribution<> dis(0.0, W);
@@ -178,7 +344,7 @@ void simulate(const Weights &w, MorpionGame::Sequence &l)
 		MorpionGame::Move chosen = simulation.Moves().mv[simulation.Moves().length-1]; // sometimes r would be greater than W!
 
         for (unsigned int i = 0; i < simulation.Moves().length; i++) {
-           	t += exp(w[MorpionGame::goedel_number(simulation.Moves().mv[i])] - s);
+           	t += exp(w[simulation.goedel_number(simulation.Moves().mv[i])] - s);
 			if (t >= r) {
 				chosen = simulation.Moves().mv[i]; break;
 			}
@@ -187,21 +353,130 @@ void simulate(const Weights &w, MorpionGame::Sequence &l)
 		l.mv[l.length++] = chosen;
 		simulation.MakeMove(chosen);
 	}
+}
+
+void CppNRPA::simulate_vectorized(const Weights &w, MorpionGame &simulation, MorpionGame::Sequence &l)
+{
+    alignas(32) float weights[MorpionGame::Sequence::bound];
+    alignas(32) float cumulative[MorpionGame::Sequence::bound];
+
+	l.init();
+
+	while(simulation.Moves().length > 0) {
+        const MorpionGame::Move *mv = simulation.Moves().mv;
+        const int n = simulation.Moves().length;
+
+        // gather log-weights of legal moves
+        for (int i = 0; i < n; i++) {
+            weights[i] = w[simulation.goedel_number(mv[i])];
+        }
+
+		float smax = -1000000000.0f;
+		float smin =  1000000000.0f;
+
+        for (int i = 0; i < n; i++) {
+            smax = max(smax, weights[i]);
+            smin = min(smin, weights[i]);
+        }
+
+       	float s = (smax + smin) / 2.0f;
+
+        if (smax - s > 10.0f) {
+            s = smax - 10.0f;
+        }
+
+        // adjusted exp-weights (all arguments are <= 10) and their prefix sums
+        for (int i = 0; i < n; i++) {
+            weights[i] = vectorizable_exp(weights[i] - s);
+        }
+
+        float W = 0.0f;
+        for (int i = 0; i < n; i++) {
+            W += weights[i];
+            cumulative[i] = W;
+        }
+
+        float r = unit(generator) * W;
+
+        // sometimes r would be greater than W!
+        int chosen = std::lower_bound(cumulative, cumulative + n, r) - cumulative;
+        if (chosen == n) {
+            chosen = n - 1;
+        }
+
+		l.mv[l.length++] = mv[chosen];
+		simulation.MakeMove(mv[chosen]);
+	}
+}
+
+/*
+ * Playout with cached exponentials: probabilities of legal moves are proportional
+ * to w.e, so a move costs a gather and a prefix sum.
+ */
+
+void CppNRPA::simulate_exp_cache(const Weights &w, MorpionGame &simulation, MorpionGame::Sequence &l)
+{
+    alignas(32) float weights[MorpionGame::Sequence::bound];
+    alignas(32) float cumulative[MorpionGame::Sequence::bound];
+
+	l.init();
+
+	while(simulation.Moves().length > 0) {
+        const MorpionGame::Move *mv = simulation.Moves().mv;
+        const int n = simulation.Moves().length;
+
+        for (int i = 0; i < n; i++) {
+            weights[i] = w.e[simulation.goedel_number(mv[i])];
+        }
+
+        float W = 0.0f;
+        for (int i = 0; i < n; i++) {
+            W += weights[i];
+            cumulative[i] = W;
+        }
+
+        if (W < 1e-30f) {
+            // All cached values underflowed; compute exponentials relative to the largest
+            // weight of a legal move instead
+            float smax = -1000000000.0f;
+            for (int i = 0; i < n; i++) {
+                smax = max(smax, w[simulation.goedel_number(mv[i])]);
+            }
+
+            W = 0.0f;
+            for (int i = 0; i < n; i++) {
+                W += vectorizable_exp(w[simulation.goedel_number(mv[i])] - smax);
+                cumulative[i] = W;
+            }
+        }
 
-	state -> moves += l.length;
-	state -> sequences++;
+        float r = unit(generator) * W;
+
+        // sometimes r would be greater than W!
+        int chosen = std::lower_bound(cumulative, cumulative + n, r) - cumulative;
+        if (chosen == n) {
+            chosen = n - 1;
+        }
+
+		l.mv[l.length++] = mv[chosen];
+		simulation.MakeMove(mv[chosen]);
+	}
 }
 
 /*
  * NRPA
  */
 
-void nrpa(int level, Weights &w, MorpionGame::Sequence &l)
+void CppNRPA::nrpa(int level, Weights &w, MorpionGame::Sequence &l)
 {
 	Weights wc(w);
 	MorpionGame::Sequence nl;
 
-	for (int i = 0; i < state->iterations; i++) {
+	for (int i = 0; i < iterations; i++) {
+		if (cancelled.load(std::memory_order_relaxed)) {
+			return;
+		}
+
 		nl.init();
 
 		if (level == 1) {
@@ -214,7 +489,7 @@ void nrpa(int level, Weights &w, MorpionGame::Sequence &l)
 			l = nl;
 		}
 
-    	wc.adapt(l);
+    	adapt(wc, l);
 	}
 }
 
@@ -222,10 +497,21 @@ void nrpa(int level, Weights &w, MorpionGame::Sequence &l)
  * NRPA experiment class.
  */
 
-CppNRPA::CppNRPA() { }
+CppNRPA::CppNRPA() : unit(0.0f, 1.0f),
+                     root(&MorpionGame::Root(MorpionGame::T5, MorpionGame::MAX_SIZE)),
+                     game(*root), state(nullptr), cancelled(false),
+                     iterations(0), kernel(DEFAULT_PLAYOUT_KERNEL), journal(false), moves(0),
+                     sequences(0), reset_bytes(0)
+{
+    game.EnableJournal();
+}
 
 CppNRPA::~CppNRPA() { }
 
+void CppNRPA::cancel() {
+    cancelled.store(true, std::memory_order_relaxed);
+}
+
 void CppNRPA::run(CppNRPAExperimentData &_state) {
     state = &_state;
 
@@ -236,8 +522,21 @@ void CppNRPA::run(CppNRPAExperimentData &_state) {
     state -> sequences = 0;
     state -> time_us = 0;
 
+    iterations = state -> iterations;
+    kernel = state -> kernel;
+    journal = state -> journal;
+    moves = 0;
+    sequences = 0;
+    reset_bytes = 0;
+
     generator.seed(state -> random_seed);
 
+    root = &MorpionGame::Root(state -> v, state -> board_size, state -> canonical);
+    if (game.variant != root -> variant || game.size != root -> size ||
+        game.canonical != root -> canonical) {
+        game = *root;
+    }
+
     std::chrono::steady_clock::time_point computation_begin;
     std::chrono::steady_clock::time_point computation_end;
 
@@ -245,14 +544,32 @@ void CppNRPA::run(CppNRPAExperimentData &_state) {
 
     MorpionGame::Sequence l;
 
-    for (int i = 0; i < state->batch_size; i++) {
+    // nrpa() adapts a copy of w, so w is shared by the whole batch
+    Weights w(state -> v, state -> board_size, state -> canonical, state -> weights);
+    if (kernel == EXP_CACHE_KERNEL) {
+        w.enable_exp_cache();
+    }
+
+    for (int i = 0; i < state->batch_size && !cancelled.load(std::memory_order_relaxed); i++) {
+        // Independent searches of a batch may have their own seeds
+        if (!state -> random_seeds.empty()) {
+            generator.seed(state -> random_seeds[i]);
+        }
+
         l.init();
-        Weights w(state -> weights);
 
-        if (state -> levels == 0) {
-            simulate(w, l);
-        } else {
-            nrpa(state -> levels, w, l);
+        try {
+            if (state -> levels == 0) {
+                simulate(w, l);
+            } else {
+                nrpa(state -> levels, w, l);
+            }
+        } catch (...) {
+            // Diverged weights (see Weights::adapt) end the run. The journaled position may
+            // be in the middle of an adaptation.
+            game = *root;
+            cancelled.store(false, std::memory_order_relaxed);
+            throw;
         }
 
         if (l.length > state -> best_sequence.size()) {
@@ -267,10 +584,80 @@ void CppNRPA::run(CppNRPAExperimentData &_state) {
 
     computation_end = std::chrono::steady_clock::now();
 
+    // A cancel stops this run only, or the next one if it came before the run started
+    state -> cancelled = cancelled.exchange(false, std::memory_order_relaxed);
+    state -> moves = moves;
+    state -> sequences = sequences;
+    state -> reset_bytes = reset_bytes;
     state->time_us = std::chrono::duration_cast<std::chrono::microseconds>(computation_end -
                       computation_begin).count();
 }
 
+/*
+ * Move generation benchmark.
+ */
+
+// Hashes positions through their public interface: legal moves and plain move numbers
+static void hash_moves(const MorpionGame &game, unsigned long long &checksum)
+{
+    for (unsigned int i = 0; i < game.Moves().length; i++) {
+        checksum = (checksum ^ game.Moves().mv[i].pythonize()) * 1099511628211ULL;
+    }
+    checksum = (checksum ^ game.Moves().length) * 1099511628211ULL;
+}
+
+void benchmark_moves(MoveBenchmarkData &data)
+{
+    const MorpionGame &root = MorpionGame::Root(data.v, data.board_size);
+
+    std::mt19937_64 generator(data.random_seed);
+    std::vector<MorpionGame::Sequence> games(data.games);
+    for (MorpionGame::Sequence &sequence: games) {
+        MorpionGame game(root);
+        sequence.init();
+        while (game.Moves().length > 0) {
+            MorpionGame::Move move = game.Moves().mv[generator() % game.Moves().length];
+            sequence.mv[sequence.length++] = move;
+            game.ReferenceMakeMove(move);
+        }
+    }
+
+    data.moves = 0;
+    data.checksum = 14695981039346656037ULL;
+    std::chrono::steady_clock::duration replay_time(0);
+
+    for (const MorpionGame::Sequence &sequence: games) {
+        MorpionGame game(root);
+
+        auto begin = std::chrono::steady_clock::now();
+        if (data.reference) {
+            for (unsigned int i = 0; i < sequence.length; i++) {
+                game.ReferenceMakeMove(sequence.mv[i]);
+            }
+        } else {
+            for (unsigned int i = 0; i < sequence.length; i++) {
+                game.MakeMove(sequence.mv[i]);
+            }
+        }
+        replay_time += std::chrono::steady_clock::now() - begin;
+        data.moves += sequence.length;
+
+        // Replay again to hash the positions after every move
+        MorpionGame check(root);
+        for (unsigned int i = 0; i < sequence.length; i++) {
+            if (data.reference) {
+                check.ReferenceMakeMove(sequence.mv[i]);
+            } else {
+                check.MakeMove(sequence.mv[i]);
+            }
+            hash_moves(check, data.checksum);
+        }
+        data.checksum = (data.checksum ^ game.Hash()) * 1099511628211ULL;
+    }
+
+    data.time_us = std::chrono::duration_cast<std::chrono::microseconds>(replay_time).count();
+}
+
 MorpionGame::Sequence cythonize(std::vector<int> seq)
 {
     MorpionGame::Sequence s;
@@ -1,51 +1,173 @@
 #ifndef CPPNRPA_H
 #define CPPNRPA_H
+
+#include <atomic>
+#include <random>
+#include <vector>
+
 class Weights
 {
 public:
 	float w[MorpionGame::max_goedel_number];
     float alpha = 1.0; // FIXME
 
+    /*
+     * Game of the weights, and whether they are indexed by canonical move numbers. Only
+     * the first length = goedel_count() weights of the board are used and copied.
+     */
+    MorpionGame::Variant variant = MorpionGame::T5;
+    int board_size = MorpionGame::MAX_SIZE;
+    bool canonical = false;
+    int length = MorpionGame::max_goedel_number;
+
+    /*
+     * Optional cache of exponentials: e[i] = exp(w[i] - shift), valid if exp_cache is set.
+     * adapt() updates the entries it changes and renormalizes (moves shift to the maximum
+     * weight) when an entry grows too large.
+     */
+    bool exp_cache = false;
+    float shift = 0.0f;
+    float e[MorpionGame::max_goedel_number];
+
 	Weights();
 	~Weights();
-    Weights(float _w[]);
+    Weights(MorpionGame::Variant variant, int board_size, bool canonical, const float _w[]);
 	Weights(const Weights& _w);
 	Weights& operator=(const Weights& _w);
 	float& operator[](int i);
 	const float& operator[](int i) const;
+    // Throws std::overflow_error, without changing the weights, if they diverged
     void adapt(const MorpionGame::Sequence &l);
+    void adapt(const MorpionGame::Sequence &l, MorpionGame &simulation);
+
+    // All-zero weights of a variant and board size
+    void reset(MorpionGame::Variant variant, int board_size, bool canonical);
+
+    void enable_exp_cache();
+    void renormalize();
+
+private:
+    void update_exp_cache(const std::vector<int> &touched);
 };
 
 MorpionGame::Sequence cythonize(std::vector<int> seq);
 
+/*
+ * Playout kernels. The reference kernel is the original implementation; the vectorized
+ * kernel computes each exponential once with a vectorizable exp and samples from
+ * a cumulative array; the exp cache kernel keeps exponentials of the weights in Weights
+ * (see Weights::enable_exp_cache), so playouts compute no exponentials at all.
+ * All kernels draw one random number per move.
+ */
+enum PlayoutKernel { REFERENCE_KERNEL = 0, VECTORIZED_KERNEL = 1, EXP_CACHE_KERNEL = 2 };
+
+#ifndef NRPA_PLAYOUT_KERNEL
+#define NRPA_PLAYOUT_KERNEL VECTORIZED_KERNEL
+#endif
+
+const int DEFAULT_PLAYOUT_KERNEL = NRPA_PLAYOUT_KERNEL;
+
 struct CppNRPAExperimentData {
     /*
      * Search parameters.
      */
     int batch_size;             // Batch size
     long long int random_seed;  // RNG seed
+    std::vector<long long int> random_seeds;    // Per search RNG seeds (optional, batch_size)
 	unsigned int levels;    	// number of levels
 	int iterations;			    // number of iterations at every level
 	float alpha;				// alpha value
 	MorpionGame::Variant v;		// 5T or 5D
-    float weights[MorpionGame::max_goedel_number];
+    int board_size;             // MorpionGame::MIN_SIZE to MorpionGame::MAX_SIZE
+    bool canonical;             // weights are indexed by canonical move numbers
+    int kernel;                 // PlayoutKernel
+    bool journal;               // reset positions with the undo journal instead of copying
+                                // (off by default: copies are as fast or faster)
+    float weights[MorpionGame::max_goedel_number];  // goedel_count() of the board are used
 
     /*
      * Search results.
      */
 	std::vector<int> best_sequence;
     std::vector<long long int> histogram;
+    bool cancelled;             // the search was cancelled and returned early
     long long int moves;
     long long int sequences;
+    long long int reset_bytes;  // bytes copied or journaled to reset positions
+    long long int time_us;
+};
+
+/*
+ * Move generation benchmark. Random games (uniformly random legal moves, generated with
+ * MorpionGame::ReferenceMakeMove from random_seed) are replayed from the root position with
+ * MakeMove, or with ReferenceMakeMove if reference is set. time_us is the time of the
+ * replays only, and checksum is a hash of the legal moves (in order) after every move and of
+ * the final positions, so both implementations must give the same checksum.
+ */
+struct MoveBenchmarkData {
+    long long int random_seed;
+    int games;
+    MorpionGame::Variant v;
+    int board_size;
+    bool reference;
+
+    long long int moves;
     long long int time_us;
+    unsigned long long int checksum;
 };
 
+void benchmark_moves(MoveBenchmarkData &data);
+
+/*
+ * NRPA search engine. Each instance owns its random generator, parameters and
+ * statistics counters, so independent instances can run concurrently on separate
+ * threads. A single instance is not re-entrant, but cancel() may be called from any
+ * thread: run() then returns after the current playout. A cancel before run() cancels the
+ * next run, so that cancelled jobs that have not started yet return at once. run() throws
+ * std::overflow_error if the weights diverge.
+ */
 class CppNRPA {
 public:
     CppNRPA();
     ~CppNRPA();
 
     void run(CppNRPAExperimentData &_state);
+    void cancel();
+
+private:
+    void simulate(const Weights &w, MorpionGame::Sequence &l);
+    void simulate(const Weights &w, MorpionGame &simulation, MorpionGame::Sequence &l);
+    void simulate_reference(const Weights &w, MorpionGame &simulation, MorpionGame::Sequence &l);
+    void simulate_vectorized(const Weights &w, MorpionGame &simulation, MorpionGame::Sequence &l);
+    void simulate_exp_cache(const Weights &w, MorpionGame &simulation, MorpionGame::Sequence &l);
+    void adapt(Weights &w, const MorpionGame::Sequence &l);
+    void nrpa(int level, Weights &w, MorpionGame::Sequence &l);
+
+    std::mt19937_64 generator;
+    std::uniform_real_distribution<float> unit;
+
+    // Root position of the search, and its copy with the undo journal enabled, reused by
+    // playouts and adaptations
+    const MorpionGame *root;
+    MorpionGame game;
+
+    CppNRPAExperimentData *state;
+
+    std::atomic<bool> cancelled;
+
+    /*
+     * Search parameters.
+     */
+    int iterations;
+    int kernel;
+    bool journal;
+
+    /*
+     * Statistics counters.
+     */
+    long long int moves;
+    long long int sequences;
+    long long int reset_bytes;
 };
 
 #endif /* CPPNRPA_H */
@@ -5,6 +5,7 @@ Experiment launcher.
 """
 
 import argparse
+import json
 import logging
 from termcolor import colored
 import tempfile
@@ -16,13 +17,50 @@ parser = argparse.ArgumentParser()
 
 parser.add_argument('--pro', dest='prometheus', action='store_true')
 parser.add_argument('--cores', type=int, default=5)
+parser.add_argument('--threads', dest='threads', action='store_true',
+                    help='local run in a single process with a thread pool of --cores workers')
 parser.set_defaults(prometheus=False)
+parser.set_defaults(threads=False)
 
 parser.add_argument('--seed', type=int, default=1)
 parser.add_argument('--iterations', type=int, default=100)
 parser.add_argument('--parallel_levels', type=int, default=2)
 parser.add_argument('--atomic_levels', type=int, default=2)
 parser.add_argument('--alpha', type=float, default=1.0)
+parser.add_argument('--variant', choices=['5t', '5d'], default='5t')
+parser.add_argument('--board_size', type=int, default=0,
+                    help='board width in dots, 20 to 40 (0 for 40 in 5T and 32 in 5D)')
+parser.add_argument('--canonical_moves', action='store_true',
+                    help='share policy weights between symmetric moves')
+parser.set_defaults(canonical_moves=False)
+parser.add_argument('--prefetch', type=int, default=1,
+                    help='number of jobs queued at each worker')
+parser.add_argument('--batch_size', type=int, default=1,
+                    help='number of independent atomic searches per job')
+parser.add_argument('--checkpoint_interval', type=int, default=600,
+                    help='seconds between checkpoints of the rollout tree (0 disables)')
+parser.add_argument('--speculation_threshold', type=float, default=1.0,
+                    help='do not compute rollouts whose policy changes with this probability '
+                         'while other jobs run')
+parser.add_argument('--adaptive_selector', action='store_true',
+                    help='estimate policy change probabilities from discarded rollouts')
+parser.set_defaults(adaptive_selector=False)
+parser.add_argument('--policy_chains', action='store_true',
+                    help='send policies to MPI workers as chains of adapt sequences')
+parser.set_defaults(policy_chains=False)
+parser.add_argument('--sub_servers', type=int, default=0,
+                    help='MPI ranks that compute subtrees of --sub_parallel_levels on their own '
+                         'groups of workers (0 for a single server)')
+parser.add_argument('--sub_parallel_levels', type=int, default=1)
+parser.add_argument('--timeline', default='timeline.jsonl',
+                    help='file with spans of the server loop (see timeline.py), empty to disable')
+parser.add_argument('--profile', dest='profile', action='store_true',
+                    help='run the server loop under cProfile')
+parser.set_defaults(profile=False)
+parser.add_argument('--local_reports', dest='local_reports', action='store_true',
+                    help='run without Neptune: parameters in params.json, reports in files of '
+                         'the experiment directory')
+parser.set_defaults(local_reports=False)
 
 args = parser.parse_args()
 
@@ -34,6 +72,7 @@ def print_param(param, value):
 print(colored('Parallel NRPA Experiment Launcher', 'yellow', attrs=['bold']))
 print('')
 print_param('Environment', 'prometheus' if args.prometheus else 'local')
+print_param('Workers', 'threads' if args.threads else 'MPI')
 
 print_param('Cores', args.cores)
 
@@ -55,11 +94,47 @@ print_param('Iterations', args.iterations)
 print_param('Parallel levels', args.parallel_levels)
 print_param('Atomic levels', args.atomic_levels)
 print_param('Alpha', args.alpha)
+print_param('Game', '{0} on {1} board'.format(args.variant.upper(), args.board_size
+                                               if args.board_size > 0 else 'default'))
+print_param('Weights', 'canonical moves' if args.canonical_moves else 'all moves')
+print_param('Prefetch', args.prefetch)
+print_param('Batch size', args.batch_size)
+print_param('Checkpoints', '{0} s'.format(args.checkpoint_interval)
+            if args.checkpoint_interval > 0 else 'off')
+print_param('Speculation', '{0} ({1})'.format(args.speculation_threshold,
+                                              'adaptive' if args.adaptive_selector else 'static'))
+print_param('Policies', 'adapt chains' if args.policy_chains else 'sparse weights')
+print_param('Sub-servers', '{0} ({1} levels)'.format(args.sub_servers, args.sub_parallel_levels)
+            if args.sub_servers > 0 else 'none')
+print_param('Timeline', args.timeline if args.timeline else 'off')
+print_param('Profile', args.profile)
+print_param('Reports', 'local' if args.local_reports else 'neptune')
 print('')
 
 saved_dir = os.getcwd()
+profile = ', --profile' if args.profile else ''
 os.chdir(experiment_dir)
 
+if args.local_reports:
+    params = {'parallel_levels': args.parallel_levels,
+              'atomic_levels': args.atomic_levels,
+              'iterations': args.iterations,
+              'alpha': args.alpha,
+              'variant': args.variant,
+              'board_size': args.board_size,
+              'canonical_moves': args.canonical_moves,
+              'seed': args.seed,
+              'prefetch': args.prefetch,
+              'batch_size': args.batch_size,
+              'checkpoint_interval': args.checkpoint_interval,
+              'speculation_threshold': args.speculation_threshold,
+              'adaptive_selector': args.adaptive_selector,
+              'policy_chains': args.policy_chains,
+              'sub_parallel_levels': args.sub_parallel_levels,
+              'timeline': args.timeline}
+    json.dump(params, open('params.json', 'wt'), indent=2)
+    local_options = ' --params params.json' + (' --profile' if args.profile else '')
+
 if args.prometheus:
     slurm = """\
 #!/bin/env bash
@@ -88,8 +163,11 @@ module load plgrid/libs/python-numpy/1.14.2-python-3.6
 
 # cp token ~/.neptune/tokens/
 
-neptune run --config experiment.yaml
-    """.format(nodes, time, memory)
+{3}
+    """.format(nodes, time, memory,
+               'srun --mpi=pmi2 -n {0} {1}/parallel_nrpa.py --sub_servers {2}{3}'.format(
+                   args.cores, saved_dir, args.sub_servers, local_options)
+               if args.local_reports else 'neptune run --config experiment.yaml')
     print(slurm, file=open('experiment.slurm', 'wt'))
 
     yaml = """\
@@ -105,18 +183,38 @@ parameters:
   iterations: {3}
   alpha: {4}
   seed: {5}
-
-command: [ srun, --mpi=pmi2, -n, *cores, {6}/parallel_nrpa.py ]
+  prefetch: {7}
+  batch_size: {8}
+  checkpoint_interval: {9}
+  speculation_threshold: {10}
+  adaptive_selector: {11}
+  sub_parallel_levels: {12}
+  timeline: "{14}"
+  policy_chains: {16}
+  variant: "{17}"
+  board_size: {18}
+  canonical_moves: {19}
+
+command: [ srun, --mpi=pmi2, -n, *cores, {6}/parallel_nrpa.py, --sub_servers, "{13}"{15} ]
 
 exclude: [ '*' ]
     """.format(args.cores, args.parallel_levels, args.atomic_levels, args.iterations, args.alpha,
-                   args.seed, saved_dir)
+                   args.seed, saved_dir, args.prefetch, args.batch_size, args.checkpoint_interval,
+                   args.speculation_threshold, args.adaptive_selector, args.sub_parallel_levels,
+                   args.sub_servers, args.timeline, profile, args.policy_chains, args.variant,
+                   args.board_size, args.canonical_moves)
     print(yaml, file=open('experiment.yaml', 'wt'))
 
     os.system('sbatch experiment.slurm')
 
     print(colored('Scheduled {0}/experiment.slurm for execution.'.format(experiment_dir), attrs=['bold']))
 else:
+    if args.threads:
+        command = '[ {0}/parallel_nrpa.py, --threads, *cores{1} ]'.format(saved_dir, profile)
+    else:
+        command = '[ mpirun, -n, *cores, {0}/parallel_nrpa.py, --sub_servers, "{1}"{2} ]'.format(
+            saved_dir, args.sub_servers, profile)
+
     yaml = """\
 project: nn-nrpa
 name: Parallel NRPA
@@ -130,14 +228,36 @@ parameters:
   iterations: {3}
   alpha: {4}
   seed: {5}
+  prefetch: {7}
+  batch_size: {8}
+  checkpoint_interval: {9}
+  speculation_threshold: {10}
+  adaptive_selector: {11}
+  sub_parallel_levels: {12}
+  timeline: "{13}"
+  policy_chains: {14}
+  variant: "{15}"
+  board_size: {16}
+  canonical_moves: {17}
   
-command: [ mpirun, -n, *cores, {6}/parallel_nrpa.py ]
+command: {6}
 
 exclude: [ '*' ]
     """.format(args.cores, args.parallel_levels, args.atomic_levels, args.iterations, args.alpha,
-               args.seed, saved_dir)
+               args.seed, command, args.prefetch, args.batch_size, args.checkpoint_interval,
+               args.speculation_threshold, args.adaptive_selector, args.sub_parallel_levels,
+               args.timeline, args.policy_chains, args.variant, args.board_size,
+               args.canonical_moves)
 
     print(yaml, file=open('experiment.yaml', 'wt'))
 
-    os.system('neptune run --config experiment.yaml'.format(experiment_dir))
+    if args.local_reports:
+        if args.threads:
+            os.system('{0}/parallel_nrpa.py --threads {1}{2}'.format(saved_dir, args.cores,
+                                                                     local_options))
+        else:
+            os.system('mpirun -n {0} {1}/parallel_nrpa.py --sub_servers {2}{3}'.format(
+                args.cores, saved_dir, args.sub_servers, local_options))
+    else:
+        os.system('neptune run --config experiment.yaml'.format(experiment_dir))
 os.chdir(saved_dir)
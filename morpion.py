@@ -303,6 +303,14 @@ class Game:
 
         self.reset()
 
+    @classmethod
+    def on_board(cls, variant='5t', size=40):
+        """A game on the size x size board of the C++ engine (MorpionGame), which numbers
+        moves the same way."""
+        west = (size - 3) // 2 - 3
+        east = size - 10 - west
+        return cls(variant, cls.BBox(west, east, east, west))
+
     def __repr__(self):
         """ASCII Art rendering of the final position."""
 
@@ -373,7 +381,7 @@ class Game:
         with open(filename, 'w') as psol_file:
             psol_file.write(str(self.dot_from_pos(self.reference)) + '\n')
 
-            replay = Game(reference=self.reference)
+            replay = Game(self.variant, self.board_size, reference=self.reference)
 
             direction_symbols = ['-', '\\', '|', '/']
             for move in self.history:
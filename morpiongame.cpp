@@ -1,16 +1,26 @@
+#include <algorithm>
 #include <vector>
 #include <string>
 #include <iostream>
+#include <memory>
+#include <mutex>
 #include <string.h>
 
 #include "morpiongame.h"
 
 using namespace std;
 
-const int MorpionGame::dir[MorpionGame::DIRS] = {1, SIZE + 1, SIZE, SIZE - 1};
-
-MorpionGame::MorpionGame()
+MorpionGame::MorpionGame(Variant variant, int size, bool canonical)
+    : variant(variant), size(size), area(size * size), canonical(canonical),
+      move_numbers(nullptr), move_count(DIRS * size * size)
 {
+    dir[0] = 1;
+    dir[1] = size + 1;
+    dir[2] = size;
+    dir[3] = size - 1;
+
+    neighbourhood = Neighbours(variant, size);
+
     memset(has_dot, 0, sizeof(has_dot));
     memset(dots_count, 0, sizeof(dots_count));
     memset(move_index, 0, sizeof(move_index));
@@ -19,8 +29,8 @@ MorpionGame::MorpionGame()
     };
     static const int ARMLEN = LINE - 2;
     Position p =
-        PositionOfCoords((SIZE - 3 * ARMLEN) / 2,
-                         (SIZE - ARMLEN) / 2);
+        PositionOfCoords((size - 3 * ARMLEN) / 2,
+                         (size - ARMLEN) / 2);
     for (int i = 0; i < 12; i++)
     {
         int d = ShiftFromDir(cross[i]);
@@ -30,30 +40,263 @@ MorpionGame::MorpionGame()
             PutDot(p, 1);
         }
     }
+
+    clipEdges();
+
+    if (canonical)
+    {
+        move_numbers = CanonicalNumbers(size, move_count);
+    }
+}
+
+const MorpionGame& MorpionGame::Root(Variant variant, int size, bool canonical)
+{
+    static std::mutex mutex;
+    static std::unique_ptr<MorpionGame> roots[2][MAX_SIZE + 1][2];
+
+    std::lock_guard<std::mutex> lock(mutex);
+    std::unique_ptr<MorpionGame> &root = roots[variant][size][canonical];
+    if (!root)
+    {
+        root.reset(new MorpionGame(variant, size, canonical));
+    }
+    return *root;
+}
+
+const MorpionGame::Neighbourhood *MorpionGame::Neighbours(Variant variant, int size)
+{
+    static std::mutex mutex;
+    static std::unique_ptr<Neighbourhood> tables[2][MAX_SIZE + 1];
+
+    std::lock_guard<std::mutex> lock(mutex);
+    std::unique_ptr<Neighbourhood> &table = tables[variant][size];
+    if (!table)
+    {
+        const int offsets[DIRS] = {1, size + 1, size, size - 1};
+        table.reset(new Neighbourhood);
+        for (Direction d = 0; d < DIRS; d++)
+        {
+            for (int i = 0; i < LINE; i++)
+            {
+                table->dot[d * LINE + i] = SlotOf(-offsets[d] * i, d);
+                table->line[d][i] = offsets[d] * i;
+            }
+        }
+        table->blocked_count = 2 * (LINE - 2 + variant) + 1;
+        for (Direction d = 0; d < DIRS; d++)
+        {
+            for (int i = 0; i < table->blocked_count; i++)
+            {
+                table->blocked[d][i] = SlotOf(offsets[d] * (i - (LINE - 2 + variant)), 0);
+            }
+        }
+    }
+    return table.get();
+}
+
+// Coordinate steps of directions e, se, s, sw
+static const int dx[4] = {1, 1, 0, -1};
+static const int dy[4] = {0, 1, 1, 1};
+
+// Whether all dots of the line are at least EDGE dots from the edges of the board
+bool MorpionGame::LineOnBoard(Position p, Direction d) const
+{
+    int x, y;
+    CoordsOfPosition(p, x, y);
+    int ex = x + dx[d] * (LINE - 1);
+    int ey = y + dy[d] * (LINE - 1);
+    return std::min(x, ex) >= EDGE && std::max(x, ex) < size - EDGE &&
+           y >= EDGE && ey < size - EDGE;
+}
+
+void MorpionGame::clipEdges()
+{
+    for (Position p = 0; p < area; p++)
+    {
+        for (Direction d = 0; d < DIRS; d++)
+        {
+            if (!LineOnBoard(p, d))
+            {
+                IncDotCount(p, d, LINE);
+            }
+        }
+    }
+}
+
+/*
+ * Canonical move numbers (see goedel_number), computed once per board size. Moves are
+ * joined with their images under the 8 symmetries of the cross, in coordinates relative
+ * to its centre (doubled, so that they are integers), and the classes are numbered in
+ * order of their first move. Moves that are never legal on the board get number 0, but
+ * they are never looked up.
+ */
+const int *MorpionGame::CanonicalNumbers(int size, int &count)
+{
+    static std::mutex mutex;
+    static std::unique_ptr<std::vector<int>> tables[MAX_SIZE + 1];
+    static int counts[MAX_SIZE + 1];
+
+    std::lock_guard<std::mutex> lock(mutex);
+    if (tables[size])
+    {
+        count = counts[size];
+        return tables[size]->data();
+    }
+
+    MorpionGame board(T5, size);
+    int rx, ry;
+    board.CoordsOfPosition(board.ReferencePoint(), rx, ry);
+    const int cx = 2 * rx + 3, cy = 2 * ry + 3;
+
+    // Union-find of plain move numbers
+    std::vector<int> parent(DIRS * board.area);
+    for (size_t g = 0; g < parent.size(); g++)
+    {
+        parent[g] = g;
+    }
+    auto find = [&parent](int g) {
+        while (parent[g] != g)
+        {
+            g = parent[g] = parent[parent[g]];
+        }
+        return g;
+    };
+
+    for (Position p = 0; p < board.area; p++)
+    {
+        for (Direction d = 0; d < DIRS; d++)
+        {
+            if (!board.LineOnBoard(p, d))
+            {
+                continue;
+            }
+
+            // Doubled coordinates of the ends of the line
+            int x, y;
+            board.CoordsOfPosition(p, x, y);
+            int ax = 2 * x - cx, ay = 2 * y - cy;
+            int bx = ax + 2 * dx[d] * (LINE - 1), by = ay + 2 * dy[d] * (LINE - 1);
+
+            for (int t = 1; t < 8; t++)
+            {
+                // Reflections in the axes (bits 0 and 1) and in the diagonal (bit 2)
+                int tax = (t & 1) ? -ax : ax, tay = (t & 2) ? -ay : ay;
+                int tbx = (t & 1) ? -bx : bx, tby = (t & 2) ? -by : by;
+                if (t & 4)
+                {
+                    std::swap(tax, tay);
+                    std::swap(tbx, tby);
+                }
+
+                // The image starts at the end from which it runs in one of the directions
+                int sx = (tbx - tax) / (2 * (LINE - 1)), sy = (tby - tay) / (2 * (LINE - 1));
+                if (sy < 0 || (sy == 0 && sx < 0))
+                {
+                    std::swap(tax, tbx);
+                    std::swap(tay, tby);
+                    sx = -sx;
+                    sy = -sy;
+                }
+                Direction td = 0;
+                while (dx[td] != sx || dy[td] != sy)
+                {
+                    td++;
+                }
+
+                int tx = (tax + cx) / 2, ty = (tay + cy) / 2;
+                if (tx < 0 || tx >= size || ty < 0 || ty >= size)
+                {
+                    continue;
+                }
+                Position tp = board.PositionOfCoords(tx, ty);
+                if (board.LineOnBoard(tp, td))
+                {
+                    parent[find(td * board.area + tp)] = find(d * board.area + p);
+                }
+            }
+        }
+    }
+
+    std::vector<int> *numbers = new std::vector<int>(DIRS * board.area, 0);
+    std::vector<int> first(DIRS * board.area, -1);
+    count = 0;
+    for (Direction d = 0; d < DIRS; d++)
+    {
+        for (Position p = 0; p < board.area; p++)
+        {
+            if (board.LineOnBoard(p, d))
+            {
+                int g = d * board.area + p;
+                int r = find(g);
+                if (first[r] < 0)
+                {
+                    first[r] = count++;
+                }
+                (*numbers)[g] = first[r];
+            }
+        }
+    }
+
+    tables[size].reset(numbers);
+    counts[size] = count;
+    return numbers->data();
 }
 
-void MorpionGame::IncDotCount(Position pos, Direction d, int count)
+inline void MorpionGame::RemoveMove(Slot slot)
 {
-    if (CanMove(pos, d))
+    int idx = move_index[slot];
+    Move& back = legal_moves.mv[legal_moves.length-1];
+    move_index[SlotOf(back.pos, back.dir)] = idx;
+    legal_moves.mv[idx] = back;
+    legal_moves.length--;
+}
+
+inline void MorpionGame::AddMove(Slot slot)
+{
+    move_index[slot] = legal_moves.length;
+    legal_moves.mv[legal_moves.length].dir = slot % DIRS;
+    legal_moves.mv[legal_moves.length++].pos = slot / DIRS;
+}
+
+void MorpionGame::IncDotCount(Slot slot, int count)
+{
+    if (CanMove(slot))
     {
-        int idx = move_index[pos][d];
-        Move& back = legal_moves.mv[legal_moves.length-1];
-        move_index[back.pos][back.dir] = idx;
-        legal_moves.mv[idx] = back;
-        legal_moves.length--;
+        RemoveMove(slot);
     }
-    dots_count[pos][d] += count;
-    if (CanMove(pos, d))
+    dots_count[slot] += count;
+    if (CanMove(slot))
     {
-        move_index[pos][d] = legal_moves.length;
-		legal_moves.mv[legal_moves.length].dir = d;
-        legal_moves.mv[legal_moves.length++].pos = pos;
+        AddMove(slot);
     }
 }
 
 void MorpionGame::PutDot(Position pos, int count)
 {
-    has_dot[pos] = count > 0;
+    SetDot(pos, count > 0);
+    const Slot origin = SlotOf(pos, 0);
+    const Slot *dot = neighbourhood->dot;
+    for (int i = 0; i < DIRS * LINE; i++)
+    {
+        // IncDotCount: a move is removed when it reaches LINE dots, added at LINE - 1
+        const Slot slot = origin + dot[i];
+        const int before = dots_count[slot];
+        const int after = before + count;
+        dots_count[slot] = after;
+        if (before == LINE - 1)
+        {
+            RemoveMove(slot);
+        }
+        else if (after == LINE - 1)
+        {
+            AddMove(slot);
+        }
+    }
+}
+
+void MorpionGame::ReferencePutDot(Position pos, int count)
+{
+    SetDot(pos, count > 0);
     for (Direction d = 0; d < DIRS; d++)
     {
         Position p = pos;
@@ -68,19 +311,118 @@ void MorpionGame::PutDot(Position pos, int count)
 void MorpionGame::MakeMove(Move move)
 {
     /* Block moves overlaping with segments added by the move */
+    const Slot origin = SlotOf(move.pos, move.dir);
+    const Slot *blocked = neighbourhood->blocked[move.dir];
+    for (int i = 0; i < neighbourhood->blocked_count; i++)
+    {
+        // IncDotCount by LINE: blocked moves cannot become legal
+        const Slot slot = origin + blocked[i];
+        if (CanMove(slot))
+        {
+            RemoveMove(slot);
+        }
+        dots_count[slot] += LINE;
+    }
+    /* Find dot and put it */
+    const Position *line = neighbourhood->line[move.dir];
+    for (int i = 0; i < LINE; i++)
+    {
+        Position p = move.pos + line[i];
+        if (!HasDot(p))
+        {
+            if (journaling)
+            {
+                UndoRecord record;
+                record.move = move;
+                record.dot = p;
+                journal.push_back(record);
+            }
+            PutDot(p, 1); break;
+        }
+    }
+}
+
+void MorpionGame::ReferenceMakeMove(Move move)
+{
     for (int i = -(LINE - 2 + variant); i <= LINE - 2 + variant; i++)
         IncDotCount(move.pos + dir[move.dir] * i, move.dir, LINE);
-    /* Find dot and put it */
     for (int i = 0; i < LINE; i++)
     {
         Position p = move.pos + dir[move.dir] * i;
-        if (!has_dot[p])
+        if (!HasDot(p))
         {
-            PutDot(p, 1); break;
+            if (journaling)
+            {
+                UndoRecord record;
+                record.move = move;
+                record.dot = p;
+                journal.push_back(record);
+            }
+            ReferencePutDot(p, 1); break;
         }
     }
 }
 
+unsigned long long MorpionGame::Hash() const
+{
+    unsigned long long hash = 14695981039346656037ULL;
+    auto add = [&hash](const void *data, size_t bytes) {
+        for (size_t i = 0; i < bytes; i++)
+        {
+            hash = (hash ^ static_cast<const unsigned char *>(data)[i]) * 1099511628211ULL;
+        }
+    };
+
+    add(has_dot, DotWords() * sizeof(has_dot[0]));
+    add(dots_count, DIRS * area * sizeof(dots_count[0]));
+    add(&legal_moves.length, sizeof(legal_moves.length));
+    add(legal_moves.mv, legal_moves.length * sizeof(Move));
+    return hash;
+}
+
+size_t MorpionGame::Rollback(const MorpionGame &origin)
+{
+    size_t count = 0;
+
+    /* Dot counts changed by MakeMove and PutDot */
+    for (const UndoRecord &record : journal)
+    {
+        const Move &move = record.move;
+        const Slot move_slot = SlotOf(move.pos, move.dir);
+        for (int i = 0; i < neighbourhood->blocked_count; i++)
+        {
+            Slot slot = move_slot + neighbourhood->blocked[move.dir][i];
+            dots_count[slot] = origin.dots_count[slot];
+        }
+        count += neighbourhood->blocked_count;
+
+        SetDot(record.dot, origin.HasDot(record.dot));
+        const Slot dot_slot = SlotOf(record.dot, 0);
+        for (int i = 0; i < DIRS * LINE; i++)
+        {
+            Slot slot = dot_slot + neighbourhood->dot[i];
+            dots_count[slot] = origin.dots_count[slot];
+        }
+        count += DIRS * LINE;
+    }
+
+    size_t bytes = count * sizeof(dots_count[0]) + journal.size() * sizeof(has_dot[0]);
+
+    /* Legal moves. move_index is only used for legal moves, so only their entries matter */
+    legal_moves.length = origin.legal_moves.length;
+    for (unsigned int i = 0; i < legal_moves.length; i++)
+    {
+        const Move &move = origin.legal_moves.mv[i];
+        legal_moves.mv[i] = move;
+        move_index[SlotOf(move.pos, move.dir)] = i;
+    }
+    bytes += legal_moves.length * (sizeof(Move) + sizeof(move_index[0]));
+
+    journal.clear();
+
+    return bytes;
+}
+
 MorpionGame::Position MorpionGame::ReferencePoint() const
 //     XXXX
 //     X  X
@@ -96,7 +438,7 @@ MorpionGame::Position MorpionGame::ReferencePoint() const
 //     R - reference point
 {
     const int ARMLEN = LINE - 2;
-    const int MIDDLE = (SIZE - ARMLEN) / 2;
+    const int MIDDLE = (size - ARMLEN) / 2;
     return PositionOfCoords(MIDDLE, MIDDLE);
 }
 
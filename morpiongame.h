@@ -10,14 +10,29 @@ class MorpionGame
 public:
 	enum Variant { T5 = 0, D5 = 1 };
 
-	int variant = T5;
+	/*
+	 * Board geometry. Boards are size x size dots, for sizes between MIN_SIZE and
+	 * MAX_SIZE, with the cross in the middle. State arrays are allocated for MAX_SIZE, but
+	 * only the first size * size positions are used (and copied).
+	 */
+	static const int MIN_SIZE = 20;
+	static const int MAX_SIZE = 40;
+
+	// Board size per variant when none is given: a 5D game stays much closer to the cross
+	static int DefaultSize(Variant variant)
+	{
+		return variant == D5 ? 32 : MAX_SIZE;
+	}
 
-    static const int SIZE = 40;
+	int variant;
+	int size;
+	int area;   // size * size
+	bool canonical;     // canonical move numbers (see goedel_number)
 
 	// Invalidate moves that are outside of the octagonal board
 	void clipBoard(int o[8])
 	{
-		for (Position p = 0; p < ARRAY_SIZE; p++) {
+		for (Position p = 0; p < area; p++) {
 			for (Direction d = 0; d < DIRS; d++) {
 				if (!LineInsideBoard(p,d,o)) {
 					IncDotCount(p,d,LINE);
@@ -62,9 +77,9 @@ public:
     };
 
 	class Sequence {
+	public:
 		static const int bound = 200;   // Warning: this number is hardcoded in nrpa.pyx
 
-	public:
 		unsigned int length;
 		Move mv[bound];
 
@@ -86,19 +101,80 @@ public:
 		}
 	};
 
-    MorpionGame();
+    MorpionGame(Variant variant = T5, int size = MAX_SIZE, bool canonical = false);
 	const Sequence& Moves() const;
     void MakeMove(Move move);
 
+	/*
+	 * MakeMove of the original implementation, which computes the positions of the moves
+	 * it updates. It updates the same moves in the same order as MakeMove, so positions and
+	 * their legal moves are identical (see benchmark_moves in cppnrpa.h).
+	 */
+	void ReferenceMakeMove(Move move);
+
+	/*
+	 * Root position of a variant on a board, constructed once and shared by all threads.
+	 * Positions are copied from it, which is much faster than constructing them.
+	 */
+	static const MorpionGame& Root(Variant variant, int size, bool canonical = false);
+
 	MorpionGame(const MorpionGame& g)
+	{
+		*this = g;
+	}
+
+	// Copies the position and its geometry; the journal is cleared, but stays enabled.
+	MorpionGame& operator=(const MorpionGame& g)
 	{
 		variant = g.variant;
-		memcpy(has_dot, g.has_dot, sizeof(has_dot));
-		memcpy(dots_count, g.dots_count, sizeof(dots_count));
-		memcpy(move_index, g.move_index, sizeof(move_index));
+		size = g.size;
+		area = g.area;
+		canonical = g.canonical;
+		move_numbers = g.move_numbers;
+		move_count = g.move_count;
+		memcpy(dir, g.dir, sizeof(dir));
+		neighbourhood = g.neighbourhood;
+		memcpy(has_dot, g.has_dot, DotWords() * sizeof(has_dot[0]));
+		memcpy(dots_count, g.dots_count, DIRS * area * sizeof(dots_count[0]));
+		memcpy(move_index, g.move_index, DIRS * area * sizeof(move_index[0]));
 		legal_moves = g.legal_moves;
+		journal.clear();
+		return *this;
+	}
+
+	// FNV-1a hash of the position: dots, dot counts and legal moves in order
+	unsigned long long Hash() const;
+
+	// Number of bytes copied by the copy constructor
+	size_t StateBytes() const
+	{
+		return DotWords() * sizeof(has_dot[0]) + DIRS * area * sizeof(dots_count[0]) +
+		       DIRS * area * sizeof(move_index[0]) + sizeof(legal_moves.length) +
+		       legal_moves.length * sizeof(Move);
+	}
+
+	/*
+	 * Undo journal. When enabled, MakeMove records the moves played, and Rollback(origin)
+	 * restores the position to origin (the position the journal was enabled in, including
+	 * the order of legal moves) by copying back only the entries changed by these moves,
+	 * in time proportional to the number of moves. This is much cheaper than copying the
+	 * whole position.
+	 */
+	void EnableJournal()
+	{
+		journaling = true;
+		journal.clear();
+		journal.reserve(Sequence::bound);
+	}
+
+	bool Journaling() const
+	{
+		return journaling;
 	}
 
+	// Returns the number of bytes copied from origin.
+	size_t Rollback(const MorpionGame &origin);
+
 protected:
     /*  o-
      * /|\ */
@@ -106,22 +182,110 @@ protected:
     enum { RIGHT = 0, DOWN = 2, LEFT = 4, UP = 6 };
     
     static const int DIRS = 4;
-    static const int ARRAY_SIZE = SIZE * SIZE;
+    static const int ARRAY_SIZE = MAX_SIZE * MAX_SIZE;
     static const int LINE = 5; // in number of dots
-    static const int dir[DIRS];
 
-    bool has_dot[ARRAY_SIZE];
-    int dots_count[ARRAY_SIZE][DIRS];
-    int move_index[ARRAY_SIZE][DIRS];
+    // Position offsets of directions: e, se, s, sw
+    int dir[DIRS];
+
+    /*
+     * Moves whose lines have dots closer than EDGE to the edge of the board are blocked, so
+     * that MakeMove and PutDot never reach outside of the board.
+     */
+    static const int EDGE = LINE - 1;
+
+    /*
+     * Compact state, so that the hot state fits in L1/L2 and copies are cheap:
+     * - has_dot is a bitset,
+     * - dots_count is at most LINE - 1 dots plus LINE per blocking (by at most a few
+     *   overlapping moves and clipping), well below 256,
+     * - move_index is an index to legal_moves, below Sequence::bound.
+     * dots_count and move_index are indexed by the slots of moves.
+     */
+    typedef unsigned long long DotWord;
+    static const int DOT_WORD_BITS = 8 * sizeof(DotWord);
+
+    typedef int Slot;
+
+    static Slot SlotOf(Position pos, Direction d)
+    {
+        return pos * DIRS + d;
+    }
+
+    DotWord has_dot[(ARRAY_SIZE + DOT_WORD_BITS - 1) / DOT_WORD_BITS];
+    int DotWords() const { return (area + DOT_WORD_BITS - 1) / DOT_WORD_BITS; }
+    unsigned char dots_count[ARRAY_SIZE * DIRS];
+    unsigned short move_index[ARRAY_SIZE * DIRS];
     Sequence legal_moves;
+
+    /*
+     * Slots of the moves updated by PutDot and MakeMove, in the order they update them,
+     * relative to the slot of the dot in direction 0 or to the slot of the move. The edge
+     * guard (clipEdges) keeps the moves of a dot or a legal move on the board, so the
+     * offsets do not depend on the position, and PutDot and MakeMove walk these tables with
+     * no position arithmetic. The tables are built once per variant and board size and
+     * shared by all positions, so copies of positions copy only a pointer to them.
+     */
+    struct Neighbourhood
+    {
+        Slot dot[DIRS * LINE];              // moves through a dot
+        Slot blocked[DIRS][2 * LINE - 1];   // moves overlapping a move, by its direction
+        int blocked_count;                  // 2 * (LINE - 2 + variant) + 1
+        Position line[DIRS][LINE];          // dots of a move, by its direction
+    };
+
+    const Neighbourhood *neighbourhood;
+
+    static const Neighbourhood *Neighbours(Variant variant, int size);
+
+    bool HasDot(Position pos) const
+    {
+        return (has_dot[pos / DOT_WORD_BITS] >> (pos % DOT_WORD_BITS)) & 1;
+    }
+
+    void SetDot(Position pos, bool dot)
+    {
+        DotWord bit = DotWord(1) << (pos % DOT_WORD_BITS);
+        has_dot[pos / DOT_WORD_BITS] = dot ? has_dot[pos / DOT_WORD_BITS] | bit
+                                           : has_dot[pos / DOT_WORD_BITS] & ~bit;
+    }
+
+    struct UndoRecord
+    {
+        Move move;
+        Position dot;           // position of the dot added by the move
+    };
+
+    bool journaling = false;
+    std::vector<UndoRecord> journal;
     
+    bool CanMove(Slot slot) const
+    {
+        return dots_count[slot] == LINE - 1;
+    }
+
     bool CanMove(Position pos, Direction d) const
     {
-        return dots_count[pos][d] == LINE - 1;
+        return CanMove(SlotOf(pos, d));
     }
 
-    void IncDotCount(Position pos, Direction d, int count);
+    void IncDotCount(Slot slot, int count);
+    void RemoveMove(Slot slot);
+    void AddMove(Slot slot);
+    void IncDotCount(Position pos, Direction d, int count)
+    {
+        IncDotCount(SlotOf(pos, d), count);
+    }
     void PutDot(Position pos, int count);
+    void ReferencePutDot(Position pos, int count);
+    bool LineOnBoard(Position p, Direction d) const;
+    void clipEdges();
+
+    // Canonical numbers of moves by their plain numbers, or nullptr, and their count
+    const int *move_numbers;
+    int move_count;
+
+    static const int *CanonicalNumbers(int size, int &count);
 
     int ShiftFromDir(int d) { return d < DIRS ? dir[d] : -dir[d - DIRS]; }
 
@@ -160,7 +324,7 @@ protected:
 	bool LineInsideBoard(Position p, Direction d, int o[8])
 	{
 		for (int i = 0; i < LINE; i++) {
-			if (!has_dot[p + dir[d] * i] && !InsideBoard(p + dir[d] * i,o)) return false;
+			if (!HasDot(p + dir[d] * i) && !InsideBoard(p + dir[d] * i,o)) return false;
 		}
 		return true;
 	}
@@ -171,19 +335,31 @@ public:
 		return Move(-m.pos + 2 * ReferencePoint() + PositionOfCoords(3,3) - 4 * dir[m.dir], m.dir);
 	}
 
+    /*
+     * Moves of a board are numbered below goedel_count(), at most max_goedel_number.
+     * Plain numbers are m.dir * area + m.pos. Canonical numbers are shared by moves that
+     * are images of each other under the symmetries of the cross (its rotations and
+     * reflections), and only moves that can be legal on the board are numbered, so weights
+     * indexed by canonical numbers are about 15 times smaller and learn each move together
+     * with its images.
+     */
     static const int max_goedel_number = DIRS * ARRAY_SIZE;
-    static inline int goedel_number(const Move &m)
+    inline int goedel_number(const Move &m) const
+    {
+        return move_numbers ? move_numbers[m.dir * area + m.pos] : m.dir * area + m.pos;
+    }
+    inline int goedel_count() const
     {
-        return m.dir * ARRAY_SIZE + m.pos;
+        return move_count;
     }
 
 	void print(int o[8])
 	{
-		for (int y = 0; y < SIZE; y++) {
-			for (int x = 0; x < SIZE; x++) {
+		for (int y = 0; y < size; y++) {
+			for (int x = 0; x < size; x++) {
 				if (PositionOfCoords(x,y) == ReferencePoint()) {
 					std::cout << "R";
-				} else if (has_dot[PositionOfCoords(x,y)]) {
+				} else if (HasDot(PositionOfCoords(x,y))) {
 					std::cout << "*";
 				} else if (InsideBoard(PositionOfCoords(x,y),o)) {
 					std::cout << ".";
@@ -203,13 +379,13 @@ inline const MorpionGame::Sequence& MorpionGame::Moves() const
 
 inline MorpionGame::Position MorpionGame::PositionOfCoords(int x, int y) const
 {
-    return x + y * SIZE;
+    return x + y * size;
 }
 
 inline void MorpionGame::CoordsOfPosition(Position p, int & x, int & y) const
 {
-    x = p % SIZE;
-    y = p / SIZE;
+    x = p % size;
+    y = p / size;
 }
 
 std::ostream& operator<<(std::ostream& os, MorpionGame::Variant v);
@@ -2,9 +2,12 @@
 # distutils: sources = cppnrpa.cpp morpiongame.cpp
 # distutils: extra_compile_args=["-std=c++14"]
 
+from libc.string cimport memcpy
 from libcpp.vector cimport vector
 import numpy as np
 
+import policy
+
 cdef extern from "morpiongame.h" namespace "MorpionGame":
     cdef enum Variant: T5, D5
 
@@ -31,46 +34,121 @@ cdef extern from "cppnrpa.h":
         Weights();
         Weights(const Weights & _w);
         Weights & operator = (const Weights & _w);
-        void adapt(const Sequence & l);
+        void adapt(const Sequence & l) except +
 
 cdef extern from "cppnrpa.h":
     cdef struct CppNRPAExperimentData:
         int batch_size;
         long long int random_seed;
+        vector[long long int] random_seeds;
         unsigned int levels;
         int iterations;
         float alpha;
-        int v;
+        Variant v;
+        int board_size;
+        bint canonical;
+        int kernel;
+        bint journal;
         float weights[max_goedel_number]
 
         vector[int] best_sequence;
         vector[long long int] histogram;
+        bint cancelled;
         long long int moves;
         long long int sequences;
+        long long int reset_bytes;
+        long long int time_us;
+
+cdef extern from "cppnrpa.h":
+    cdef enum PlayoutKernel: REFERENCE_KERNEL, VECTORIZED_KERNEL, EXP_CACHE_KERNEL
+    cdef const int DEFAULT_PLAYOUT_KERNEL
+
+cdef extern from "cppnrpa.h":
+    cdef struct MoveBenchmarkData:
+        long long int random_seed;
+        int games;
+        Variant v;
+        int board_size;
+        bint reference;
+
+        long long int moves;
         long long int time_us;
+        unsigned long long int checksum;
+
+    void c_benchmark_moves "benchmark_moves"(MoveBenchmarkData &) nogil;
 
 cdef extern from "cppnrpa.h":
     cdef cppclass CppNRPA:
-        void run(CppNRPAExperimentData &);
+        void run(CppNRPAExperimentData &) except + nogil
+        void cancel() nogil;
+
+# Playout kernels, selected with the optional 'kernel' payload key
+KERNELS = {'reference': REFERENCE_KERNEL, 'vectorized': VECTORIZED_KERNEL,
+           'exp_cache': EXP_CACHE_KERNEL}
+DEFAULT_KERNEL = DEFAULT_PLAYOUT_KERNEL
 
 cdef class NRPA:
+    """Atomic NRPA computation.
+
+    run() releases the GIL, so separate NRPA objects can compute in parallel threads.
+    A single NRPA object must not be shared between threads, except for cancel().
+    """
+
     cdef CppNRPA nrpa
     cdef CppNRPAExperimentData experiment_data
 
     def set_payload(self, payload):
-        self.experiment_data.weights = payload['weights'].get_weights()
+        """Weights are given either as a WeightPolicy or as a float32 array, for the
+        optional 'variant', 'board_size' and 'canonical_moves' payload keys (see
+        policy.WeightPolicy)."""
+        variant, board_size = policy.board_geometry(payload.get('variant', '5t'),
+                                                    payload.get('board_size'))
+        canonical = payload.get('canonical_moves', False)
+        self.experiment_data.v = policy.VARIANTS[variant]
+        self.experiment_data.board_size = board_size
+        self.experiment_data.canonical = canonical
+        count = policy.weight_count(variant, board_size, canonical)
+
+        weights = payload['weights']
+        if not isinstance(weights, np.ndarray):
+            weights = weights.to_array()
+
+        cdef const float[::1] view = np.ascontiguousarray(weights, dtype=np.float32)
+        if view.shape[0] != count:
+            raise ValueError("Expected {0} weights for a board of size {1}, got {2}.".format(
+                count, board_size, view.shape[0]))
+        memcpy(&self.experiment_data.weights[0], &view[0], view.shape[0] * sizeof(float))
+
+    def cancel(self):
+        """Make run() return early, in any thread. Cancelled runs return partial results
+        with the 'cancelled' key set. A cancel before run() cancels the next run only."""
+        self.nrpa.cancel()
 
     def run(self, payload):
+        """Run batch_size independent searches from the same policy.
+
+        Searches are seeded from the optional 'random_seeds' list, one seed per search,
+        or else all from a single generator seeded with 'random_seed'. The result has the
+        best sequence and the histogram of best sequence lengths of all searches.
+        Raises OverflowError if the weights of a search diverge.
+        """
         self.experiment_data.batch_size = payload['batch_size']
         self.experiment_data.levels = payload['levels']
         self.experiment_data.iterations = payload['iterations']
         self.experiment_data.alpha = payload['alpha']
         self.experiment_data.random_seed = payload['random_seed']
-        self.experiment_data.v = T5;
+        self.experiment_data.random_seeds = payload.get('random_seeds', [])
+        if not self.experiment_data.random_seeds.empty() and \
+                <int> self.experiment_data.random_seeds.size() < self.experiment_data.batch_size:
+            raise ValueError("Expected {0} random seeds, got {1}.".format(
+                self.experiment_data.batch_size, self.experiment_data.random_seeds.size()))
+        self.experiment_data.kernel = payload.get('kernel', DEFAULT_PLAYOUT_KERNEL)
+        self.experiment_data.journal = payload.get('journal', False)
 #        self.experiment_data.weights = payload['weights'].get_weights()
         self.set_payload(payload)
 
-        self.nrpa.run(self.experiment_data)
+        with nogil:
+            self.nrpa.run(self.experiment_data)
 
         result = dict()
 
@@ -80,12 +158,36 @@ cdef class NRPA:
         result['iterations'] = self.experiment_data.iterations
         result['alpha'] = self.experiment_data.alpha
         result['v'] = self.experiment_data.v
+        result['board_size'] = self.experiment_data.board_size
+        result['kernel'] = self.experiment_data.kernel
 
-        result['weights'] = np.array(self.experiment_data.weights, copy=True)
         result['best_sequence'] = self.experiment_data.best_sequence
         result['histogram'] = self.experiment_data.histogram
+        result['cancelled'] = self.experiment_data.cancelled
         result['moves'] = self.experiment_data.moves
         result['sequences'] = self.experiment_data.sequences
+        result['reset_bytes'] = self.experiment_data.reset_bytes
         result['time_us'] = self.experiment_data.time_us
 
         return result
+
+
+def benchmark_moves(games=1000, random_seed=1, variant='5t', board_size=None, reference=False):
+    """Replay games of random moves with MorpionGame::MakeMove (or ReferenceMakeMove).
+
+    Returns the number of moves, the replay time and a checksum of the positions after every
+    move, which is the same for both implementations.
+    """
+    cdef MoveBenchmarkData data
+    variant, board_size = policy.board_geometry(variant, board_size)
+    data.random_seed = random_seed
+    data.games = games
+    data.v = policy.VARIANTS[variant]
+    data.board_size = board_size
+    data.reference = reference
+
+    with nogil:
+        c_benchmark_moves(data)
+
+    return {'moves': data.moves, 'time_us': data.time_us, 'checksum': data.checksum,
+            'moves_per_second': 1e6 * data.moves / data.time_us if data.time_us > 0 else 0.0}
@@ -2,71 +2,246 @@
 
 from mpi4py import MPI
 from collections import deque
+import argparse
+import json
 import logging
 import time
-from deepsense import neptune
 import cProfile
 import pstats
 import sys
 
+import checkpoint
 import client_server
 import nrpa
+import policy
+import policy_cache
 import rollout
 import selector
 import reporting
+import timeline
+import workers
 
 
 class ParallelNRPAExperiment(client_server.ClientServer):
+    def __init__(self, threads=0, sub_servers=0, profile=False, params_file=None):
+        """With threads > 0 atomic computations run in a thread pool of the server
+        process instead of MPI ranks. With sub_servers > 0 MPI ranks form a two-tier
+        topology (see run_hierarchy). With profile the server loop runs under cProfile.
+        With params_file the parameters are read from a JSON file and reports are written
+        to local files instead of Neptune."""
+
+        self.threads = threads
+        self.sub_servers = sub_servers
+        self.profile = profile
+        self.params_file = params_file
+        self.reporter = None
+        self.policies = policy_cache.PolicyCache()
+        self.checkpointer = None
+        self.cancelled = False
+
+        self.worker_comm = None     # communicator of the server with its workers
+        self.sub_backend = None     # workers of a sub-server
+        self.last_subtree_policy_id = 0
+
+    def run(self):
+        """Entry point."""
+        if self.threads > 0:
+            self.server_loop()
+            logging.info("Server terminated.")
+        elif self.sub_servers > 0:
+            self.run_hierarchy()
+        else:
+            super().run()
+
+    def run_hierarchy(self):
+        """Entry point of the two-tier topology.
+
+        The top server (rank 0) keeps the upper levels of the rollout tree. Its atomic
+        rollouts are searches of sub_parallel_levels + atomic_levels levels, computed by
+        sub-servers as parallel rollout trees of sub_parallel_levels on their own groups
+        of workers (see workers.hierarchy_communicators). Only the results of subtrees are
+        sent to the top server.
+        """
+        top, group = workers.hierarchy_communicators(MPI.COMM_WORLD, self.sub_servers)
+        rank = MPI.COMM_WORLD.Get_rank()
+
+        if rank == 0:
+            self.worker_comm = top
+            self.server_loop()
+            logging.info("Server terminated.")
+        elif rank <= self.sub_servers:
+            # Subtrees are computed in a separate thread, see ClientServer.compute
+            if MPI.Query_thread() < MPI.THREAD_MULTIPLE:
+                logging.warning("MPI does not support concurrent calls from threads.")
+
+            self.sub_backend = workers.MPIWorkers(group)
+            self.client_loop(top)
+            self.sub_backend.shutdown()
+            logging.info("Sub-server {0} terminated.".format(rank))
+        else:
+            self.client_loop(group)
+            logging.info("Client {0} terminated.".format(rank))
+
+    def cancel(self):
+        """Stop the server loop: no jobs are sent and running jobs are cancelled."""
+        self.cancelled = True
+
+    def init_context(self):
+        if self.params_file is not None:
+            with open(self.params_file) as file:
+                self.neptune_params = json.load(file)
+            self.neptune_ctx = None
+            variant, board_size = self.game()
+            reporter = reporting.LocalReporter(self.neptune_params['report_dir']
+                                               if 'report_dir' in self.neptune_params else '.',
+                                               prometheus=True, images=True, variant=variant,
+                                               board_size=board_size)
+        else:
+            from deepsense import neptune
+
+            self.neptune_ctx = neptune.Context()
+            self.neptune_params = self.neptune_ctx.params
+            reporter = reporting.NeptuneReporter(self.neptune_ctx, *self.game())
+
+        # Reports are sent from a background thread
+        self.reporter = reporting.AsyncReporter(reporter)
+
+    def init_workers(self):
+        if self.threads > 0:
+            return workers.ThreadPoolWorkers(self.threads, self.atomic_computation,
+                                             self.new_engine)
+        else:
+            return workers.MPIWorkers(self.worker_comm if self.worker_comm is not None
+                                      else MPI.COMM_WORLD)
+
+    def load_checkpoint(self):
+        """Return the rollout tree of the latest checkpoint or None.
+
+        Raises ValueError if the checkpoint is of an experiment with other parameters.
+        """
+        root = checkpoint.load(self.checkpoint_dir, checkpoint.tree_parameters(self.new_root()))
+        if root is not None:
+            logging.info("Resuming from checkpoint in {0}.".format(self.checkpoint_dir))
+        return root
+
+    def save_checkpoint(self, wait=False):
+        """Checkpoint the rollout tree in the background (with running computations).
+
+        Returns False if the previous checkpoint is still being written.
+        """
+        return self.checkpointer.save(self.root, wait)
+
     def server_loop(self):
-#        self._server_loop()
-        cProfile.runctx('self._server_loop()', globals(), locals(), 'stats')
-        p = pstats.Stats('stats')
-        p.sort_stats('cumulative').print_stats(80)
+        if self.profile:
+            cProfile.runctx('self._server_loop()', globals(), locals(), 'stats')
+            p = pstats.Stats('stats')
+            p.sort_stats('cumulative').print_stats(80)
+        else:
+            self._server_loop()
 
     def report_progress(self, report_sequence=False):
         reporting.log_to_console(self.root)
         if report_sequence:
-            reporting.send_sequence(self.neptune_ctx, 'Best sequence', self.root.best_sequence)
+            self.reporter.sequence('Best sequence', self.root.best_sequence)
         #reporting.send_tree(self.neptune_ctx, 'Rollout tree', self.root.tree())
-        self.neptune_ctx.channel_send('Parallel speedup', '{0:.8f}'.format(self.root.parallel_speedup()))
-        self.neptune_ctx.channel_send('Progress', '{0:.8f}'.format(self.root.progress()))
-        self.neptune_ctx.channel_send('Best sequence length', len(self.root.best_sequence))
-        self.neptune_ctx.channel_send('Idle', self.root.idle_time_percent())
-        self.neptune_ctx.channel_send('Wall time', self.root.stats['wall_time'])
+        self.reporter.metric('Parallel speedup', '{0:.8f}'.format(self.root.parallel_speedup()))
+        self.reporter.metric('Progress', '{0:.8f}'.format(self.root.progress()))
+        self.reporter.metric('Best sequence length', len(self.root.best_sequence))
+        self.reporter.metric('Idle', self.root.idle_time_percent())
+        self.reporter.metric('Wall time', self.root.stats['wall_time'])
+        self.reporter.metric('Cancelled time saved', self.root.stats['cancelled_time_saved'])
+        if self.root.stats['histogram']:
+            self.reporter.histogram('Sequence length histogram', self.root.stats['histogram'])
+        if self.node_selector.estimator is not None:
+            logging.info("Change probability estimates: {0}".format(
+                self.node_selector.estimator.table()))
 
     def _server_loop(self):
         # Neptune initialization
 
-        self.neptune_ctx = neptune.Context()
-        self.neptune_params = self.neptune_ctx.params
+        self.init_context()
+
+        # Spans of the server loop, written to the timeline file if there is one
+
+        self.timeline = timeline.Timeline(self.neptune_params['timeline']
+                                          if 'timeline' in self.neptune_params else None)
+
+        # Checkpointing every checkpoint_interval seconds (disabled if 0)
+
+        self.checkpoint_interval = self.neptune_params['checkpoint_interval'] \
+            if 'checkpoint_interval' in self.neptune_params else 0
+        self.checkpoint_dir = self.neptune_params['checkpoint_dir'] \
+            if 'checkpoint_dir' in self.neptune_params else 'checkpoint'
 
         # Rollout tree initialization
 
-        self.root = rollout.RootRollout(iterations=self.neptune_params['iterations'],
-                                        parallel_levels=self.neptune_params['parallel_levels'],
-                                        atomic_levels=self.neptune_params['atomic_levels'],
-                                        alpha=self.neptune_params['alpha'],
-                                        random_seed=self.neptune_params['seed'])
-        self.root.add_pending_nodes()
-        self.node_selector = selector.ProbabilitySelector()
+        self.root = None
+        if self.checkpoint_interval > 0:
+            self.checkpointer = checkpoint.Checkpointer(self.checkpoint_dir)
+            self.root = self.load_checkpoint()
+
+        if self.root is None:
+            self.root = self.new_root()
+            self.root.add_pending_nodes()
+
+        # Rollouts whose policy changes with probability speculation_threshold or more are
+        # not computed while other jobs run. adaptive_selector estimates the probabilities
+        # from discarded and retired rollouts.
+
+        self.speculation_threshold = self.neptune_params['speculation_threshold'] \
+            if 'speculation_threshold' in self.neptune_params else 1.0
+        adaptive = self.neptune_params['adaptive_selector'] \
+            if 'adaptive_selector' in self.neptune_params else False
+        estimator = selector.ChangeProbabilityEstimator() if adaptive else None
+        self.node_selector = selector.IncrementalProbabilitySelector(estimator)
+
+        # MPI workers rebuild policies from adapt sequences instead of receiving weights
+
+        self.policy_chains = self.neptune_params['policy_chains'] \
+            if 'policy_chains' in self.neptune_params else False
+
+        # Parameters of subtrees computed by sub-servers
+
+        self.subtree = None
+        if self.sub_servers > 0:
+            self.subtree = {'parallel_levels': self.sub_parallel_levels(),
+                            'prefetch': self.neptune_params['prefetch']
+                            if 'prefetch' in self.neptune_params else 1,
+                            'speculation_threshold': self.speculation_threshold,
+                            'adaptive_selector': adaptive,
+                            'policy_chains': self.policy_chains}
 
         # Server initialization
 
-        self.comm = MPI.COMM_WORLD
-        self.rank = self.comm.Get_rank()
-        self.nodes = self.comm.Get_size() - 1
+        self.rank = 0
+        self.backend = self.init_workers()
+        self.backend.timeline = self.timeline
+        self.nodes = self.backend.nodes
+
+        # Each worker has a queue of up to prefetch jobs, so that it does not wait for
+        # the server between jobs. self.workers holds one entry per free queue slot.
+        self.prefetch = self.neptune_params['prefetch'] if 'prefetch' in self.neptune_params else 1
 
-        self.workers = deque()
-        for worker in range(self.nodes):
-            self.workers.append(worker + 1)
+        self.workers = deque(self.backend.ranks() * self.prefetch)
 
         self.working = True
-        self.job_source = dict()
+
+        # (rollout, job id) of the jobs queued at each worker. Jobs of discarded rollouts
+        # are cancelled; cancelled_jobs holds their ids until their results arrive.
+        self.job_source = dict((worker, deque()) for worker in self.backend.ranks())
+        self.last_job_id = 0
+        self.cancelled_jobs = set()
+
+        # Computation time of jobs that were not cancelled, to estimate time saved
+        self.finished_jobs = 0
+        self.finished_time = 0.0
 
         last_logging_time = 0
-        last_best_sequence = []
+        last_checkpoint_time = time.time()
+        last_best_sequence = ()
 
-        server_start_time = time.time()
+        # Wall time of a resumed experiment includes the time before the checkpoint
+        server_start_time = time.time() - self.root.stats['wall_time']
 
         # seq = 0
 
@@ -74,29 +249,47 @@ class ParallelNRPAExperiment(client_server.ClientServer):
         while self.working:
             # Send jobs
             waiting_rollout = None
-            while len(self.workers) > 0:
-                waiting_rollout = self.node_selector.select(self.root)
+            while len(self.workers) > 0 and not self.cancelled:
+                # Idle workers wait for results, unless no jobs are running
+                max_probability = 1.0 if len(self.workers) == self.nodes * self.prefetch \
+                    else self.speculation_threshold
+                start = self.timeline.now()
+                waiting_rollout = self.node_selector.select(self.root, max_probability)
+                self.timeline.span('select', start)
                 if waiting_rollout is None:
-                    print("NO WAITING ROLLOUTS")
+                    if max_probability >= 1.0:
+                        logging.debug("No waiting rollouts.")
                     break
 
                 job = waiting_rollout.get_computation_metadata()
+                if self.subtree is not None:
+                    job['subtree'] = self.subtree
+                if self.policy_chains:
+                    job['policy_lineage'] = self.root.policy_lineage
                 waiting_rollout.state = rollout.Rollout.State.running
                 waiting_rollout.mark_as_dirty()
 
                 # Send out the job
+                start = self.timeline.now()
+                self.last_job_id += 1
+                job['job_id'] = self.last_job_id
                 worker = self.workers.popleft()
-                self.job_source[worker] = job["source"]
+                self.job_source[worker].append((job["source"], job['job_id']))
                 del(job["source"])
                 # logging.debug("Sending job {0} to worker {1}".format(job, worker))
-                cmd = {'command': 'run', 'payload': job}
-                self.comm.send(cmd, dest=worker)
+                self.backend.send(worker, job)
+                self.timeline.span('send', start)
 
                 # Create new waiting nodes
+                start = self.timeline.now()
                 self.root.update()
+                self.cancel_discarded_jobs()
+                self.timeline.span('update', start)
+
+            self.timeline.counter('running_jobs', self.nodes * self.prefetch - len(self.workers))
 
             # Finished?
-            if waiting_rollout is None and len(self.workers) == self.nodes:
+            if waiting_rollout is None and len(self.workers) == self.nodes * self.prefetch:
                 self.working = False
                 break
 
@@ -108,54 +301,262 @@ class ParallelNRPAExperiment(client_server.ClientServer):
                 if rollout.SequenceComparator.is_right_better(last_best_sequence, self.root.best_sequence):
                     report_sequence = True
                 last_best_sequence = self.root.best_sequence
+                start = self.timeline.now()
                 self.report_progress(report_sequence)
+                self.timeline.span('report', start)
                 #with open("cert.txt", "w") as cert_file:
                 #    cert_file.write(str(self.root.atomic_levels) + " ")
                 #    cert_file.write(str(self.root.parallel_levels) + " ")
                 #    cert_file.write(str(self.root.iterations) + " \n")
                 #    self.root.write_cert(cert_file)
 
-            # Retrieve job result
-            data = self.comm.recv(source=MPI.ANY_SOURCE)
-
-            logging.debug("Received {1} move sequence from {0}.".format(data["source"], len(data["result"]["best_sequence"])))
-
-#            print("Got result", self.root.tree())
-
-            # Store result and release worker
-            self.job_source[data["source"]].record_computation_result(data["result"])
-            self.job_source[data["source"]] = None
-
-            # Update statistics
-            self.root.stats['idle_time'] += data['stats']['idle_time']
-            self.root.stats['wall_time'] = time.time() - server_start_time
-            self.root.stats['sequences'] += data['result']['sequences']
-            self.root.stats['computation_time'] += data['stats']['computation_time']
-
-            # Release worker
-            self.workers.append(data["source"])
+            # Retrieve all available job results (none if a cancel interrupted the wait)
+            start = self.timeline.now()
+            results = self.backend.recv()
+            self.timeline.span('recv', start)
+
+            if self.cancelled:
+                self.cancel_discarded_jobs()
+
+            start = self.timeline.now()
+            for data in results:
+                logging.debug("Received {1} move sequence from {0}.".format(data["source"], len(data["result"]["best_sequence"])))
+
+                # Store result and release worker
+                source, job_id = self.job_source[data["source"]].popleft()
+                source.record_computation_result(data["result"])
+                self.cancelled_jobs.discard(job_id)
+
+                # Update statistics (of the workers of a sub-server for subtrees)
+                stats = data['result']['worker_stats'] if 'worker_stats' in data['result'] \
+                    else data['stats']
+                self.root.stats['idle_time'] += stats['idle_time']
+                self.root.stats['wall_time'] = time.time() - server_start_time
+                self.root.stats['sequences'] += data['result']['sequences']
+                self.root.stats['computation_time'] += stats['computation_time']
+                if data['result'].get('cancelled', False):
+                    self.record_cancelled_job(stats['computation_time'])
+                else:
+                    self.root.record_histogram(data['result']['histogram'])
+                    self.finished_jobs += 1
+                    self.finished_time += stats['computation_time']
+
+                # Busy interval of the worker and time of the search, ending now
+                end = self.timeline.now()
+                self.timeline.span('compute', end - data['stats']['computation_time'],
+                                   data['source'], end)
+                if 'time_us' in data['result']:
+                    self.timeline.span('nrpa', end - data['result']['time_us'] / 1e6,
+                                       data['source'], end)
+
+                # Release worker
+                self.workers.append(data["source"])
+
+            self.timeline.span('record', start)
+            self.timeline.counter('results', len(results))
 
             # Update
 #            print("before update", self.root.tree())
+            start = self.timeline.now()
             self.root.update()
+            self.cancel_discarded_jobs()
+            self.timeline.span('update', start)
 #            print("after update", self.root.tree())
 
+            # Checkpoint
+            if self.checkpointer is not None and \
+                    time.time() - last_checkpoint_time >= self.checkpoint_interval:
+                start = self.timeline.now()
+                if self.save_checkpoint():
+                    last_checkpoint_time = time.time()
+                self.timeline.span('checkpoint', start)
+
+        if self.checkpointer is not None:
+            self.save_checkpoint(wait=True)
+
+        self.report_final_result()
+        self.timeline.close()
+        if self.reporter is not None:
+            self.reporter.close()
+
+#        self.root.tree(True).render('final.png', w=800, units='px')
+
+        # Terminate workers
+        self.stop_workers()
+
+    def new_root(self):
+        """Return the rollout tree of a new experiment, without pending rollouts."""
+        parallel_levels = self.neptune_params['parallel_levels']
+        atomic_levels = self.neptune_params['atomic_levels']
+
+        # Sub-servers compute the lower parallel levels
+        if self.sub_servers > 0:
+            parallel_levels -= self.sub_parallel_levels()
+            atomic_levels += self.sub_parallel_levels()
+            if parallel_levels < 1:
+                raise ValueError("sub_parallel_levels must be lower than parallel_levels.")
+
+        variant, board_size = self.game()
+
+        return rollout.RootRollout(iterations=self.neptune_params['iterations'],
+                                   parallel_levels=parallel_levels,
+                                   atomic_levels=atomic_levels,
+                                   alpha=self.neptune_params['alpha'],
+                                   random_seed=self.neptune_params['seed'],
+                                   batch_size=self.neptune_params['batch_size']
+                                   if 'batch_size' in self.neptune_params else 1,
+                                   variant=variant,
+                                   board_size=board_size,
+                                   canonical_moves=self.neptune_params['canonical_moves']
+                                   if 'canonical_moves' in self.neptune_params else False)
+
+    def game(self):
+        """Variant and board size of the experiment (see policy.board_geometry)."""
+        return policy.board_geometry(
+            self.neptune_params['variant'] if 'variant' in self.neptune_params else '5t',
+            self.neptune_params['board_size'] if 'board_size' in self.neptune_params else None)
+
+    def sub_parallel_levels(self):
+        return self.neptune_params['sub_parallel_levels'] \
+            if 'sub_parallel_levels' in self.neptune_params else 1
+
+    def report_final_result(self):
         self.report_progress()
         reporting.log_to_console(self.root)
+        logging.info("Server time: {0}".format(self.timeline.summary()))
         print("Best sequence length {0}".format(len(self.root.best_sequence)))
 
-#        self.root.tree(True).render('final.png', w=800, units='px')
+    def stop_workers(self):
+        self.backend.shutdown()
+
+    def cancel_discarded_jobs(self):
+        """Cancel the jobs of discarded rollouts (they have no parent), or all jobs if the
+        experiment is cancelled."""
+        for worker, jobs in self.job_source.items():
+            for source, job_id in jobs:
+                if (source.parent is None or self.cancelled) and job_id not in self.cancelled_jobs:
+                    self.cancelled_jobs.add(job_id)
+                    self.backend.cancel(worker, job_id)
+
+    def record_cancelled_job(self, computation_time):
+        """Count the computation time a cancelled job saved, assuming it would have taken
+        the mean time of jobs that were not cancelled."""
+        self.root.stats['cancelled_jobs'] += 1
+        if self.finished_jobs > 0:
+            self.root.stats['cancelled_time_saved'] += \
+                max(0.0, self.finished_time / self.finished_jobs - computation_time)
+
+    def atomic_computation(self, payload, engine=None):
+        if 'policy' in payload:
+            payload['weights'] = self.policies.decode(payload.pop('policy'))
+
+        return (engine if engine is not None else nrpa.NRPA()).run(payload)
+
+    def new_engine(self):
+        return SubtreeSearch(self) if self.sub_backend is not None else nrpa.NRPA()
+
+
+class SubtreeExperiment(ParallelNRPAExperiment):
+    """Parallel NRPA subtree computed by a sub-server for an atomic job of the top server.
+
+    The subtree starts from the policy of the job and runs on the workers of the
+    sub-server, which are kept between jobs. Policy ids continue across jobs, so that
+    policies cached by the workers are never confused.
+    """
+
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.payload = None
+
+    def cancel(self):
+        super().cancel()
+
+        # The server loop may be waiting for results
+        self.server.sub_backend.interrupt()
+
+    def search(self, payload):
+        self.payload = payload
+        self._server_loop()
+        self.server.last_subtree_policy_id = self.root.last_policy_id
+
+        # A cancel stops this search only
+        cancelled, self.cancelled = self.cancelled, False
+
+        return {'best_sequence': list(self.root.best_sequence),
+                'random_seed': payload['random_seed'],
+                'sequences': self.root.stats['sequences'],
+                'histogram': self.root.stats['histogram'],
+                'cancelled': cancelled,
+                'worker_stats': {'computation_time': self.root.stats['computation_time'],
+                                 'idle_time': self.root.stats['idle_time']}}
+
+    def init_context(self):
+        subtree = self.payload['subtree']
+
+        self.neptune_ctx = None
+        self.neptune_params = dict(subtree,
+                                   iterations=self.payload['iterations'],
+                                   atomic_levels=self.payload['levels'] - subtree['parallel_levels'],
+                                   alpha=self.payload['alpha'],
+                                   seed=self.payload['random_seed'],
+                                   batch_size=self.payload['batch_size'])
+
+    def init_workers(self):
+        return self.server.sub_backend
+
+    def new_root(self):
+        weights = policy.WeightPolicy(self.payload['variant'], self.payload['board_size'],
+                                      self.payload['canonical_moves'])
+        weights.set_array(self.payload['weights'])
+
+        return rollout.RootRollout(iterations=self.neptune_params['iterations'],
+                                   parallel_levels=self.neptune_params['parallel_levels'],
+                                   atomic_levels=self.neptune_params['atomic_levels'],
+                                   alpha=self.neptune_params['alpha'],
+                                   random_seed=self.neptune_params['seed'],
+                                   batch_size=self.neptune_params['batch_size'],
+                                   policy=weights,
+                                   policy_id=self.server.last_subtree_policy_id + 1)
+
+    def report_progress(self, report_sequence=False):
+        pass
+
+    def report_final_result(self):
+        logging.debug("Subtree search found a sequence of length {0}.".format(
+            len(self.root.best_sequence)))
+
+    def stop_workers(self):
+        pass
 
-        # Terminate workers
-        for client in range(self.nodes):
-            logging.debug("Sending QUIT command to client {0}.".format(client+1))
-            cmd = {'command': 'quit'}
-            self.comm.send(cmd, dest=client+1)
 
-    def atomic_computation(self, payload):
-        return nrpa.NRPA().run(payload)
+class SubtreeSearch:
+    """Engine of a sub-server: a cancellable SubtreeExperiment (see new_engine)."""
+
+    def __init__(self, server):
+        self.experiment = SubtreeExperiment(server)
+
+    def cancel(self):
+        self.experiment.cancel()
+
+    def run(self, payload):
+        return self.experiment.search(payload)
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    ParallelNRPAExperiment().run()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=0,
+                        help='run atomic computations in a thread pool instead of MPI ranks')
+    parser.add_argument('--sub_servers', type=int, default=0,
+                        help='MPI ranks that compute subtrees on their own groups of workers')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the server loop under cProfile and print the top entries')
+    parser.add_argument('--params', default=None,
+                        help='JSON file with experiment parameters; reports are written to '
+                             'local files instead of Neptune')
+    args = parser.parse_args()
+
+    ParallelNRPAExperiment(threads=args.threads, sub_servers=args.sub_servers,
+                           profile=args.profile, params_file=args.params).run()
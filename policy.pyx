@@ -2,6 +2,7 @@
 # distutils: sources = cppnrpa.cpp morpiongame.cpp
 # distutils: extra_compile_args=["-std=c++14"]
 
+from libc.string cimport memcpy
 from libcpp.vector cimport vector
 import numpy as np
 
@@ -17,6 +18,15 @@ cdef extern from "morpiongame.h" namespace "MorpionGame":
 
 cdef extern from "morpiongame.h" namespace "MorpionGame":
     cdef const int max_goedel_number
+    cdef const int MIN_SIZE
+    cdef const int MAX_SIZE
+    int DefaultSize(Variant variant)
+
+cdef extern from "morpiongame.h":
+    cdef cppclass MorpionGame:
+        int goedel_count() const
+        @staticmethod
+        const MorpionGame & Root(Variant variant, int size, bint canonical)
 
 cdef extern from "morpiongame.h" namespace "MorpionGame":
     cdef struct Move:
@@ -34,20 +44,74 @@ cdef extern from "morpiongame.h" namespace "MorpionGame":
 cdef extern from "cppnrpa.h":
     cdef cppclass Weights:
         float[max_goedel_number] w
+        Variant variant
+        int board_size
+        bint canonical
+        int length
 
         Weights();
         Weights(const Weights & _w);
         Weights & operator = (const Weights & _w);
-        void adapt(const Sequence & l);
+        void adapt(const Sequence & l) except +
+        void reset(Variant variant, int board_size, bint canonical);
 
 cdef extern from "cppnrpa.h":
     cdef Sequence cythonize(vector[int] seq);
 
 
+# Game variants by name, as in morpion.Game
+VARIANTS = {'5t': T5, '5d': D5}
+VARIANT_NAMES = dict((value, name) for name, value in VARIANTS.items())
+
+
+def board_geometry(variant='5t', board_size=None):
+    """Return (variant, board size), with the default board size of the variant if
+    board_size is None or 0. Boards are board_size x board_size dots."""
+    if variant not in VARIANTS:
+        raise ValueError("Unknown variant {0!r}, expected one of {1}.".format(
+            variant, ', '.join(sorted(VARIANTS))))
+    if not board_size:
+        board_size = DefaultSize(VARIANTS[variant])
+    if not MIN_SIZE <= board_size <= MAX_SIZE:
+        raise ValueError("Board size {0} is not between {1} and {2}.".format(
+            board_size, MIN_SIZE, MAX_SIZE))
+    return variant, board_size
+
+
+def weight_count(variant='5t', board_size=None, canonical_moves=False):
+    """Number of weights of policies of a variant on a board."""
+    variant, board_size = board_geometry(variant, board_size)
+    return MorpionGame.Root(VARIANTS[variant], board_size, canonical_moves).goedel_count()
+
+
 cdef class WeightPolicy(Policy):
+    """All-zero weights of moves of a variant on a board (see board_geometry).
+
+    With canonical_moves, moves that are images of each other under the symmetries of the
+    cross share a weight, and only moves that can be legal on the board have weights.
+    """
+
     cdef Weights weights
 
+    def __init__(self, variant='5t', board_size=None, canonical_moves=False):
+        variant, board_size = board_geometry(variant, board_size)
+        self.weights.reset(VARIANTS[variant], board_size, canonical_moves)
+
+    @property
+    def variant(self):
+        return VARIANT_NAMES[self.weights.variant]
+
+    @property
+    def board_size(self):
+        return self.weights.board_size
+
+    @property
+    def canonical_moves(self):
+        return self.weights.canonical
+
     def adapt(self, sequence):
+        """Adapt the weights to sequence. Raises OverflowError, without changing the
+        weights, if they diverged."""
         self.weights.adapt(cythonize(sequence))
 
     def __repr__(self):
@@ -55,14 +119,25 @@ cdef class WeightPolicy(Policy):
 
     def __reduce__(self):
         d=dict()
-        d['weights'] = np.asarray(self.weights.w)
-        return (WeightPolicy, (d['weights'], ), d)
+        d['weights'] = self.to_array()
+        return (WeightPolicy, (self.variant, self.board_size, self.canonical_moves), d)
 
     def __setstate__(self, d):
-        self.weights.w = d['weights']
+        self.set_array(d['weights'])
 
     def get_weights(self):
         return self.weights.w
 
+    def to_array(self):
+        """Copy of the weights as a float32 NumPy array."""
+        cdef float[::1] view = <float[:self.weights.length]> &self.weights.w[0]
+        return np.array(view, dtype=np.float32, copy=True)
+
+    def set_array(self, weights):
+        """Set the weights from a float32 array of weight_count() elements."""
+        cdef const float[::1] view = np.ascontiguousarray(weights, dtype=np.float32)
+        assert view.shape[0] == self.weights.length
+        memcpy(&self.weights.w[0], &view[0], self.weights.length * sizeof(float))
+
     def __eq__(self, p):
         return str(self) == str(p)
@@ -0,0 +1,184 @@
+"""
+Sparse policy transfer between the server and workers.
+
+Every policy in the rollout tree has an id. Workers keep a small LRU cache of
+policies they have received, keyed by id. The server mirrors the contents of each
+worker's cache, so a policy is sent as a sparse delta (index/value pairs) against
+the cached policy it differs least from, or just as its id if the worker has it.
+The all-zero root policy is an implicit base that every worker has.
+
+With the lineage of policies (RootRollout.policy_lineage), a policy can instead be sent
+as a chain of adapt sequences from a cached ancestor (or from the all-zero policy), which
+the worker replays with WeightPolicy.adapt. Adapt sequences are much smaller than weight
+deltas, and the server computes no deltas. Policies with no short chain from a cached
+policy are sent as deltas.
+"""
+
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+import policy
+
+
+class PolicyCache:
+    """Worker-side LRU cache of policy weight arrays."""
+
+    def __init__(self, capacity=8):
+        self.capacity = capacity
+        self.policies = OrderedDict()
+
+    def __contains__(self, policy_id):
+        return policy_id in self.policies
+
+    def ids(self):
+        return list(self.policies)
+
+    def get(self, policy_id):
+        """Return cached weights and mark them as recently used."""
+        self.policies.move_to_end(policy_id)
+        return self.policies[policy_id]
+
+    def put(self, policy_id, weights):
+        """Cache weights. Returns the id of the evicted policy or None."""
+        self.policies[policy_id] = weights
+        self.policies.move_to_end(policy_id)
+
+        if len(self.policies) > self.capacity:
+            evicted, _ = self.policies.popitem(last=False)
+            return evicted
+
+        return None
+
+    def decode(self, message):
+        """Reconstruct the weights sent by PolicyEncoder.encode."""
+        policy_id = message['id']
+
+        if policy_id in self.policies and 'values' not in message and 'chain' not in message:
+            return self.get(policy_id)
+
+        if 'chain' in message:
+            adapted = policy.WeightPolicy(*message['game'])
+            if message['base'] is not None:
+                adapted.set_array(self.get(message['base']))
+            for sequence in message['chain']:
+                adapted.adapt(sequence)
+            weights = adapted.to_array()
+        elif message.get('indices') is None:
+            weights = np.array(message['values'], dtype=np.float32, copy=True)
+        else:
+            if message['base'] is None:
+                weights = np.zeros(message['size'], dtype=np.float32)
+            else:
+                weights = self.get(message['base']).copy()
+            weights[message['indices']] = message['values']
+
+        self.put(policy_id, weights)
+
+        return weights
+
+
+class PolicyEncoder:
+    """Server-side encoder that mirrors the caches of all workers.
+
+    Messages for a worker must be decoded in the order they were encoded.
+    """
+
+    def __init__(self, capacity=8, max_chain=16):
+        self.capacity = capacity
+        self.max_chain = max_chain
+        self.caches = dict()
+        self.weights = dict()   # policy id -> weights, or the policy until weights are needed
+        self.references = Counter()
+
+    def mirror(self, worker):
+        if worker not in self.caches:
+            self.caches[worker] = PolicyCache(self.capacity)
+        return self.caches[worker]
+
+    def array(self, policy_id):
+        """Weights of a policy in some cache, converted from the policy on first use."""
+        weights = self.weights[policy_id]
+        if not isinstance(weights, np.ndarray):
+            weights = weights.to_array()
+            self.weights[policy_id] = weights
+        return weights
+
+    def chain(self, cache, policy_id, lineage):
+        """Return (base, adapt sequences) that rebuild policy_id from the cached policy base
+        (None for the all-zero policy), or None if there is no chain of at most max_chain
+        sequences."""
+        sequences = []
+        while len(sequences) <= self.max_chain:
+            if policy_id in cache:
+                cache.get(policy_id)
+                return policy_id, sequences[::-1]
+            if policy_id not in lineage:
+                return None
+            if lineage[policy_id] is None:
+                return None, sequences[::-1]
+
+            policy_id, sequence = lineage[policy_id]
+            sequences.append(sequence)
+
+        return None
+
+    def encode(self, worker, policy_id, policy, lineage=None):
+        """Return a message from which the worker reconstructs weights of policy.
+
+        With lineage (see RootRollout.policy_lineage) the policy is sent as a chain of
+        adapt sequences if possible."""
+        cache = self.mirror(worker)
+
+        if policy_id in cache:
+            cache.get(policy_id)
+            return {'id': policy_id}
+
+        chain = self.chain(cache, policy_id, lineage) if lineage is not None else None
+        if chain is not None:
+            base, sequences = chain
+            if policy_id not in self.weights:
+                self.weights[policy_id] = policy
+            self.add(cache, policy_id)
+
+            return {'id': policy_id, 'base': base, 'chain': sequences,
+                    'game': (policy.variant, policy.board_size, policy.canonical_moves)}
+
+        weights = self.array(policy_id) if policy_id in self.weights else policy.to_array()
+
+        # Find the cached policy that differs on the smallest number of moves
+        base = None
+        indices = np.flatnonzero(weights)
+        for candidate in cache.ids():
+            candidate_indices = np.flatnonzero(weights != self.array(candidate))
+            if candidate_indices.shape[0] < indices.shape[0]:
+                base = candidate
+                indices = candidate_indices
+
+        if indices.shape[0] * 6 >= weights.shape[0] * 4:
+            # Dense weights are smaller than index/value pairs
+            message = {'id': policy_id, 'indices': None, 'values': weights}
+        else:
+            index_type = np.uint16 if weights.shape[0] <= 65536 else np.int32
+            message = {'id': policy_id, 'base': base, 'size': weights.shape[0],
+                       'indices': indices.astype(index_type), 'values': weights[indices]}
+            if base is not None:
+                cache.get(base)
+
+        self.weights[policy_id] = weights
+        self.add(cache, policy_id)
+
+        return message
+
+    def add(self, cache, policy_id):
+        """Mirror the caching of policy_id by a worker."""
+        self.references[policy_id] += 1
+        evicted = cache.put(policy_id, None)
+        if evicted is not None:
+            self.release(evicted)
+
+    def release(self, policy_id):
+        self.references[policy_id] -= 1
+        if self.references[policy_id] == 0:
+            del self.references[policy_id]
+            del self.weights[policy_id]
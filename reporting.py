@@ -1,10 +1,22 @@
-from deepsense import neptune
+"""
+Experiment reporting: console logs and metric backends.
+
+Reporters receive metrics, sequences and sequence length histograms. NeptuneReporter sends
+them to Neptune channels, LocalReporter writes them to files. AsyncReporter wraps either
+one and sends buffered reports from a background thread, so that the server loop does not
+wait for the network or for image rendering. Neptune, morpion and matplotlib are imported
+only when they are used.
+"""
+
+import copy
+import csv
+import json
 import logging
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import morpion
-import PIL.Image as Image
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
 
 def log_to_console(rout):
     logging.info("Time: {0:.2f} wall, {1:.2f} working, {2:.2f} ({3:.0%}) idle".format(
@@ -13,6 +25,8 @@ def log_to_console(rout):
         rout.stats['idle_time'],
         rout.idle_time_percent()
     ))
+    logging.info("Cancelled: {0} jobs, {1:.2f} saved".format(
+        rout.stats['cancelled_jobs'], rout.stats['cancelled_time_saved']))
     logging.info("Sequences: {0}/{1} ({2:.0%}) speedup {3:.2f} done: {4:.0%}".format(
         rout.stats['sequences'], rout.completed_sequences(),
         rout.parallel_efficiency(), rout.parallel_speedup(), rout.progress()))
@@ -27,22 +41,26 @@ def improvement_histogram(self):
 def sequence_diagram(self):
     pass
 
-def send_sequence(ctx, channel_name, sequence):
-    game = morpion.Game()
+def sequence_image(sequence, variant='5t', board_size=40):
+    """Render the Morpion grid of sequence as an 800x800 PIL image."""
+    import morpion
+
+    game = morpion.Game.on_board(variant, board_size)
     for move in sequence:
         game.make_move(move)
     grid = game.get_grid()
-    grid_image = grid.get_PILImage(800,800)
-    neptune_image = neptune.Image(
-        name="Morpion Grid",
-        description="A sequence of length " + str(len(sequence)),
-        data=grid_image)
-    ctx.channel_send(channel_name, neptune_image)
+    return grid.get_PILImage(800,800)
+
+def histogram_image(histogram):
+    """Plot histogram as an 800x800 PIL image."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import PIL.Image as Image
 
-def send_histogram(ctx, channel_name, histogram):
     data = copy.copy(histogram)
 
-    while data[-1] == 0:
+    while data and data[-1] == 0:
         data.pop()
 
     x = [i for i in range(0, len(data))]
@@ -52,11 +70,27 @@ def send_histogram(ctx, channel_name, histogram):
     ax = fig.add_subplot(111)
     ax.bar(x, y, label='Histogram')
     fig.canvas.draw()
-    data = fig.canvas.tostring_rgb()
+    data = fig.canvas.buffer_rgba()
+
+    image = Image.frombuffer("RGBA", (800, 800), data, "raw", "RGBA", 0, 1).convert("RGB")
+    plt.close(fig)
+
+    return image
+
+def send_sequence(ctx, channel_name, sequence, variant='5t', board_size=40):
+    from deepsense import neptune
+
+    neptune_image = neptune.Image(
+        name="Morpion Grid",
+        description="A sequence of length " + str(len(sequence)),
+        data=sequence_image(sequence, variant, board_size))
+    ctx.channel_send(channel_name, neptune_image)
 
-    histogram_image = Image.frombuffer("RGB", (800, 800), data, "raw", "RGB", 0, 1)
+def send_histogram(ctx, channel_name, histogram):
+    from deepsense import neptune
 
-    neptune_image = neptune.Image(name="Histogram",description="Histogram",data=histogram_image)
+    neptune_image = neptune.Image(name="Histogram",description="Histogram",
+                                  data=histogram_image(histogram))
 
     ctx.channel_send(channel_name, neptune_image)
 
@@ -64,4 +98,209 @@ def send_tree(ctx, channel_name, tree):
     # tree.render('{0}.png'.format(seq), w=800, units='px')
 
     #ctx.channel_send(channel_name, str(tree))
-    pass
\ No newline at end of file
+    pass
+
+
+class Reporter:
+    """Abstract base class of metric backends."""
+
+    def metric(self, channel, value, timestamp=None):
+        """Report a value of a metric channel at timestamp (now by default)."""
+        raise NotImplementedError
+
+    def sequence(self, channel, sequence):
+        """Report a Morpion sequence."""
+        raise NotImplementedError
+
+    def histogram(self, channel, histogram):
+        """Report a sequence length histogram."""
+        raise NotImplementedError
+
+    def flush(self):
+        """Complete reports sent so far."""
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class NeptuneReporter(Reporter):
+    """Sends reports to channels of a Neptune context. Sequences are moves of variant on a
+    board of board_size."""
+
+    def __init__(self, ctx, variant='5t', board_size=40):
+        self.ctx = ctx
+        self.variant = variant
+        self.board_size = board_size
+
+    def metric(self, channel, value, timestamp=None):
+        self.ctx.channel_send(channel, value)
+
+    def sequence(self, channel, sequence):
+        send_sequence(self.ctx, channel, sequence, self.variant, self.board_size)
+
+    def histogram(self, channel, histogram):
+        send_histogram(self.ctx, channel, histogram)
+
+
+class LocalReporter(Reporter):
+    """Writes reports to files in directory.
+
+    metrics.csv has (time, channel, value) rows, sequences.jsonl and histograms.jsonl have
+    one report per line. With prometheus, metrics.prom has the latest value of every
+    numeric metric in the Prometheus text format (e.g. for the node exporter textfile
+    collector). With images, sequences and histograms are also rendered to PNG files, until
+    rendering fails (e.g. without morpion or matplotlib). Sequences are moves of variant
+    on a board of board_size.
+    """
+
+    def __init__(self, directory='.', prometheus=False, images=False, variant='5t',
+                 board_size=40):
+        self.directory = directory
+        self.variant = variant
+        self.board_size = board_size
+        os.makedirs(directory, exist_ok=True)
+
+        self.metrics_file = open(os.path.join(directory, 'metrics.csv'), 'a', newline='')
+        self.metrics_writer = csv.writer(self.metrics_file)
+        self.prometheus = prometheus
+        self.images = images
+        self.latest = OrderedDict()     # Prometheus metric name -> latest value
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def metric_name(channel):
+        return 'nrpa_' + re.sub(r'[^a-z0-9]+', '_', channel.lower()).strip('_')
+
+    def metric(self, channel, value, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+        self.metrics_writer.writerow(['{0:.3f}'.format(timestamp), channel, value])
+
+        if self.prometheus:
+            try:
+                self.latest[LocalReporter.metric_name(channel)] = float(value)
+            except (TypeError, ValueError):
+                pass
+
+    def append(self, name, report):
+        with open(self.path(name), 'a') as file:
+            file.write(json.dumps(report) + '\n')
+
+    def render(self, name, render, *data):
+        if not self.images:
+            return
+        try:
+            render(*data).save(self.path(name))
+        except Exception as error:
+            logging.warning("Images are not rendered: {0!r}".format(error))
+            self.images = False
+
+    def sequence(self, channel, sequence):
+        self.append('sequences.jsonl', {'time': time.time(), 'channel': channel,
+                                        'length': len(sequence), 'sequence': list(sequence)})
+        self.render('sequence.png', sequence_image, sequence, self.variant, self.board_size)
+
+    def histogram(self, channel, histogram):
+        self.append('histograms.jsonl', {'time': time.time(), 'channel': channel,
+                                         'histogram': list(histogram)})
+        self.render('histogram.png', histogram_image, histogram)
+
+    def flush(self):
+        self.metrics_file.flush()
+
+        if self.prometheus and self.latest:
+            lines = ['{0} {1}'.format(name, value) for name, value in self.latest.items()]
+            temporary = self.path('metrics.prom.tmp')
+            with open(temporary, 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+            os.replace(temporary, self.path('metrics.prom'))
+
+    def close(self):
+        self.flush()
+        self.metrics_file.close()
+
+
+class AsyncReporter(Reporter):
+    """Buffers reports and sends them to reporter from a background thread.
+
+    Metrics are sent in batches every interval seconds, with the time they were reported.
+    Of the sequences and histograms waiting to be sent, only the latest per channel is
+    sent, so slow image rendering or uploads never pile up.
+    """
+
+    def __init__(self, reporter, interval=5.0):
+        self.reporter = reporter
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.latest = OrderedDict()     # (kind, channel) -> latest sequence or histogram
+        self.sent = 0                   # number of flush requests served
+        self.requested = 0
+        self.done = threading.Condition(self.lock)
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def metric(self, channel, value, timestamp=None):
+        with self.lock:
+            self.metrics.append((channel, value,
+                                 timestamp if timestamp is not None else time.time()))
+
+    def sequence(self, channel, sequence):
+        with self.lock:
+            self.latest[('sequence', channel)] = list(sequence)
+
+    def histogram(self, channel, histogram):
+        with self.lock:
+            self.latest[('histogram', channel)] = list(histogram)
+
+    def loop(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+            with self.lock:
+                metrics, self.metrics = self.metrics, []
+                latest, self.latest = self.latest, OrderedDict()
+                requested = self.requested
+                stopping = self.stopping
+
+            try:
+                for channel, value, timestamp in metrics:
+                    self.reporter.metric(channel, value, timestamp)
+                for (kind, channel), data in latest.items():
+                    if kind == 'sequence':
+                        self.reporter.sequence(channel, data)
+                    else:
+                        self.reporter.histogram(channel, data)
+                self.reporter.flush()
+            except Exception:
+                logging.exception("Reporting failed.")
+
+            with self.lock:
+                self.sent = requested
+                self.done.notify_all()
+
+            if stopping:
+                return
+
+    def flush(self):
+        """Wait until the reports sent so far are sent to reporter."""
+        with self.lock:
+            self.requested += 1
+            requested = self.requested
+            self.wakeup.set()
+            while self.sent < requested and self.thread.is_alive():
+                self.done.wait(1.0)
+
+    def close(self):
+        with self.lock:
+            self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        self.reporter.close()
@@ -7,34 +7,60 @@ import numpy as np
 import ete3
 import copy
 import policy
-from collections import deque
+from policy import board_geometry
+from collections import OrderedDict, deque
+
+
+class MoveSequence(tuple):
+    """Sequence of moves in the rollout tree, with its set of moves computed on first use.
+
+    A sequence is created once per atomic result and shared by every rollout that holds it
+    as its best or adapt sequence, so its set of moves is computed at most once. The set is
+    kept by the sequence itself, not in a shared cache, so comparisons in several threads
+    need no lock: at worst two threads compute the same set.
+    """
+
+    def moves(self):
+        """Set of moves of the sequence."""
+        try:
+            return self._moves
+        except AttributeError:
+            self._moves = frozenset(self)
+            return self._moves
+
+    def __reduce__(self):
+        # The set of moves is not pickled
+        return (MoveSequence, (tuple(self),))
 
 
 class SequenceComparator:
-    """Comparator for Morpion sequences."""
+    """Comparator for Morpion sequences.
+
+    Sequences are compared by their move sets, which MoveSequences of the rollout tree
+    compute once.
+    """
+
+    @staticmethod
+    def fingerprint(sequence):
+        """Set of moves of sequence."""
 
-    iter = 1
-    set = np.zeros((10000,), dtype=int)
+        if isinstance(sequence, MoveSequence):
+            return sequence.moves()
+        return frozenset(sequence)
 
     @staticmethod
     def is_equal(left, right):
-        """Fuzzy equality test."""
+        """Fuzzy equality test: at most 30% of moves of right are not in left."""
 
         if len(left) != len(right):
             return False
-        SequenceComparator.iter += 1
+        if left is right or left == right:
+            return True
 
-        for i in left:
-            SequenceComparator.set[i] = SequenceComparator.iter
+        moves = SequenceComparator.fingerprint(left)
+        diffs = len(right) - sum(map(moves.__contains__, right))
 
-        diffs = 0
-        for i in right:
-            if SequenceComparator.set[i] != SequenceComparator.iter:
-                diffs += 1
-                if diffs > len(left) * 0.3:
-                    return False
-
-        return True
+        return diffs <= len(left) * 0.3
 
     @staticmethod
     def is_right_better(left, right):
@@ -43,8 +69,31 @@ class SequenceComparator:
                                           and not SequenceComparator.is_equal(left, right))
 
 
+class RolloutObserver:
+    """Base class of objects notified about changes of the rollout tree (RootRollout.observers)."""
+
+    def node_added(self, node):
+        """node was added to the active pool of its parent."""
+
+    def node_completed(self, node):
+        """node became completed."""
+
+    def node_discarded(self, node):
+        """node was discarded, either itself or with a discarded ancestor."""
+
+    def node_rejected(self, node):
+        """node is about to be discarded because its adapt sequence is not the sequence its
+        parent predicts any more."""
+
+    def node_retired(self, node):
+        """Completed node left the active pool of its parent, so its adapt sequence held."""
+
+
 class Rollout:
-    """Abstract base class for RootRollout, ParallelRollout and AtomicRollout."""
+    """Abstract base class for RootRollout, ParallelRollout and AtomicRollout.
+
+    Best and adapt sequences are tuples, shared by the nodes they are passed to.
+    """
 
     class State(enum.Enum):
         """State of a rollout."""
@@ -58,8 +107,9 @@ class Rollout:
         self.sibling = None
         self.parent = None
         self.adapt_sequence = None
-        self.best_sequence = []
+        self.best_sequence = ()
         self.policy = None
+        self.policy_id = None
         self.dirty = False
         self.root = None
         self.depth = None
@@ -72,22 +122,55 @@ class Rollout:
             node.dirty = True
             node = node.parent
 
+    @property
+    def policy(self):
+        """Policy of the rollout, materialized from policy_base on first use."""
+
+        if self.materialized_policy is None and self.policy_base is not None:
+            base = self.policy_base.policy
+            if self.adapt_sequence:
+                base = copy.copy(base)
+                base.adapt(self.adapt_sequence)
+            self.root.stats['materialized_policies'] += 1
+
+            # Policies never change, so the base is not needed any more
+            self.materialized_policy = base
+            self.policy_base = None
+
+        return self.materialized_policy
+
+    @policy.setter
+    def policy(self, value):
+        self.materialized_policy = value
+        self.policy_base = None
+
     def adapt(self):
-        """Adapt policy of sibling with parent's predicted best sequence."""
+        """Adapt policy of sibling with parent's predicted best sequence.
+
+        Policies are computed lazily: the rollout keeps the rollout its policy is adapted
+        from (policy_base), and the policy is materialized when the rollout is dispatched
+        or when a rollout adapted from it is materialized. Speculative rollouts that are
+        discarded before that never compute their policies.
+        """
 
         if self.parent is None:
             # We are the root node
-            self.policy = policy.WeightPolicy()
-            self.adapt_sequence = []
+            self.policy = policy.WeightPolicy(self.variant, self.board_size,
+                                              self.canonical_moves)
+            self.policy_id = 0
+            self.adapt_sequence = ()
         else:
             if self.sibling is None:
-                # First node in a rollout copies parent policy
-                self.adapt_sequence = []
-                self.policy = copy.copy(self.parent.policy)
+                # First node in a rollout shares parent policy
+                self.adapt_sequence = ()
+                self.policy_base = self.parent
+                self.policy_id = self.parent.policy_id
             else:
-                self.adapt_sequence = copy.copy(self.parent.predicted_best_sequence())
-                self.policy = copy.copy(self.sibling.policy)
-                self.policy.adapt(self.adapt_sequence)
+                self.adapt_sequence = self.parent.predicted_best_sequence()
+                self.policy_base = self.sibling
+                self.policy_id = self.root.new_policy_id()
+                self.root.record_lineage(self.policy_id, self.sibling.policy_id,
+                                         self.adapt_sequence)
 
     def update(self) -> None:
         """Update rollout tree and clear dirty bits."""
@@ -114,7 +197,9 @@ class ParallelRollout(Rollout):
         for rout in self.active_pool:
             rout.discard()
 
+        self.root.node_discarded(self)
         del self.parent
+        self.policy = None
 
     def predicted_best_sequence(self):
         """Predicted best sequence if rollouts completed in future will be validated."""
@@ -124,7 +209,7 @@ class ParallelRollout(Rollout):
             if SequenceComparator.is_right_better(sequence, node_sequence):
                 sequence = node_sequence
 
-        return copy.copy(sequence)
+        return sequence
 
     def tree(self) -> ete3.Tree:
         """Create ete3.Tree representing rollout structure."""
@@ -151,7 +236,7 @@ class ParallelRollout(Rollout):
         self.state = Rollout.State.pending
         self.parent = parent
         self.node_id = node_id
-        self.best_sequence = []
+        self.best_sequence = ()
         self.completed_nodes = 0
 
         depth = 0
@@ -182,32 +267,49 @@ class ParallelRollout(Rollout):
             rollout = AtomicRollout(parent=self, node_id=node_id)
         else:
             rollout = ParallelRollout(parent=self, node_id=node_id)
-            rollout.add_pending_nodes()
 
         self.active_pool.append(rollout)
+        self.root.node_added(rollout)
+
+        if not rollout.is_atomic():
+            rollout.add_pending_nodes()
+
         return True
 
+    def find_dirty_node(self):
+        """Return the first dirty child and the node after it."""
+
+        children_iterator = iter(self.active_pool)
+        for node in children_iterator:
+            if node.dirty:
+                return node, next(children_iterator, None)
+
+        return None, None
+
     def update(self):
-        """Update rollout structure after computation result was posted."""
+        """Update rollout structure after computation results were posted.
+
+        Dirty children are updated one by one, so results of several computations
+        can be recorded before a single update.
+        """
 
         if not self.dirty:
             return
 
-        # Find the dirty node and the next node
-        dirty_node = None
-        next_node = None
-        children_iterator = iter(self.active_pool)
-        for node in children_iterator:
-            if node.dirty:
-                dirty_node = node
-                next_node = next(children_iterator, None)
-                break
+        dirty_node, next_node = self.find_dirty_node()
 
         if dirty_node is None:
             # dirty_node was discarded
             self.dirty = False
             return
 
+        while dirty_node is not None:
+            self.update_dirty_node(dirty_node, next_node)
+            dirty_node, next_node = self.find_dirty_node()
+
+    def update_dirty_node(self, dirty_node, next_node):
+        """Update a dirty child, discard inconsistent children after it and update state."""
+
         # Update the dirty node
         dirty_node.update()
 
@@ -215,8 +317,10 @@ class ParallelRollout(Rollout):
         if next_node is not None:
             if SequenceComparator.is_right_better(next_node.adapt_sequence,
                                                   dirty_node.predicted_best_sequence()):
-                while not self.active_pool[-1].dirty:
-                    self.active_pool.pop().discard()
+                while self.active_pool[-1] is not dirty_node:
+                    node = self.active_pool.pop()
+                    self.root.node_rejected(node)
+                    node.discard()
 
         # Update our best sequence, starting with next_node sequence
         found_dirty = False
@@ -225,7 +329,7 @@ class ParallelRollout(Rollout):
                 found_dirty = True
             if found_dirty:
                 if SequenceComparator.is_right_better(self.best_sequence, node.best_sequence):
-                    self.best_sequence = copy.copy(node.best_sequence)
+                    self.best_sequence = node.best_sequence
             if node.state != Rollout.State.completed:
                 break
 
@@ -249,13 +353,15 @@ class ParallelRollout(Rollout):
         elif has_pending:
             self.state = Rollout.State.pending
         else:
-            self.state = Rollout.State.completed
+            if self.state != Rollout.State.completed:
+                self.state = Rollout.State.completed
+                self.root.node_completed(self)
 
             assert len(self.active_pool) + self.completed_nodes == self.root.iterations
 
         # Delete completed nodes
         while len(self.active_pool) > 1 and self.active_pool[0].state == Rollout.State.completed:
-            self.active_pool.popleft()
+            self.root.node_retired(self.active_pool.popleft())
             self.completed_nodes += 1
 
         if len(self.active_pool) > 0:
@@ -268,15 +374,36 @@ class ParallelRollout(Rollout):
 class RootRollout(ParallelRollout):
     """RootRollout stores metadata and computation statistics."""
 
+    LINEAGE_SIZE = 1 << 14  #: Number of recent policies whose lineage is kept
+
     def discard(self):
         # root rollout should never be discarded
         assert False
 
     def __init__(self, random_seed=1, parallel_levels=2, atomic_levels=2,
-                 iterations=100, alpha=1.0):
+                 iterations=100, alpha=1.0, batch_size=1, policy=None, policy_id=0,
+                 variant='5t', board_size=None, canonical_moves=False):
+        """Each atomic rollout runs batch_size independent searches (with different
+        seeds) and keeps the best sequence.
+
+        The search starts from policy (all zero weights if None) with id policy_id; new
+        policies get the following ids. Without a policy, the game is given by variant and
+        board_size, and the weights by canonical_moves (see policy.WeightPolicy).
+        """
+
+        if policy is not None:
+            variant, board_size = policy.variant, policy.board_size
+            canonical_moves = policy.canonical_moves
+        # The default board size of the variant
+        self.variant, self.board_size = board_geometry(variant, board_size)
+        self.canonical_moves = canonical_moves
 
         super().__init__(None, 0)
 
+        if policy is not None:
+            self.policy = policy
+        self.policy_id = policy_id
+
         self.discarded_pool = []
 
         self.node_id = 0
@@ -288,6 +415,20 @@ class RootRollout(ParallelRollout):
         self.parallel_levels = parallel_levels
         self.atomic_levels = atomic_levels
         self.alpha = alpha
+        self.batch_size = batch_size
+
+        # Policy ids identify policies in worker caches
+        self.last_policy_id = policy_id
+
+        # Lineage of recent policies: policy id -> (id of the policy it was adapted from,
+        # adapt sequence), or None for the all-zero policy. Workers can rebuild a policy
+        # from a cached ancestor with the adapt sequences (see policy_cache).
+        self.policy_lineage = OrderedDict()
+        if policy is None:
+            self.policy_lineage[policy_id] = None
+
+        # RolloutObservers notified about changes of the tree (e.g. selectors)
+        self.observers = []
 
         # Statistics initialization
         self.stats = dict()
@@ -297,12 +438,27 @@ class RootRollout(ParallelRollout):
         self.stats["sequences"] = 0
         self.stats['computation_time'] = 0
 
+        # Jobs of discarded rollouts stopped early, and their estimated remaining time
+        self.stats['cancelled_jobs'] = 0
+        self.stats['cancelled_time_saved'] = 0.0
+
         self.stats['completed_atomic'] = 0
         self.stats['discarded_atomic'] = 0
 
-        # Initialization of random seeds for atomic rollouts
+        # Policies of rollouts computed so far (see Rollout.adapt)
+        self.stats['materialized_policies'] = 0
+
+        # Histogram of sequence lengths of all atomic searches
+        self.stats['histogram'] = []
+
+        self.init_seeds()
+
+    def init_seeds(self):
+        """Initialize random seeds for atomic rollouts (batch_size per rollout) from
+        random_seed. Checkpoints do not save the seeds (see checkpoint.load)."""
         np.random.seed(self.random_seed)
-        self.seeds = np.random.randint(1, 1000000000, self.iterations ** self.parallel_levels)
+        self.seeds = np.random.randint(1, 1000000000,
+                                       self.iterations ** self.parallel_levels * self.batch_size)
 
     def update(self):
         super().update()
@@ -310,11 +466,55 @@ class RootRollout(ParallelRollout):
         # Dirty state is cleared by parent, unless we are the root node
         self.dirty = False
 
+    def node_added(self, node):
+        for observer in self.observers:
+            observer.node_added(node)
+
+    def node_completed(self, node):
+        for observer in self.observers:
+            observer.node_completed(node)
+
+    def node_discarded(self, node):
+        for observer in self.observers:
+            observer.node_discarded(node)
+
+    def node_rejected(self, node):
+        for observer in self.observers:
+            observer.node_rejected(node)
+
+    def node_retired(self, node):
+        for observer in self.observers:
+            observer.node_retired(node)
+
+    def new_policy_id(self):
+        self.last_policy_id += 1
+        return self.last_policy_id
+
+    def record_lineage(self, policy_id, base_id, sequence):
+        self.policy_lineage[policy_id] = (base_id, sequence)
+        if len(self.policy_lineage) > RootRollout.LINEAGE_SIZE:
+            self.policy_lineage.popitem(last=False)
+
     def atomic_random_seed(self, n):
         """Retrieve deterministic random seed for an atomic node."""
-        assert n < self.seeds.shape[0]
+        assert n * self.batch_size < self.seeds.shape[0]
+
+        return self.seeds[n * self.batch_size]
+
+    def atomic_random_seeds(self, n):
+        """Retrieve deterministic random seeds for the searches of an atomic node."""
+        assert (n + 1) * self.batch_size <= self.seeds.shape[0]
 
-        return self.seeds[n]
+        return [int(seed) for seed in self.seeds[n * self.batch_size:(n + 1) * self.batch_size]]
+
+    def record_histogram(self, histogram):
+        """Add sequence length histogram of an atomic computation."""
+        total = self.stats['histogram']
+        if len(total) < len(histogram):
+            total.extend([0] * (len(histogram) - len(total)))
+
+        for length, count in enumerate(histogram):
+            total[length] += count
 
     # Statistics
 
@@ -345,10 +545,10 @@ class RootRollout(ParallelRollout):
 
     def completed_sequences(self):
         return (self.stats['completed_atomic'] - self.stats['discarded_atomic']) * \
-               (self.iterations ** self.atomic_levels)
+               (self.iterations ** self.atomic_levels) * self.batch_size
 
     def total_expected_sequences(self):
-        return self.iterations ** (self.parallel_levels + self.atomic_levels)
+        return self.iterations ** (self.parallel_levels + self.atomic_levels) * self.batch_size
 
     def progress(self):
         if self.stats['sequences'] == 0:
@@ -378,7 +578,9 @@ class AtomicRollout(Rollout):
         self.computation_time = 0.0
 
     def discard(self):
+        self.root.node_discarded(self)
         self.parent = None
+        self.policy = None
 
         assert self not in self.root.discarded_pool
 
@@ -418,17 +620,24 @@ class AtomicRollout(Rollout):
         return {'source': self,
                 'iterations': self.root.iterations,
                 'levels': self.root.atomic_levels,
-                'batch_size': 1,
+                'batch_size': self.root.batch_size,
                 'alpha': self.root.alpha,
                 'random_seed': self.root.atomic_random_seed(self.node_id),
-                'weights': self.policy}
+                'random_seeds': self.root.atomic_random_seeds(self.node_id),
+                'weights': self.policy,
+                'policy_id': self.policy_id,
+                'variant': self.root.variant,
+                'board_size': self.root.board_size,
+                'canonical_moves': self.root.canonical_moves}
 
     def record_computation_result(self, result):
         assert self.state == Rollout.State.running
 
         self.state = Rollout.State.completed
+        if self.parent is not None:
+            self.root.node_completed(self)
         self.mark_as_dirty()
-        self.best_sequence = copy.copy(result['best_sequence'])
+        self.best_sequence = MoveSequence(result['best_sequence'])
         self.atomic_random_seed = result['random_seed']
 
         self.root.stats['completed_atomic'] += 1
@@ -2,6 +2,10 @@
 Heuristics for selecting a pending rollout for computation.
 """
 
+import bisect
+import logging
+from collections import defaultdict
+
 import rollout
 
 class Selector:
@@ -28,6 +32,18 @@ class DFSSelector(Selector):
         return None
 
 class ProbabilitySelector(Selector):
+    """Selects the pending atomic rollout whose policy is least likely to change.
+
+    Rollouts are not selected if that probability is at least max_probability, which
+    leaves workers idle rather than compute rollouts that are likely to be discarded.
+    Sequence change probabilities are sequence_change_probability, or estimates of a
+    ChangeProbabilityEstimator.
+    """
+
+    def __init__(self, estimator=None):
+        super().__init__()
+        self.estimator = estimator
+
     @staticmethod
     def sequence_change_probability(length):
         if length >= 150:
@@ -42,40 +58,271 @@ class ProbabilitySelector(Selector):
             return 0.95
         return 1.0
 
-    @staticmethod
-    def policy_change_probability(node, parent_change_probability):
-        if node.state == rollout.Rollout.State.completed:
-            return (None, 1.0)
+    def change_probability(self, node):
+        """Probability that the adapt sequence of node changes."""
+        if self.estimator is None:
+            return ProbabilitySelector.sequence_change_probability(len(node.adapt_sequence))
+        return self.estimator.probability(node.parent.depth + 1, len(node.adapt_sequence))
 
-        my_prob = 1.0 - parent_change_probability
+    def sibling_factor(self, node, older_siblings):
+        """Probability that none of the adapt sequences of the older_siblings incomplete
+        siblings before node changes, each with the change probability of node."""
+        keep = 1.0
+        for _ in range(older_siblings):
+            keep = keep * (1.0 - self.change_probability(node))
+        return keep
 
+    def keep_probability(self, node):
+        """Return the pending atomic rollout in the subtree of node whose policy is least
+        likely to change, and the probability that it does not change, relative to the
+        parent of node: the product of the sibling factors of nodes on the path from node.
+
+        The policy of a rollout changes if the adapt sequence of an incomplete older sibling
+        of the rollout or of any of its ancestors changes.
+        """
+        if node.state == rollout.Rollout.State.completed:
+            return (None, 0.0)
+
+        older_siblings = 0
         sibling = node.sibling
         while sibling is not None:
             if sibling.state != rollout.Rollout.State.completed:
-                my_prob = my_prob * (1.0 - ProbabilitySelector.sequence_change_probability(len(node.adapt_sequence)))
+                older_siblings += 1
             sibling = sibling.sibling
+        factor = self.sibling_factor(node, older_siblings)
 
         if node.is_atomic():
             if node.state == rollout.Rollout.State.pending:
-                return (node, 1.0 - my_prob)
-            else:
-                return (None, 1.0)
-        else:
-            best_prob = 1.0
-            best_child = None
-            for child in node.active_pool:
-                child_node, child_prob = ProbabilitySelector.policy_change_probability(child, 1.0-my_prob)
+                return (node, factor)
+            return (None, 0.0)
 
-                if child_prob < best_prob:
-                    best_prob = child_prob
-                    best_child = child_node
+        best_keep = 0.0
+        best_child = None
+        for child in node.active_pool:
+            child_node, child_keep = self.keep_probability(child)
 
-            return (best_child, best_prob)
+            if child_keep > best_keep:
+                best_keep = child_keep
+                best_child = child_node
 
-    def select(self, rout):
-        node, prob = ProbabilitySelector.policy_change_probability(rout, 0.0)
+        return (best_child, factor * best_keep)
+
+    def observe(self, root):
+        """Feed the estimator with changes of the tree of root."""
+        if self.estimator is not None and self.estimator not in root.observers:
+            root.observers.append(self.estimator)
+
+    def select(self, rout, max_probability=1.0):
+        self.observe(rout)
+
+        node, keep = self.keep_probability(rout)
 
         if node is None:
-            print("Selector found no node.")
+            logging.debug("Selector found no node.")
+        elif 1.0 - keep >= max_probability:
+            return None
+
+        return node
+
+class ChangeProbabilityEstimator(rollout.RolloutObserver):
+    """Online estimates of sequence change probabilities per depth and adapt sequence length.
+
+    A speculative rollout (not the first child) counts as changed when it is rejected and
+    as kept when it retires. Lengths are bucketed by the thresholds of
+    ProbabilitySelector.sequence_change_probability, which is the prior mean of a Beta prior
+    worth prior_weight observations. Estimates change only every refresh_interval
+    observations, when version is incremented, so that selectors can cache them.
+    """
+
+    LENGTHS = [64, 80, 120, 140, 150]
+
+    def __init__(self, prior_weight=10.0, refresh_interval=64):
+        self.prior_weight = prior_weight
+        self.refresh_interval = refresh_interval
+        self.changed = defaultdict(int)     # (depth, bucket) -> rejected rollouts
+        self.kept = defaultdict(int)        # (depth, bucket) -> retired rollouts
+        self.observations = 0
+        self.version = 0
+        self.estimates = dict()
+
+    def bucket(self, length):
+        return bisect.bisect_right(ChangeProbabilityEstimator.LENGTHS, length)
+
+    def probability(self, depth, length):
+        key = (depth, self.bucket(length))
+        if key not in self.estimates:
+            prior = ProbabilitySelector.sequence_change_probability(length)
+            changed = self.changed[key]
+            observed = changed + self.kept[key]
+            self.estimates[key] = prior if observed == 0 else \
+                (prior * self.prior_weight + changed) / (self.prior_weight + observed)
+        return self.estimates[key]
+
+    def observe(self, node, changed):
+        if node.node_id % node.root.iterations == 0:
+            return
+
+        key = (node.parent.depth + 1, self.bucket(len(node.adapt_sequence)))
+        if changed:
+            self.changed[key] += 1
+        else:
+            self.kept[key] += 1
+
+        self.observations += 1
+        if self.observations % self.refresh_interval == 0:
+            self.estimates = dict()
+            self.version += 1
+
+    def node_rejected(self, node):
+        self.observe(node, True)
+
+    def node_retired(self, node):
+        self.observe(node, False)
+
+    def table(self):
+        """Current estimates as {depth: [probability per length bucket]}."""
+        depths = sorted(set(depth for depth, _ in list(self.changed) + list(self.kept)))
+        lengths = [0] + ChangeProbabilityEstimator.LENGTHS
+        return dict((depth, [self.probability(depth, length) for length in lengths])
+                    for depth in depths)
+
+class IncrementalProbabilitySelector(ProbabilitySelector, rollout.RolloutObserver):
+    """Selects the same rollouts as ProbabilitySelector, updating only the affected paths.
+
+    Every node of the rollout tree keeps its sibling factor and the best pending atomic
+    rollout of its subtree with its keep probability (ProbabilitySelector.keep_probability),
+    which is the sibling factor of the node times the best keep probability of its
+    children. The selector observes the rollout tree (RootRollout.observers): a change of a
+    node recomputes the nodes on the path from its parent to the root, and a completed
+    rollout also the sibling factors of its younger siblings. Selection reads the best
+    rollout of the root. Dispatched rollouts are removed lazily, when they are selected.
+    """
+
+    def __init__(self, estimator=None):
+        super().__init__(estimator)
+        self.root = None
+        self.version = None     # estimator version of the probabilities
+        self.factors = dict()   # node -> its sibling factor
+        self.best = dict()      # node -> (best pending atomic rollout of its subtree, keep)
+
+    def attach(self, root):
+        if self.root is not None:
+            self.root.observers.remove(self)
+
+        self.root = root
+        self.root.observers.append(self)
+        self.observe(root)
+        self.version = self.estimator.version if self.estimator is not None else None
+
+        self.factors = dict()
+        self.best = dict()
+        self.factors[root] = 1.0
+        self.build(root)
+
+    def build(self, node):
+        """Compute sibling factors and best rollouts of the subtree of node."""
+        older_siblings = 0
+        for child in node.active_pool:
+            self.factors[child] = self.sibling_factor(child, older_siblings)
+            if child.is_atomic():
+                self.best[child] = self.subtree_best(child)
+            else:
+                self.build(child)
+            if child.state != rollout.Rollout.State.completed:
+                older_siblings += 1
+        self.best[node] = self.subtree_best(node)
+
+    def subtree_best(self, node):
+        """Best rollout of the subtree of node, from the best rollouts of its children.
+
+        The arithmetic is that of keep_probability, so probabilities are equal.
+        """
+        if node.state == rollout.Rollout.State.completed:
+            return (None, 0.0)
+
+        if node.is_atomic():
+            if node.state == rollout.Rollout.State.pending:
+                return (node, self.factors[node])
+            return (None, 0.0)
+
+        best_keep = 0.0
+        best_child = None
+        for child in node.active_pool:
+            child_node, child_keep = self.best.get(child, (None, 0.0))
+
+            if child_keep > best_keep:
+                best_keep = child_keep
+                best_child = child_node
+
+        return (best_child, self.factors[node] * best_keep)
+
+    def refresh(self, node):
+        """Recompute best rollouts of node and its ancestors."""
+        while node is not None:
+            self.best[node] = self.subtree_best(node)
+            node = node.parent
+
+    # Rollout tree observer
+
+    def node_added(self, node):
+        parent = node.parent
+        if parent not in self.best:
+            return
+
+        older_siblings = sum(1 for child in parent.active_pool
+                             if child is not node and
+                             child.state != rollout.Rollout.State.completed)
+        self.factors[node] = self.sibling_factor(node, older_siblings)
+        self.best[node] = self.subtree_best(node)
+        self.refresh(parent)
+
+    def node_completed(self, node):
+        # Completed nodes have no pending rollouts (see subtree_best)
+        self.factors.pop(node, None)
+        self.best.pop(node, None)
+
+        # Younger siblings have one incomplete sibling less
+        parent = node.parent
+        if parent not in self.best:
+            return
+
+        older_siblings = 0
+        younger = False
+        for child in parent.active_pool:
+            if younger and child in self.factors:
+                self.factors[child] = self.sibling_factor(child, older_siblings)
+                self.best[child] = self.subtree_best(child)
+            if child is node:
+                younger = True
+            elif child.state != rollout.Rollout.State.completed:
+                older_siblings += 1
+        self.refresh(parent)
+
+    def node_rejected(self, node):
+        # The youngest child left the active pool of its parent
+        if node.parent in self.best:
+            self.refresh(node.parent)
+
+    def node_discarded(self, node):
+        self.factors.pop(node, None)
+        self.best.pop(node, None)
+
+    def select(self, rout, max_probability=1.0):
+        # All probabilities change with new estimates
+        if rout is not self.root or \
+                (self.estimator is not None and self.estimator.version != self.version):
+            self.attach(rout)
+
+        while True:
+            # Completed rollouts, the root too, have no entries
+            node, keep = self.best.get(rout, (None, 0.0))
+            if node is None:
+                logging.debug("Selector found no node.")
+                return None
+
+            if node.state == rollout.Rollout.State.pending:
+                return node if 1.0 - keep < max_probability else None
 
-        return node
\ No newline at end of file
+            # Dispatched since it was selected
+            self.best[node] = (None, 0.0)
+            self.refresh(node.parent)
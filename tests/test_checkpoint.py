@@ -0,0 +1,122 @@
+"""
+Checkpoints of rollout trees (checkpoint.py).
+"""
+
+import pickle
+
+import numpy as np
+import pytest
+
+import checkpoint
+import nrpa
+import rollout
+import selector
+
+
+def tree_nodes(root):
+    """Map node id -> rollout for the rollouts in the active pools of the tree."""
+    nodes = dict()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes[node.node_id] = node
+        stack.extend(node.active_pool)
+    return nodes
+
+
+def dispatch(node):
+    job = node.get_computation_metadata()
+    node.state = rollout.Rollout.State.running
+    node.mark_as_dirty()
+    node.root.update()
+    return job
+
+
+def test_round_trip(tmp_path):
+    root = rollout.RootRollout(random_seed=2, parallel_levels=3, atomic_levels=0,
+                               iterations=6)
+    root.add_pending_nodes()
+    node_selector = selector.ProbabilitySelector()
+    checkpointer = checkpoint.Checkpointer(str(tmp_path))
+
+    jobs = []
+    for step in range(40):
+        node = node_selector.select(root)
+        if node is not None:
+            jobs.append(dispatch(node))
+        if len(jobs) > 3 or (node is None and jobs):
+            job = jobs.pop(0)
+            job.pop('source').record_computation_result(nrpa.NRPA().run(job))
+            root.update()
+        if step % 10 == 0:
+            checkpointer.save(root, wait=True)
+    checkpointer.save(root, wait=True)
+
+    loaded = checkpoint.load(str(tmp_path))
+
+    before = tree_nodes(root)
+    after = tree_nodes(loaded)
+    assert before.keys() == after.keys()
+    for node_id, node in before.items():
+        assert np.array_equal(node.policy.to_array(), after[node_id].policy.to_array())
+        assert node.best_sequence == after[node_id].best_sequence
+        assert node.completed_nodes == after[node_id].completed_nodes
+        # Running rollouts are computed again
+        assert node.state == after[node_id].state or \
+            (node.state == rollout.Rollout.State.running and
+             after[node_id].state == rollout.Rollout.State.pending)
+        assert after[node_id].root is loaded
+
+    # Seeds and the lineage of policies are not saved
+    assert np.array_equal(root.seeds, loaded.seeds)
+    assert len(loaded.policy_lineage) == 0
+    assert loaded.stats == root.stats
+
+
+def test_deep_tree(tmp_path):
+    """Trees deeper than the recursion limit of pickle along parent links."""
+    levels = 300
+    root = rollout.RootRollout(random_seed=2, parallel_levels=levels, atomic_levels=0,
+                               iterations=1)
+    root.add_pending_nodes()
+
+    checkpoint.Checkpointer(str(tmp_path)).save(root, wait=True)
+    loaded = checkpoint.load(str(tmp_path))
+
+    node, original = loaded, root
+    for _ in range(levels):
+        assert len(node.active_pool) == 1
+        child = node.active_pool[0]
+        assert child.parent is node and child.root is loaded
+        assert child.depth == original.active_pool[0].depth
+        node, original = child, original.active_pool[0]
+    assert node.is_atomic() and node.state == rollout.Rollout.State.pending
+
+
+def test_parameters(tmp_path):
+    """Only experiments with the parameters of a checkpoint resume from it."""
+    root = rollout.RootRollout(random_seed=2, parallel_levels=2, atomic_levels=0,
+                               iterations=4)
+    root.add_pending_nodes()
+    checkpoint.Checkpointer(str(tmp_path)).save(root, wait=True)
+
+    parameters = checkpoint.tree_parameters(root)
+    assert checkpoint.load(str(tmp_path), parameters) is not None
+
+    for name, value in (('iterations', 5), ('variant', '5d'), ('board_size', 32)):
+        with pytest.raises(ValueError, match=name):
+            checkpoint.load(str(tmp_path), dict(parameters, **{name: value}))
+
+
+def test_other_formats(tmp_path):
+    # Checkpoints of format 1 pickled the tree recursively after a header without format
+    with open(str(tmp_path / checkpoint.TREE_FILE), 'wb') as file:
+        file.write(pickle.dumps({'store': checkpoint.STORE_FILE.format(0)}) +
+                   pickle.dumps(rollout.RootRollout()))
+    with pytest.raises(ValueError, match='format 1'):
+        checkpoint.load(str(tmp_path))
+
+    with open(str(tmp_path / checkpoint.TREE_FILE), 'wb') as file:
+        file.write(b'not a pickle')
+    with pytest.raises(ValueError, match='Cannot read'):
+        checkpoint.load(str(tmp_path))
@@ -0,0 +1,84 @@
+"""
+Move numbers and move generation of the C++ engine (morpiongame.cpp).
+"""
+
+import numpy as np
+import pytest
+
+import nrpa
+import policy
+
+# Directions of moves (see morpion.Game.dir): e, se, s, sw
+DIRECTIONS = [(1, 0), (1, 1), (0, 1), (-1, 1)]
+
+
+def first_moves(variant):
+    """Legal moves of the initial position, the first moves of level 0 searches."""
+    moves = set()
+    for seed in range(1, 300):
+        result = nrpa.NRPA().run({'batch_size': 1, 'levels': 0, 'iterations': 1,
+                                  'alpha': 1.0, 'random_seed': seed, 'variant': variant,
+                                  'weights': policy.WeightPolicy(variant)})
+        moves.add(result['best_sequence'][0])
+    return sorted(moves)
+
+
+def rotated(move, size):
+    """Image of move on the size x size board under the rotation by 90 degrees about the
+    centre of the cross (moves are numbered as by morpion.Game.on_board)."""
+    reference = (size - 3) // 2
+    centre = 2 * reference + 3
+
+    # Doubled coordinates of the ends of the line, relative to the centre
+    x, y = move // 4 % size, move // 4 // size
+    dx, dy = DIRECTIONS[move % 4]
+    ends = [(2 * x - centre, 2 * y - centre),
+            (2 * (x + 4 * dx) - centre, 2 * (y + 4 * dy) - centre)]
+    (ax, ay), (bx, by) = [(-ey, ex) for ex, ey in ends]
+
+    # The image starts at the end from which it runs in one of the directions
+    step = ((bx - ax) // 8, (by - ay) // 8)
+    if step not in DIRECTIONS:
+        ax, ay = bx, by
+        step = (-step[0], -step[1])
+
+    return ((ax + centre) // 2 + (ay + centre) // 2 * size) * 4 + DIRECTIONS.index(step)
+
+
+@pytest.mark.parametrize('variant, board_size, count', [('5t', 40, 434), ('5d', 32, 230)])
+def test_weight_counts(variant, board_size, count):
+    assert policy.weight_count(variant, board_size) == 4 * board_size * board_size
+    assert policy.weight_count(variant, board_size, canonical_moves=True) == count
+
+
+@pytest.mark.parametrize('variant', ['5t', '5d'])
+def test_canonical_images(variant):
+    """Images of a first move share its canonical number, so adapting a policy to either
+    move gives the same weights."""
+    size = policy.board_geometry(variant)[1]
+    moves = first_moves(variant)
+    assert sorted(rotated(move, size) for move in moves) == moves
+
+    for move in moves:
+        image = rotated(move, size)
+        weights = dict()
+        for canonical_moves in (False, True):
+            for played in (move, image):
+                adapted = policy.WeightPolicy(variant, canonical_moves=canonical_moves)
+                adapted.adapt([played])
+                weights[canonical_moves, played] = adapted.to_array()
+
+        assert not np.array_equal(weights[False, move], weights[False, image])
+        assert np.array_equal(weights[True, move], weights[True, image])
+
+
+@pytest.mark.parametrize('variant, board_size', [('5t', 40), ('5t', 24), ('5d', 32)])
+def test_reference_make_move(variant, board_size):
+    """MakeMove with neighbourhood tables produces the positions of ReferenceMakeMove."""
+    fast = nrpa.benchmark_moves(games=200, variant=variant, board_size=board_size)
+    reference = nrpa.benchmark_moves(games=200, variant=variant, board_size=board_size,
+                                     reference=True)
+
+    assert fast['moves'] == reference['moves'] > 0
+    assert fast['checksum'] == reference['checksum']
+
@@ -0,0 +1,40 @@
+"""
+NRPA searches of the C++ engine (nrpa.pyx).
+"""
+
+import pytest
+
+import nrpa
+import policy
+
+
+def payload(**keys):
+    job = {'batch_size': 2, 'levels': 1, 'iterations': 10, 'alpha': 1.0, 'random_seed': 7,
+           'weights': policy.WeightPolicy(keys.get('variant', '5t'), keys.get('board_size'))}
+    job.update(keys)
+    return job
+
+
+@pytest.mark.parametrize('kernel', sorted(nrpa.KERNELS))
+@pytest.mark.parametrize('variant', ['5t', '5d'])
+def test_journal(kernel, variant):
+    """Positions reset by the undo journal are those reset by copies of the root."""
+    job = payload(levels=2, iterations=5, variant=variant, kernel=nrpa.KERNELS[kernel])
+    copied = nrpa.NRPA().run(dict(job, journal=False))
+    journaled = nrpa.NRPA().run(dict(job, journal=True))
+
+    assert journaled['best_sequence'] == copied['best_sequence']
+    assert journaled['histogram'] == copied['histogram']
+    assert journaled['moves'] == copied['moves']
+    assert 0 < journaled['reset_bytes'] < copied['reset_bytes']
+
+
+def test_cancel():
+    """A cancel before run() cancels that run only."""
+    search = nrpa.NRPA()
+    search.cancel()
+    assert search.run(payload())['cancelled']
+
+    result = search.run(payload())
+    assert not result['cancelled']
+    assert len(result['best_sequence']) > 0
@@ -0,0 +1,78 @@
+"""
+Sparse policy transfer (policy_cache.py).
+"""
+
+import copy
+import random
+
+import numpy as np
+
+import nrpa
+import policy
+import policy_cache
+
+
+def adapted_policies(count):
+    """Return (policies by id, lineage): the all-zero policy 0, and policies each adapted
+    to the best sequence of a level 0 search from the previous one."""
+    policies = {0: policy.WeightPolicy()}
+    lineage = {0: None}
+
+    for policy_id in range(1, count):
+        base = policies[policy_id - 1]
+        result = nrpa.NRPA().run({'batch_size': 1, 'levels': 0, 'iterations': 1, 'alpha': 1.0,
+                                  'random_seed': policy_id, 'weights': base})
+        adapted = copy.copy(base)
+        adapted.adapt(result['best_sequence'])
+        policies[policy_id] = adapted
+        lineage[policy_id] = (policy_id - 1, result['best_sequence'])
+
+    return policies, lineage
+
+
+def check_transfer(policies, order, capacity=8, lineage=None):
+    """Encode policies in order for two workers and check the decoded weights."""
+    encoder = policy_cache.PolicyEncoder(capacity=capacity)
+    caches = {1: policy_cache.PolicyCache(capacity), 2: policy_cache.PolicyCache(capacity)}
+
+    messages = []
+    for worker, policy_id in order:
+        message = encoder.encode(worker, policy_id, policies[policy_id], lineage)
+        messages.append(message)
+        weights = caches[worker].decode(message)
+        assert np.array_equal(weights, policies[policy_id].to_array()), policy_id
+
+    return messages
+
+
+def test_deltas():
+    policies, _ = adapted_policies(6)
+    order = [(1, policy_id) for policy_id in range(6)] + [(2, 5), (2, 4)]
+    messages = check_transfer(policies, order)
+
+    # The policy of the second worker is a delta against its cached policy
+    assert messages[-1]['base'] == 5
+
+    # Cached policies are sent as ids
+    message = check_transfer(policies, order + [(1, 3)])[-1]
+    assert message == {'id': 3}
+
+
+def test_chains():
+    policies, lineage = adapted_policies(6)
+    order = [(1, policy_id) for policy_id in range(6)] + [(2, 5)]
+    messages = check_transfer(policies, order, lineage=lineage)
+
+    # Every policy is one adapt sequence from the policy before it
+    assert all('chain' in message for message in messages)
+    assert [len(message['chain']) for message in messages] == [0, 1, 1, 1, 1, 1, 5]
+    assert messages[-1]['base'] is None
+
+
+def test_evictions():
+    policies, lineage = adapted_policies(8)
+    generator = random.Random(1)
+    order = [(generator.choice([1, 2]), generator.randrange(8)) for _ in range(60)]
+
+    check_transfer(policies, order, capacity=2)
+    check_transfer(policies, order, capacity=2, lineage=lineage)
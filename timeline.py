@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+Timeline of the server loop.
+
+The server records spans (select, update, send, recv, ...) and counters (running jobs) in a
+Timeline. Totals per span name are always kept; with a path, events are also appended to a
+JSONL file, one event per line:
+
+    [phase, name, timestamp, duration or value, track]
+
+Phase "X" is a span and "C" a counter. Timestamps and durations are in microseconds (since
+the epoch), track 0 is the server and track n is worker n. Worker tracks have the busy
+intervals of workers ("compute") and the time of the C++ search ("nrpa").
+
+    python3 timeline.py timeline.jsonl trace.json
+
+converts a timeline to a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import json
+import sys
+import time
+from collections import defaultdict
+
+SERVER = 0
+
+
+class Timeline:
+    """Span and counter recorder. Spans are measured with Timeline.now()."""
+
+    def __init__(self, path=None, buffer_size=4096):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.events = []
+        self.totals = defaultdict(lambda: [0, 0.0])     # name -> [count, seconds]
+
+        # Offset from perf_counter() to the epoch, so that timelines of resumed
+        # experiments can be appended to the same file
+        self.offset = time.time() - time.perf_counter()
+
+        self.file = open(path, 'a') if path else None
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+    def span(self, name, start, track=SERVER, end=None):
+        """Record a span from start to end (now by default)."""
+        if end is None:
+            end = time.perf_counter()
+
+        total = self.totals[name]
+        total[0] += 1
+        total[1] += end - start
+
+        if self.file is not None:
+            self.events.append(('X', name, start, end - start, track))
+            if len(self.events) >= self.buffer_size:
+                self.flush()
+
+    def counter(self, name, value, track=SERVER):
+        if self.file is not None:
+            self.events.append(('C', name, time.perf_counter(), value, track))
+            if len(self.events) >= self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        if self.file is None:
+            return
+
+        # Names are identifiers, so lines are formatted without json.dumps
+        offset = self.offset
+        lines = ['["X","%s",%d,%d,%d]' % (name, (start + offset) * 1e6, value * 1e6, track)
+                 if phase == 'X' else
+                 '["C","%s",%d,%d,%d]' % (name, (start + offset) * 1e6, value, track)
+                 for phase, name, start, value, track in self.events]
+        if lines:
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+        self.events = []
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def summary(self):
+        """Count and total time per span name."""
+        return ', '.join('{0}: {1} x {2:.3f} ms = {3:.2f} s'.format(
+            name, count, 1000.0 * seconds / count, seconds)
+            for name, (count, seconds) in sorted(self.totals.items()) if count > 0)
+
+
+def chrome_trace(lines):
+    """Convert timeline lines to a Chrome trace."""
+    events = []
+    tracks = set()
+
+    for line in lines:
+        if not line.strip():
+            continue
+        phase, name, timestamp, value, track = json.loads(line)
+        tracks.add(track)
+        if phase == 'X':
+            events.append({'name': name, 'ph': 'X', 'ts': timestamp, 'dur': value,
+                           'pid': 0, 'tid': track})
+        else:
+            events.append({'name': name, 'ph': 'C', 'ts': timestamp, 'pid': 0, 'tid': track,
+                           'args': {name: value}})
+
+    for track in sorted(tracks):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': track,
+                       'args': {'name': 'server' if track == SERVER
+                                else 'worker {0}'.format(track)}})
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: timeline.py TIMELINE.jsonl TRACE.json")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as timeline_file:
+        trace = chrome_trace(timeline_file)
+    with open(sys.argv[2], 'w') as trace_file:
+        json.dump(trace, trace_file)
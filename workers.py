@@ -0,0 +1,237 @@
+"""
+Worker backends used by the server loop to run atomic computations.
+"""
+
+import logging
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import policy_cache
+
+
+def hierarchy_communicators(comm, sub_servers):
+    """Split comm for a two-tier topology of a top server, sub-servers and workers.
+
+    Rank 0 is the top server and ranks 1..sub_servers are sub-servers; the other ranks are
+    workers, assigned to sub-servers in turn. Returns the communicator of the top server
+    with the sub-servers (the top server is rank 0) and the communicator of a sub-server
+    with its workers (the sub-server is rank 0), MPI.COMM_NULL for ranks not in them.
+    """
+    from mpi4py import MPI
+
+    if comm.Get_size() < 2 * sub_servers + 1:
+        raise ValueError("{0} sub-servers need at least {1} ranks.".format(
+            sub_servers, 2 * sub_servers + 1))
+
+    rank = comm.Get_rank()
+    top = comm.Split(0 if rank <= sub_servers else MPI.UNDEFINED, rank)
+
+    if rank == 0:
+        group = comm.Split(MPI.UNDEFINED, rank)
+    elif rank <= sub_servers:
+        group = comm.Split(rank - 1, 0)
+    else:
+        group = comm.Split((rank - sub_servers - 1) % sub_servers, rank)
+
+    return top, group
+
+
+class Workers:
+    """Abstract base class. Workers are identified by numbers 1..nodes."""
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.timeline = None    # timeline.Timeline of the server, if any
+
+    def ranks(self):
+        return [worker + 1 for worker in range(self.nodes)]
+
+    def send(self, worker, job):
+        """Queue job for computation on a worker. Does not block."""
+        raise NotImplementedError
+
+    def cancel(self, worker, job_id):
+        """Ask worker to stop the job with job_id early. Does not block.
+
+        The job still returns a result, with the 'cancelled' key set if it stopped early.
+        """
+        raise NotImplementedError
+
+    def recv(self):
+        """Wait for computation results.
+
+        Returns a list of all available results, in order of completion for each worker,
+        which is empty only if interrupt() ended the wait. A result is a dictionary with
+        'source', 'result' and 'stats' keys.
+        """
+        raise NotImplementedError
+
+    def interrupt(self):
+        """End the wait of recv(), or of the next recv() if none is waiting, even if no
+        results arrived. Safe to call from any thread."""
+        raise NotImplementedError
+
+    def shutdown(self):
+        """Stop all workers."""
+        raise NotImplementedError
+
+
+class MPIWorkers(Workers):
+    """Workers are MPI ranks 1..size-1 running ClientServer.client_loop.
+
+    Policies are sent as sparse deltas against policies cached by the worker, or as chains
+    of adapt sequences if jobs have a 'policy_lineage' (see policy_cache).
+    """
+
+    INTERRUPT_TAG = 1   #: Tag of the messages of interrupt(); results have tag 0
+
+    def __init__(self, comm):
+        super().__init__(comm.Get_size() - 1)
+        self.comm = comm
+        self.encoder = policy_cache.PolicyEncoder()
+
+        # Pending isend requests (they own the pickled jobs until completed)
+        self.send_requests = []
+        self.interrupt_requests = []    # sent by interrupt(), from other threads
+
+    def send(self, worker, job):
+        if 'policy_id' in job:
+            start = self.timeline.now() if self.timeline is not None else None
+            job = dict(job)
+            job['policy'] = self.encoder.encode(worker, job.pop('policy_id'), job.pop('weights'),
+                                                job.pop('policy_lineage', None))
+            if self.timeline is not None:
+                self.timeline.span('encode', start)
+
+        # The job is pickled by isend
+        cmd = {'command': 'run', 'payload': job}
+        self.send_requests.append(self.comm.isend(cmd, dest=worker))
+
+        self.collect_send_requests()
+
+    def cancel(self, worker, job_id):
+        cmd = {'command': 'cancel', 'job_id': job_id}
+        self.send_requests.append(self.comm.isend(cmd, dest=worker))
+
+        self.collect_send_requests()
+
+    def collect_send_requests(self):
+        if len(self.send_requests) > 2 * self.nodes:
+            self.send_requests = [request for request in self.send_requests
+                                  if not request.Test()]
+
+    def recv(self):
+        from mpi4py import MPI
+
+        # Matched probes receive results of any size into buffers allocated to fit
+        status = MPI.Status()
+        results = []
+        message = self.comm.mprobe(source=MPI.ANY_SOURCE, status=status)
+
+        while message is not None:
+            data = message.recv()
+            if status.Get_tag() != MPIWorkers.INTERRUPT_TAG:
+                results.append(data)
+            message = self.comm.improbe(source=MPI.ANY_SOURCE, status=status)
+
+        return results
+
+    def interrupt(self):
+        # A message of this rank to itself ends the matched probe of recv
+        self.interrupt_requests.append(self.comm.isend(None, dest=self.comm.Get_rank(),
+                                                       tag=MPIWorkers.INTERRUPT_TAG))
+
+    def shutdown(self):
+        from mpi4py import MPI
+
+        MPI.Request.Waitall(self.send_requests)
+        self.send_requests = []
+
+        # Receive interrupts that no recv() received
+        while True:
+            message = self.comm.improbe(source=self.comm.Get_rank(),
+                                        tag=MPIWorkers.INTERRUPT_TAG)
+            if message is None:
+                break
+            message.recv()
+        MPI.Request.Waitall(self.interrupt_requests)
+        self.interrupt_requests = []
+
+        for client in self.ranks():
+            logging.debug("Sending QUIT command to client {0}.".format(client))
+            cmd = {'command': 'quit'}
+            self.comm.send(cmd, dest=client)
+
+
+class ThreadPoolWorkers(Workers):
+    """Workers are threads of the server process.
+
+    Jobs are passed by reference, without pickling. The computation function must
+    release the GIL (nrpa.NRPA.run does) for the threads to run in parallel. Each job is
+    computed with its own engine from new_engine (e.g. nrpa.NRPA), which cancel() cancels.
+    """
+
+    def __init__(self, threads, computation, new_engine):
+        super().__init__(threads)
+        self.computation = computation
+        self.new_engine = new_engine
+        self.engines = dict()   # job id -> engine of a queued or running job
+        self.executors = dict((worker, ThreadPoolExecutor(max_workers=1))
+                              for worker in self.ranks())
+        self.results = queue.Queue()
+        self.time_checkpoint = dict((worker, time.time()) for worker in self.ranks())
+
+    def compute(self, worker, job, engine):
+        stats = dict()
+
+        time_measurement = time.time()
+        stats['idle_time'] = time_measurement - self.time_checkpoint[worker]
+        time_checkpoint = time_measurement
+
+        try:
+            result = self.computation(job, engine)
+        except Exception as error:
+            self.results.put({'source': worker, 'error': error})
+            raise
+        finally:
+            self.engines.pop(job.get('job_id'), None)
+
+        time_measurement = time.time()
+        stats['computation_time'] = time_measurement - time_checkpoint
+        self.time_checkpoint[worker] = time_measurement
+
+        result['computation_time'] = stats['computation_time']
+
+        self.results.put({'source': worker, 'result': result, 'stats': stats})
+
+    def send(self, worker, job):
+        engine = self.new_engine()
+        self.engines[job.get('job_id')] = engine
+        self.executors[worker].submit(self.compute, worker, job, engine)
+
+    def cancel(self, worker, job_id):
+        engine = self.engines.get(job_id)
+        if engine is not None:
+            engine.cancel()
+
+    def recv(self):
+        results = [self.results.get()]
+        while not self.results.empty():
+            results.append(self.results.get())
+
+        # None is queued by interrupt()
+        results = [data for data in results if data is not None]
+
+        for data in results:
+            if 'error' in data:
+                raise RuntimeError("Worker {0} failed.".format(data['source'])) from data['error']
+
+        return results
+
+    def interrupt(self):
+        self.results.put(None)
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown()